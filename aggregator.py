@@ -1,5 +1,11 @@
 # stdlib
+from array import array
+from hashlib import md5
+from itertools import izip
 import logging
+import math
+from struct import unpack_from
+import threading
 from time import time
 
 # project
@@ -28,6 +34,11 @@ class UnknownValue(Exception):
     pass
 
 
+class UnparseablePacket(Exception):
+    """ Raised by the packet parsers on malformed input """
+    pass
+
+
 class Metric(object):
     """
     A base metric class that accepts points, slices them into time intervals
@@ -42,6 +53,14 @@ class Metric(object):
         """ Flush all metrics up to the given timestamp. """
         raise NotImplementedError()
 
+    def dump(self):
+        """ Return the picklable state sampled since the last flush. """
+        raise NotImplementedError()
+
+    def merge(self, state):
+        """ Merge a state returned by `dump` into this metric. """
+        raise NotImplementedError()
+
 
 class Gauge(Metric):
     """ A metric that tracks a value at particular points in time. """
@@ -61,6 +80,18 @@ class Gauge(Metric):
         self.last_sample_time = time()
         self.timestamp = timestamp
 
+    def dump(self):
+        return (self.value, self.last_sample_time, self.timestamp)
+
+    def merge(self, state):
+        # Last write wins
+        value, last_sample_time, timestamp = state
+        if value is None:
+            return
+        if self.last_sample_time is None or last_sample_time >= self.last_sample_time:
+            self.value = value
+            self.last_sample_time = last_sample_time
+            self.timestamp = timestamp
 
     def flush(self, timestamp, interval):
         if self.value is not None:
@@ -201,6 +232,14 @@ class Counter(Metric):
         self.value += value * int(1 / sample_rate)
         self.last_sample_time = time()
 
+    def dump(self):
+        return (self.value, self.last_sample_time)
+
+    def merge(self, state):
+        value, last_sample_time = state
+        self.value += value
+        self.last_sample_time = max(self.last_sample_time, last_sample_time)
+
     def flush(self, timestamp, interval):
         try:
             value = self.value / interval
@@ -244,10 +283,17 @@ class Histogram(Metric):
         self.samples.append(value)
         self.last_sample_time = time()
 
-    def flush(self, ts, interval):
-        if not self.count:
-            return []
+    def dump(self):
+        return (self.count, self.samples, self.last_sample_time)
 
+    def merge(self, state):
+        count, samples, last_sample_time = state
+        self.count += count
+        self.samples.extend(samples)
+        self.last_sample_time = max(self.last_sample_time, last_sample_time)
+
+    def _summarize(self):
+        """ Return the min, max, median and average of the samples. """
         self.samples.sort()
         length = len(self.samples)
 
@@ -255,6 +301,21 @@ class Histogram(Metric):
         max_ = self.samples[-1]
         med = self.samples[int(round(length/2 - 1))]
         avg = sum(self.samples) / float(length)
+        return min_, max_, med, avg
+
+    def _percentile(self, p):
+        """ Called after `_summarize`. """
+        return self.samples[int(round(p * len(self.samples) - 1))]
+
+    def _reset(self):
+        self.samples = []
+        self.count = 0
+
+    def flush(self, ts, interval):
+        if not self.count:
+            return []
+
+        min_, max_, med, avg = self._summarize()
 
         aggregators = [
             ('min', min_, MetricTypes.GAUGE),
@@ -282,7 +343,7 @@ class Histogram(Metric):
         ]
 
         for p in self.percentiles:
-            val = self.samples[int(round(p * length - 1))]
+            val = self._percentile(p)
             name = '%s.%spercentile' % (self.name, int(p * 100))
             metrics.append(self.formatter(
                 hostname=self.hostname,
@@ -295,14 +356,192 @@ class Histogram(Metric):
             ))
 
         # Reset our state.
-        self.samples = []
-        self.count = 0
+        self._reset()
 
         return metrics
 
 
+DEFAULT_SKETCH_RELATIVE_ACCURACY = 0.01
+DEFAULT_SKETCH_MAX_BINS = 2048
+# Samples closer to 0 than this are counted as 0
+SKETCH_MIN_VALUE = 1e-9
+
+
+class SketchHistogram(Histogram):
+    """
+    A Histogram that counts its samples in bins of logarithmic size instead
+    of keeping them. Its memory doesn't grow with the number of samples, and
+    the median and percentiles it reports are within `relative_accuracy` of
+    a sample that has this rank. Past `max_bins` bins of positive (or
+    negative) values, the ones closest to 0 are merged and lose this guarantee.
+
+    Samples are weighted by 1/sample_rate, so that sampled values count in the
+    distribution as much as they count in `count`. The min and max are exact,
+    the average is weighted.
+    """
+
+    def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
+        Histogram.__init__(self, formatter, name, tags, hostname, device_name, extra_config)
+        extra_config = extra_config or {}
+        relative_accuracy = extra_config.get('relative_accuracy') or DEFAULT_SKETCH_RELATIVE_ACCURACY
+        self.max_bins = extra_config.get('max_bins') or DEFAULT_SKETCH_MAX_BINS
+        # A bin holds the values in ]gamma^(key - 1), gamma^key]
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._inverse_log_gamma = 1 / math.log(self.gamma)
+        self._reset()
+
+    def _reset(self):
+        self.count = 0
+        self.bins = {}
+        self.negative_bins = {}
+        self.zero_weight = 0
+        self.weight = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+
+    def _key(self, value):
+        return int(math.ceil(math.log(value) * self._inverse_log_gamma))
+
+    def _value(self, key):
+        # Within relative_accuracy of every value of the bin
+        return 2 * self.gamma ** key / (self.gamma + 1)
+
+    def _collapse(self, bins):
+        keys = sorted(bins)
+        excess = len(keys) - self.max_bins
+        for key in keys[:excess]:
+            bins[keys[excess]] += bins.pop(key)
+
+    def sample(self, value, sample_rate, timestamp=None):
+        # Checked before anything is counted, not to leave the sketch inconsistent
+        if math.isnan(value) or math.isinf(value):
+            raise ValueError("Unable to sketch %s in %s" % (value, self.name))
+        weight = 1.0 / sample_rate
+        if value > SKETCH_MIN_VALUE:
+            bins = self.bins
+            key = self._key(value)
+        elif value < -SKETCH_MIN_VALUE:
+            bins = self.negative_bins
+            key = self._key(-value)
+        else:
+            bins = None
+
+        self.count += int(1 / sample_rate)
+        if bins is not None:
+            bins[key] = bins.get(key, 0) + weight
+            if len(bins) > self.max_bins:
+                self._collapse(bins)
+        else:
+            self.zero_weight += weight
+
+        self.weight += weight
+        self.sum += value * weight
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        self.last_sample_time = time()
+
+    def dump(self):
+        return (self.count, self.bins, self.negative_bins, self.zero_weight, self.weight,
+                self.sum, self.min, self.max, self.last_sample_time)
+
+    def merge(self, state):
+        count, bins, negative_bins, zero_weight, weight, sum_, min_, max_, last_sample_time = state
+        self.count += count
+        for own_bins, other_bins in ((self.bins, bins), (self.negative_bins, negative_bins)):
+            for key, bin_weight in other_bins.iteritems():
+                own_bins[key] = own_bins.get(key, 0) + bin_weight
+            if len(own_bins) > self.max_bins:
+                self._collapse(own_bins)
+        self.zero_weight += zero_weight
+        self.weight += weight
+        self.sum += sum_
+        if min_ is not None and (self.min is None or min_ < self.min):
+            self.min = min_
+        if max_ is not None and (self.max is None or max_ > self.max):
+            self.max = max_
+        self.last_sample_time = max(self.last_sample_time, last_sample_time)
+
+    def _summarize(self):
+        return self.min, self.max, self._percentile(0.5), self.sum / float(self.weight)
+
+    def _percentile(self, p):
+        # The value of the bin that holds the sample of rank p * weight
+        rank = p * self.weight
+        cumulative = 0
+        value = None
+        for key in sorted(self.negative_bins, reverse=True):
+            cumulative += self.negative_bins[key]
+            if cumulative >= rank:
+                value = -self._value(key)
+                break
+        else:
+            cumulative += self.zero_weight
+            if self.zero_weight and cumulative >= rank:
+                value = 0
+            else:
+                for key in sorted(self.bins):
+                    cumulative += self.bins[key]
+                    if cumulative >= rank:
+                        value = self._value(key)
+                        break
+                else:
+                    value = self.max
+        return min(max(value, self.min), self.max)
+
+
+# Precision of the HyperLogLog sets: they have 2^precision registers of a byte
+DEFAULT_SET_HYPERLOGLOG_PRECISION = 12
+
+
+def _hyperloglog_hash(value):
+    """ A 64 bits hash of a set value, stable across processes. """
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    elif not isinstance(value, str):
+        value = repr(value)
+    return unpack_from('<Q', md5(value).digest())[0]
+
+
+def _hyperloglog_sigma(x):
+    if x == 1:
+        return float('inf')
+    y = 1.0
+    z = x
+    while True:
+        x *= x
+        previous_z = z
+        z += x * y
+        y += y
+        if z == previous_z:
+            return z
+
+
+def _hyperloglog_tau(x):
+    if x == 0 or x == 1:
+        return 0.0
+    y = 1.0
+    z = 1 - x
+    while True:
+        x = math.sqrt(x)
+        previous_z = z
+        y *= 0.5
+        z -= (1 - x) ** 2 * y
+        if z == previous_z:
+            return z / 3
+
+
 class Set(Metric):
-    """ A metric to track the number of unique elements in a set. """
+    """
+    A metric to track the number of unique elements in a set.
+
+    Past `exact_threshold` elements, the set switches to a HyperLogLog of
+    2^`precision` registers: its memory stops growing and the number of
+    elements it reports has a standard error of 1.04/sqrt(2^precision), i.e.
+    1.6% with the default precision of 12 (4KB per set).
+    """
 
     def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
         self.formatter = formatter
@@ -310,29 +549,93 @@ class Set(Metric):
         self.tags = tags
         self.hostname = hostname
         self.device_name = device_name
+        extra_config = extra_config or {}
+        self.exact_threshold = extra_config.get('exact_threshold')
+        self.precision = extra_config.get('precision') or DEFAULT_SET_HYPERLOGLOG_PRECISION
         self.values = set()
+        # The HyperLogLog registers, once the set went past exact_threshold
+        self.registers = None
         self.last_sample_time = None
 
     def sample(self, value, sample_rate, timestamp=None):
-        self.values.add(value)
+        if self.registers is None:
+            self.values.add(value)
+            if self.exact_threshold and len(self.values) > self.exact_threshold:
+                self._to_hyperloglog()
+        else:
+            self._add_to_registers(value)
         self.last_sample_time = time()
 
+    def _to_hyperloglog(self):
+        self.registers = bytearray(1 << self.precision)
+        for value in self.values:
+            self._add_to_registers(value)
+        self.values = set()
+
+    def _add_to_registers(self, value):
+        h = _hyperloglog_hash(value)
+        index = h & ((1 << self.precision) - 1)
+        # The registers keep the maximum position of the first 1 bit in
+        # what's left of the hash
+        rank = 65 - self.precision - (h >> self.precision).bit_length()
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def _estimate(self):
+        """
+        The cardinality estimated from the registers, with the estimator of
+        Otmar Ertl's "New cardinality estimation algorithms for HyperLogLog
+        sketches", which doesn't need the bias corrections of the original
+        one for small cardinalities.
+        """
+        m = len(self.registers)
+        q = 64 - self.precision
+        counts = [0] * (q + 2)
+        for register in self.registers:
+            counts[register] += 1
+        z = m * _hyperloglog_tau(1 - float(counts[q + 1]) / m)
+        for k in xrange(q, 0, -1):
+            z = 0.5 * (z + counts[k])
+        z += m * _hyperloglog_sigma(float(counts[0]) / m)
+        return m * m / (2 * math.log(2) * z)
+
+    def dump(self):
+        return (self.values, self.registers, self.last_sample_time)
+
+    def merge(self, state):
+        values, registers, last_sample_time = state
+        if registers is None:
+            for value in values:
+                self.sample(value, 1)
+        else:
+            if self.registers is None:
+                self._to_hyperloglog()
+            for index, register in enumerate(registers):
+                if register > self.registers[index]:
+                    self.registers[index] = register
+        self.last_sample_time = max(self.last_sample_time, last_sample_time)
+
     def flush(self, timestamp, interval):
-        if not self.values:
-            return []
+        if self.registers is None:
+            if not self.values:
+                return []
+            value = len(self.values)
+        else:
+            value = int(round(self._estimate()))
         try:
             return [self.formatter(
                 hostname=self.hostname,
                 device_name=self.device_name,
                 tags=self.tags,
                 metric=self.name,
-                value=len(self.values),
+                value=value,
                 timestamp=timestamp,
                 metric_type=MetricTypes.GAUGE,
                 interval=interval,
             )]
         finally:
             self.values = set()
+            self.registers = None
 
 
 class Rate(Metric):
@@ -387,6 +690,437 @@ class Rate(Metric):
         finally:
             self.samples = self.samples[-1:]
 
+class ContextExpiryIndex(object):
+    """
+    The last sample time of metric contexts, indexed by its second like in a
+    timing wheel, so that the expired contexts are found without comparing
+    the last sample time of every context.
+
+    A context sampled again in a new second is moved to the slot of that
+    second, so that each context is in a single slot.
+    """
+
+    def __init__(self):
+        self.last_sample_time_by_context = {}
+        self._contexts_by_second = {}
+
+    def __len__(self):
+        return len(self.last_sample_time_by_context)
+
+    def __iter__(self):
+        return iter(self.last_sample_time_by_context)
+
+    def __contains__(self, context):
+        return context in self.last_sample_time_by_context
+
+    def touch(self, context, last_sample_time):
+        previous = self.last_sample_time_by_context.get(context)
+        self.last_sample_time_by_context[context] = last_sample_time
+        second = int(last_sample_time)
+        if previous is None or int(previous) != second:
+            if previous is not None:
+                self._remove_from_slot(context, int(previous))
+            contexts = self._contexts_by_second.get(second)
+            if contexts is None:
+                contexts = self._contexts_by_second[second] = set()
+            contexts.add(context)
+
+    def _remove_from_slot(self, context, second):
+        contexts = self._contexts_by_second.get(second)
+        if contexts is not None:
+            contexts.discard(context)
+            if not contexts:
+                del self._contexts_by_second[second]
+
+    def discard(self, context):
+        previous = self.last_sample_time_by_context.pop(context, None)
+        if previous is not None:
+            self._remove_from_slot(context, int(previous))
+
+    def expire(self, expiry_timestamp):
+        """ Remove and return the contexts last sampled before `expiry_timestamp` """
+        last_sample_time_by_context = self.last_sample_time_by_context
+        expired = []
+        for second in [s for s in self._contexts_by_second if s < expiry_timestamp]:
+            not_expired = set()
+            for context in self._contexts_by_second.pop(second):
+                last_sample_time = last_sample_time_by_context[context]
+                if last_sample_time < expiry_timestamp:
+                    del last_sample_time_by_context[context]
+                    expired.append(context)
+                else:
+                    # The expiry timestamp is within this second
+                    not_expired.add(context)
+            if not_expired:
+                self._contexts_by_second[second] = not_expired
+        return expired
+
+
+# Kinds of the metrics stored in the columns of a MetricBucket
+GAUGE_KIND = 0
+COUNTER_KIND = 1
+
+
+class MetricBucket(object):
+    """
+    The metrics sampled in a bucket of a MetricsBucketAggregator.
+
+    Gauges and counters only hold a number, so they aren't Metric objects:
+    their contexts are interned into integer slots, and their kinds, values
+    and last sample times stored in columns indexed by slot. That's a few
+    dozen bytes per context instead of an object and its dict. The other
+    metrics are in `metric_by_context`.
+    """
+
+    def __init__(self):
+        self.metric_by_context = {}
+        self.slot_by_context = {}
+        self.contexts = []
+        self.kinds = bytearray()
+        # Not doubles: the integers keep their exact value, and are sent as integers
+        self.values = []
+        self.last_sample_times = array('d')
+
+    def __len__(self):
+        return len(self.metric_by_context) + len(self.contexts)
+
+    def add_slot(self, context, kind, value=0, last_sample_time=0):
+        slot = self.slot_by_context[context] = len(self.contexts)
+        self.contexts.append(context)
+        self.kinds.append(kind)
+        self.values.append(value)
+        self.last_sample_times.append(last_sample_time)
+        return slot
+
+    def sample_slot(self, slot, value, sample_rate):
+        if self.kinds[slot] == COUNTER_KIND:
+            self.values[slot] += value * int(1 / sample_rate)
+        else:
+            self.values[slot] = value
+        self.last_sample_times[slot] = time()
+
+    def merge_slot(self, slot, value, last_sample_time):
+        if self.kinds[slot] == COUNTER_KIND:
+            self.values[slot] += value
+            self.last_sample_times[slot] = max(self.last_sample_times[slot], last_sample_time)
+        elif last_sample_time >= self.last_sample_times[slot]:
+            # Last write wins
+            self.values[slot] = value
+            self.last_sample_times[slot] = last_sample_time
+
+    def is_counter(self, context):
+        slot = self.slot_by_context.get(context)
+        if slot is None:
+            return isinstance(self.metric_by_context.get(context), Counter)
+        return self.kinds[slot] == COUNTER_KIND
+
+    def dump(self):
+        """ The state of the metrics, in the format of the Metric classes' `dump` """
+        dumped = dict(
+            (context, (metric.__class__, metric.dump()))
+            for context, metric in self.metric_by_context.iteritems()
+        )
+        for context, kind, value, last_sample_time in izip(self.contexts, self.kinds, self.values,
+                                                          self.last_sample_times):
+            if kind == COUNTER_KIND:
+                dumped[context] = (Counter, (value, last_sample_time))
+            else:
+                dumped[context] = (BucketGauge, (value, last_sample_time, None))
+        return dumped
+
+
+class InternTable(object):
+    """
+    Canonical instances of the metric names, hostnames, tags and tag tuples,
+    so that the contexts repeating them share the same objects, and that
+    comparing them mostly compares identities.
+
+    `str` goes through the builtin `intern`, whose strings are released once
+    unused. Unicode strings and tuples can neither be interned nor weakly
+    referenced, they're kept in a two-generation table of up to `size`
+    entries, like the context cache. A `size` of 0 disables the interning.
+    """
+
+    def __init__(self, size):
+        self.size = int(size or 0)
+        self._table = {}
+        self._table_old = {}
+
+    def __len__(self):
+        return len(self._table) + len(self._table_old)
+
+    def string(self, s):
+        if not self.size or s is None:
+            return s
+        if type(s) is str:
+            return intern(s)
+        return self._canonical(s)
+
+    def tags(self, tags):
+        """ The canonical tuple of a tuple of tags, made of canonical tags """
+        if not self.size or not tags:
+            return tags
+        canonical = self._table.get(tags)
+        if canonical is None:
+            canonical = self._table_old.get(tags)
+            if canonical is None:
+                canonical = tuple([intern(tag) if type(tag) is str else self._canonical(tag) for tag in tags])
+            self._add(canonical)
+        return canonical
+
+    def _canonical(self, key):
+        canonical = self._table.get(key)
+        if canonical is None:
+            canonical = self._table_old.get(key, key)
+            self._add(canonical)
+        return canonical
+
+    def _add(self, canonical):
+        if len(self._table) * 2 >= self.size:
+            self._table_old = self._table
+            self._table = {}
+        self._table[canonical] = canonical
+
+
+# Tags of the contexts that new contexts past the limit of their metric are folded into
+OVERFLOW_TAGS = ('overflow:true', )
+# Internal metrics, never limited
+CONTEXT_LIMITER_EXEMPT_PREFIX = 'datadog.dogstatsd.'
+# Number of metric names whose rejected samples are counted by name
+CONTEXT_LIMITER_MAX_REJECTED_NAMES = 1000
+
+
+class ContextLimiter(object):
+    """
+    Bounds the number of contexts an aggregator samples in a flush interval,
+    globally and per metric name.
+
+    The contexts sampled in the previous interval keep their place in the
+    current one: only new contexts are limited. Past the limit of their
+    metric, they're folded into its overflow context, tagged `overflow:true`,
+    or dropped if `overflow` is False. Past the global limit, they're dropped
+    unless that overflow context was already sampled.
+    """
+
+    def __init__(self, max_contexts=0, max_contexts_per_metric=0, overflow=True):
+        self.max_contexts = max_contexts or 0
+        self.max_contexts_per_metric = max_contexts_per_metric or 0
+        self.overflow = overflow
+        self.current = set()
+        self.previous = set()
+        # Contexts of the current interval that weren't in the previous one
+        self.new_count = 0
+        self.new_count_by_name = {}
+        self.previous_count_by_name = {}
+        self.rejected_count = 0
+        self.rejected_count_by_name = {}
+
+    def __len__(self):
+        return len(self.previous) + self.new_count
+
+    def admit(self, context):
+        """ The context to sample instead of `context`, None to drop the sample """
+        if context in self.current:
+            return context
+        if context in self.previous:
+            self.current.add(context)
+            return context
+
+        name = context[0]
+        if name.startswith(CONTEXT_LIMITER_EXEMPT_PREFIX):
+            return context
+
+        over_metric_limit = self.max_contexts_per_metric and \
+            self.previous_count_by_name.get(name, 0) + self.new_count_by_name.get(name, 0) \
+            >= self.max_contexts_per_metric
+        if self.max_contexts and len(self) >= self.max_contexts or over_metric_limit:
+            self._reject(name)
+            if not self.overflow:
+                return None
+            overflow_context = (name, OVERFLOW_TAGS, context[2], context[3])
+            if overflow_context in self.current:
+                return overflow_context
+            if overflow_context in self.previous:
+                self.current.add(overflow_context)
+                return overflow_context
+            if self.max_contexts and len(self) >= self.max_contexts:
+                return None
+            # Past the limit of its metric only
+            context = overflow_context
+
+        self.current.add(context)
+        self.new_count += 1
+        self.new_count_by_name[name] = self.new_count_by_name.get(name, 0) + 1
+        return context
+
+    def _reject(self, name):
+        self.rejected_count += 1
+        rejected_count_by_name = self.rejected_count_by_name
+        if name in rejected_count_by_name:
+            rejected_count_by_name[name] += 1
+        elif len(rejected_count_by_name) < CONTEXT_LIMITER_MAX_REJECTED_NAMES:
+            rejected_count_by_name[name] = 1
+
+    def rotate(self):
+        """ Start a new flush interval """
+        count_by_name = {}
+        for context in self.current:
+            count_by_name[context[0]] = count_by_name.get(context[0], 0) + 1
+        self.previous = self.current
+        self.previous_count_by_name = count_by_name
+        self.current = set()
+        self.new_count = 0
+        self.new_count_by_name = {}
+
+    def pop_stats(self, top=5):
+        """
+        Return and reset the number of rejected samples, with the `top` metric
+        names with the most rejected samples.
+        """
+        top_rejected = sorted(self.rejected_count_by_name.iteritems(), key=lambda n: (-n[1], n[0]))[:top]
+        stats = {
+            'contexts': len(self),
+            'rejected': self.rejected_count,
+            'top_rejected': top_rejected,
+        }
+        self.rejected_count = 0
+        self.rejected_count_by_name = {}
+        return stats
+
+
+def coalesce_service_checks(service_checks):
+    """
+    Keep the latest status of each check, by host and tags, with the number
+    of runs it stands for in `count` when there were several.
+    Service checks keep the order of their first run.
+    """
+    coalesced = []
+    index_by_key = {}
+    for service_check in service_checks:
+        key = (service_check['check'], service_check['host_name'], tuple(service_check.get('tags') or ()))
+        index = index_by_key.get(key)
+        if index is None:
+            index_by_key[key] = len(coalesced)
+            coalesced.append(service_check)
+            continue
+        latest = coalesced[index]
+        count = latest.get('count', 1) + 1
+        if service_check['timestamp'] >= latest['timestamp']:
+            latest = coalesced[index] = service_check
+        latest['count'] = count
+    return coalesced
+
+
+# The fields of the events that are coalesced, besides their aggregation key
+EVENT_COALESCING_FIELDS = ('msg_title', 'alert_type', 'priority', 'source_type_name', 'host')
+
+
+def coalesce_events(events):
+    """
+    Keep the latest of the events that share an aggregation key, and all the
+    fields monitors filter on, with their number in `count` when there
+    were several. Events without an aggregation key are all kept.
+    """
+    coalesced = []
+    index_by_key = {}
+    for event in events:
+        aggregation_key = event.get('aggregation_key')
+        if aggregation_key is None:
+            coalesced.append(event)
+            continue
+        key = (aggregation_key, tuple(event.get('tags') or ())) + \
+            tuple(event.get(field) for field in EVENT_COALESCING_FIELDS)
+        index = index_by_key.get(key)
+        if index is None:
+            index_by_key[key] = len(coalesced)
+            coalesced.append(event)
+            continue
+        latest = coalesced[index]
+        count = latest.get('count', 1) + 1
+        if event['timestamp'] >= latest['timestamp']:
+            latest = coalesced[index] = event
+        latest['count'] = count
+    return coalesced
+
+
+# Metric types whose packets can be shed: their sample_rate compensates the
+# shed packets. Gauges and sets can't be compensated.
+SHEDDABLE_METRIC_TYPES = frozenset(['c', 'h', 'ms'])
+# Shedding keeps at least 1 in this many packets of each context
+LOAD_SHEDDER_MAX_RATIO = 64
+# How often the time spent aggregating is measured, in seconds
+LOAD_SHEDDER_WINDOW = 1.0
+
+
+class LoadShedder(object):
+    """
+    Sheds counter and histogram packets when aggregating them takes more
+    than `cpu_budget` of the time of the thread submitting them.
+
+    The load is measured every `LOAD_SHEDDER_WINDOW`. Above the budget, the
+    shedding ratio is doubled: only 1 in `ratio` packets of each context is
+    kept. It's halved once the load is under half the budget. Packets are
+    shed deterministically, every `ratio`-th packet of a context is kept,
+    and sampled with its sample_rate divided by `ratio` so that counts stay
+    unbiased. The positions of the contexts are kept across windows, so that
+    contexts sending less than `ratio` packets per window aren't over-counted,
+    and dropped once nothing is shed anymore.
+    """
+
+    def __init__(self, cpu_budget):
+        self.cpu_budget = float(cpu_budget)
+        self.ratio = 1
+        self.window_start = time()
+        self.busy_time = 0.0
+        # Packets seen modulo the ratio by context key
+        self.positions = {}
+        self.packet_count = 0
+        self.shed_count = 0
+
+    def keep(self, key):
+        """ Whether to keep the packet of context `key` """
+        position = self.positions.get(key, 0) % self.ratio
+        self.positions[key] = position + 1
+        if position:
+            self.shed_count += 1
+            return False
+        return True
+
+    def account(self, start, end, packet_count):
+        """ Account for `packet_count` metric packets aggregated from `start` to `end` """
+        self.busy_time += end - start
+        self.packet_count += packet_count
+        elapsed = end - self.window_start
+        if elapsed < LOAD_SHEDDER_WINDOW:
+            return
+
+        load = self.busy_time / elapsed
+        if load > self.cpu_budget and self.ratio < LOAD_SHEDDER_MAX_RATIO:
+            self.ratio *= 2
+            log.warning("Aggregating took %.0f%% of the time, over the budget of %.0f%%. "
+                        "Keeping 1 in %s counter and histogram packets",
+                        load * 100, self.cpu_budget * 100, self.ratio)
+        elif load < self.cpu_budget / 2 and self.ratio > 1:
+            self.ratio //= 2
+            log.info("Aggregating took %.0f%% of the time. Keeping 1 in %s counter and histogram packets",
+                     load * 100, self.ratio)
+            if self.ratio == 1:
+                self.positions = {}
+        self.window_start = end
+        self.busy_time = 0.0
+
+    def pop_stats(self):
+        """ Return and reset the number of metric packets seen and shed """
+        stats = {
+            'packets': self.packet_count,
+            'shed': self.shed_count,
+            'ratio': self.ratio,
+        }
+        self.packet_count = 0
+        self.shed_count = 0
+        return stats
+
+
 class Aggregator(object):
     """
     Abstract metric aggregator class.
@@ -397,7 +1131,11 @@ class Aggregator(object):
     def __init__(self, hostname, interval=1.0, expiry_seconds=300,
             formatter=None, recent_point_threshold=None,
             histogram_aggregates=None, histogram_percentiles=None,
-            utf8_decoding=False):
+            utf8_decoding=False, context_cache_size=0,
+            histogram_sketch_prefixes=None, histogram_sketch_accuracy=None,
+            set_hyperloglog_threshold=None, set_hyperloglog_precision=None,
+            intern_table_size=0, max_contexts=0, max_contexts_per_metric=0, context_overflow=True,
+            cpu_budget=0, coalesce_service_checks=False, coalesce_events=False):
         self.events = []
         self.service_checks = []
         self.total_count = 0
@@ -412,17 +1150,64 @@ class Aggregator(object):
         recent_point_threshold = recent_point_threshold or RECENT_POINT_THRESHOLD_DEFAULT
         self.recent_point_threshold = int(recent_point_threshold)
         self.num_discarded_old_points = 0
+        self.num_malformed_packets = 0
+
+        # Held to update what's both submitted from a thread and flushed from
+        # another: the packet counts, the events and the service checks
+        self._lock = threading.Lock()
 
         # Additional config passed when instantiating metric configs
         self.metric_config = {
             Histogram: {
                 'aggregates': histogram_aggregates,
                 'percentiles': histogram_percentiles
-            }
+            },
+            SketchHistogram: {
+                'aggregates': histogram_aggregates,
+                'percentiles': histogram_percentiles,
+                'relative_accuracy': histogram_sketch_accuracy,
+            },
+            Set: {
+                'exact_threshold': set_hyperloglog_threshold,
+                'precision': set_hyperloglog_precision,
+            },
         }
 
+        # Histograms whose name starts with one of these prefixes are
+        # SketchHistograms, '' makes them all sketches
+        self.histogram_sketch_prefixes = tuple(histogram_sketch_prefixes) if histogram_sketch_prefixes else None
+
         self.utf8_decoding = utf8_decoding
 
+        # Bounded cache of the resolved contexts of the recent metric packets,
+        # keyed on the packet without its value. See _submit_cached_metric_packet
+        self.context_cache_size = int(context_cache_size or 0)
+        self._context_cache = {}
+        self._context_cache_old = {}
+
+        # Canonical names and tags of the contexts, which the formatters then share
+        self.interned = InternTable(intern_table_size)
+
+        self.context_limiter = None
+        if max_contexts or max_contexts_per_metric:
+            self.context_limiter = ContextLimiter(max_contexts, max_contexts_per_metric, context_overflow)
+
+        self.load_shedder = None
+        if cpu_budget:
+            self.load_shedder = LoadShedder(cpu_budget)
+
+        # Whether the repeated service checks and events of a flush are
+        # coalesced, see coalesce_service_checks and coalesce_events
+        self.coalesce_service_checks = coalesce_service_checks
+        self.coalesce_events = coalesce_events
+
+    def _metric_class(self, name, mtype):
+        metric_class = self.metric_type_to_class[mtype]
+        if metric_class is Histogram and self.histogram_sketch_prefixes is not None\
+                and name.startswith(self.histogram_sketch_prefixes):
+            return SketchHistogram
+        return metric_class
+
     def packets_per_second(self, interval):
         if interval == 0:
             return 0
@@ -432,67 +1217,79 @@ class Aggregator(object):
         """
         Schema of a dogstatsd packet:
         <name>:<value>|<metric_type>|@<sample_rate>|#<tag1_name>:<tag1_value>,<tag2_name>:<tag2_value>:<value>|<metric_type>...
-        """
-        parsed_packets = []
-        name_and_metadata = packet.split(':', 1)
-
-        if len(name_and_metadata) != 2:
-            raise Exception('Unparseable metric packet: %s' % packet)
-
-        name = name_and_metadata[0]
-        broken_split = name_and_metadata[1].split(':')
-        data = []
-        partial_datum = None
-        for token in broken_split:
-            # We need to fix the tag groups that got broken by the : split
-            if partial_datum is None:
-                partial_datum = token
-            elif "|" not in token:
-                partial_datum += ":" + token
-            else:
-                data.append(partial_datum)
-                partial_datum = token
-        data.append(partial_datum)
 
-        for datum in data:
-            value_and_metadata = datum.split('|')
+        The packet is walked with index arithmetic, its colons are never split
+        and joined back together.
+        """
+        name_end = packet.find(':')
+        if name_end == -1:
+            raise UnparseablePacket('Unparseable metric packet: %s' % packet)
+        name = packet[:name_end]
+        length = len(packet)
+        find = packet.find
 
-            if len(value_and_metadata) < 2:
-                raise Exception('Unparseable metric packet: %s' % packet)
+        parsed_packets = []
+        start = name_end + 1
+        while True:
+            # A value ends at the last ':' before the first '|' that follows
+            # a ':', the other colons belong to its tags.
+            end = length
+            colon = find(':', start)
+            if colon != -1:
+                pipe = find('|', colon + 1)
+                if pipe != -1:
+                    end = packet.rfind(':', colon, pipe)
+
+            value_end = find('|', start, end)
+            if value_end == -1:
+                raise UnparseablePacket('Unparseable metric packet: %s' % packet)
+            type_end = find('|', value_end + 1, end)
+            if type_end == -1:
+                type_end = end
 
             # Submit the metric
-            raw_value = value_and_metadata[0]
-            metric_type = value_and_metadata[1]
+            raw_value = packet[start:value_end]
+            metric_type = packet[value_end + 1:type_end]
 
             if metric_type in self.ALLOW_STRINGS:
                 value = raw_value
             else:
                 # Try to cast as an int first to avoid precision issues, then as a
-                # float.
+                # float. int() never parses decimals, don't pay for its failure.
                 try:
-                    value = int(raw_value)
-                except ValueError:
-                    try:
+                    if '.' in raw_value:
                         value = float(raw_value)
-                    except ValueError:
-                        # Otherwise, raise an error saying it must be a number
-                        raise Exception('Metric value must be a number: %s, %s' % (name, raw_value))
-
+                    else:
+                        try:
+                            value = int(raw_value)
+                        except ValueError:
+                            value = float(raw_value)
+                except ValueError:
+                    # Otherwise, raise an error saying it must be a number
+                    raise UnparseablePacket('Metric value must be a number: %s, %s' % (name, raw_value))
 
             # Parse the optional values - sample rate & tags.
             sample_rate = 1
             tags = None
-            for m in value_and_metadata[2:]:
-                # Parse the sample rate
-                if m[0] == '@':
-                    sample_rate = float(m[1:])
-                    assert 0 <= sample_rate <= 1
-                elif m[0] == '#':
-                    tags = tuple(sorted(m[1:].split(',')))
-
-            parsed_packets.append((name, value, metric_type, tags,sample_rate))
-
-        return parsed_packets
+            if type_end < end:
+                for m in packet[type_end + 1:end].split('|'):
+                    if not m:
+                        raise UnparseablePacket('Unparseable metric packet: %s' % packet)
+                    # Parse the sample rate
+                    if m[0] == '@':
+                        try:
+                            sample_rate = float(m[1:])
+                        except ValueError:
+                            raise UnparseablePacket('Sample rate must be a number: %s' % packet)
+                        if not 0 <= sample_rate <= 1:
+                            raise UnparseablePacket('Sample rate must be between 0 and 1: %s' % packet)
+                    elif m[0] == '#':
+                        tags = tuple(sorted(m[1:].split(',')))
+
+            parsed_packets.append((name, value, metric_type, tags, sample_rate))
+            if end == length:
+                return parsed_packets
+            start = end + 1
 
     def _unescape_sc_content(self, string):
         return string.replace('\\n', '\n').replace('m\:', 'm:')
@@ -504,7 +1301,7 @@ class Aggregator(object):
         try:
             name_and_metadata = packet.split(':', 1)
             if len(name_and_metadata) != 2:
-                raise Exception(u'Unparseable event packet: %s' % packet)
+                raise UnparseablePacket(u'Unparseable event packet: %s' % packet)
             # Event syntax:
             # _e{5,4}:title|body|meta
             name = name_and_metadata[0]
@@ -535,7 +1332,7 @@ class Aggregator(object):
                     event['tags'] = sorted(m[1:].split(u','))
             return event
         except (IndexError, ValueError):
-            raise Exception(u'Unparseable event packet: %s' % packet)
+            raise UnparseablePacket(u'Unparseable event packet: %s' % packet)
 
     def parse_sc_packet(self, packet):
         try:
@@ -576,9 +1373,15 @@ class Aggregator(object):
             return service_check
 
         except (IndexError, ValueError):
-            raise Exception(u'Unparseable service check packet: %s' % packet)
+            raise UnparseablePacket(u'Unparseable service check packet: %s' % packet)
 
-    def submit_packets(self, packets):
+    def submit_packets(self, packets, skip_malformed=False):
+        """
+        Parse and submit newline-separated packets.
+        By default a malformed packet raises and aborts the rest of `packets`.
+        With `skip_malformed`, it is logged and skipped instead, which is what
+        we want when `packets` holds several datagrams drained in one batch.
+        """
         # We should probably consider that packets are always encoded
         # in utf8, but decoding all packets has an perf overhead of 7%
         # So we let the user decide if we wants utf8 by default
@@ -587,26 +1390,155 @@ class Aggregator(object):
         if self.utf8_decoding:
             packets = unicode(packets, 'utf-8', errors='replace')
 
-        for packet in packets.splitlines():
-            if not packet.strip():
-                continue
+        load_shedder = self.load_shedder
+        if load_shedder is not None:
+            start = time()
+        count = 0
+        event_count = 0
+        service_check_count = 0
+        malformed_count = 0
+        try:
+            for packet in packets.splitlines():
+                if not packet.strip():
+                    continue
+
+                try:
+                    if packet.startswith('_e'):
+                        event_count += 1
+                        event = self.parse_event_packet(packet)
+                        self.event(**event)
+                    elif packet.startswith('_sc'):
+                        service_check_count += 1
+                        service_check = self.parse_sc_packet(packet)
+                        self.service_check(**service_check)
+                    else:
+                        count += 1
+                        shedding_ratio = 1
+                        if load_shedder is not None and load_shedder.ratio > 1:
+                            shedding_ratio = self._shedding_ratio(packet)
+                            if not shedding_ratio:
+                                continue
+                        if self.context_cache_size and self._submit_cached_metric_packet(packet, shedding_ratio):
+                            continue
+                        parsed_packets = self.parse_metric_packet(packet)
+                        for name, value, mtype, tags, sample_rate in parsed_packets:
+                            hostname, device_name, tags = self._extract_magic_tags(tags)
+                            if shedding_ratio > 1:
+                                sample_rate = sample_rate / float(shedding_ratio)
+                            self.submit_metric(name, value, mtype, tags=tags, hostname=hostname,
+                                device_name=device_name, sample_rate=sample_rate)
+                except UnparseablePacket, e:
+                    # Counted here, and logged once per flush
+                    malformed_count += 1
+                    if not skip_malformed:
+                        raise
+                    log.debug("Skipping malformed packet: %s", e)
+                except Exception:
+                    if not skip_malformed:
+                        raise
+                    log.exception("Skipping malformed packet")
+        finally:
+            # The counts are reset by flushes, maybe from another thread
+            with self._lock:
+                self.count += count
+                self.event_count += event_count
+                self.service_check_count += service_check_count
+                self.num_malformed_packets += malformed_count
+                if load_shedder is not None:
+                    load_shedder.account(start, time(), count)
+
+    def _shedding_ratio(self, packet):
+        """
+        The ratio to divide the sample rate of a metric packet by, 0 if it's
+        shed. Packets are keyed on their context like in the context cache,
+        i.e. without their value.
+        """
+        name_end = packet.find(':')
+        value_end = packet.find('|', name_end)
+        if name_end == -1 or value_end == -1:
+            # Malformed, let the parser raise
+            return 1
+        type_end = packet.find('|', value_end + 1)
+        mtype = packet[value_end + 1:type_end] if type_end != -1 else packet[value_end + 1:]
+        if mtype not in SHEDDABLE_METRIC_TYPES:
+            return 1
+        # Multi-value packets aren't shed
+        next_colon = packet.find(':', name_end + 1)
+        if next_colon != -1 and packet.find('|', next_colon) != -1:
+            return 1
+        if not self.load_shedder.keep(packet[:name_end] + packet[value_end:]):
+            return 0
+        return self.load_shedder.ratio
 
-            if packet.startswith('_e'):
-                self.event_count += 1
-                event = self.parse_event_packet(packet)
-                self.event(**event)
-            elif packet.startswith('_sc'):
-                self.service_check_count += 1
-                service_check = self.parse_sc_packet(packet)
-                self.service_check(**service_check)
-            else:
-                self.count += 1
-                parsed_packets = self.parse_metric_packet(packet)
-                for name, value, mtype, tags, sample_rate in parsed_packets:
-                    hostname, device_name, tags = self._extract_magic_tags(tags)
-                    self.submit_metric(name, value, mtype, tags=tags, hostname=hostname,
-                        device_name=device_name, sample_rate=sample_rate)
 
+    def _submit_cached_metric_packet(self, packet, shedding_ratio=1):
+        """
+        Submit a single-value metric packet, resolving its context through the
+        context cache. Returns False, without submitting anything, for the
+        multi-value packets that the cache doesn't handle. Its sample rate is
+        divided by `shedding_ratio`, see LoadShedder.
+
+        The cache key is the packet without its value: `<name>|<metadata>`.
+        Hits only have to parse the value, the type, sample rate, tags,
+        hostname and device_name come from the cache.
+
+        The cache is a two-generation approximation of an LRU: entries are
+        added to the current generation and when it's full, it replaces the
+        previous one. A hit in the previous generation promotes the entry.
+        """
+        name_end = packet.find(':')
+        if name_end == -1:
+            return False
+        value_end = packet.find('|', name_end)
+        if value_end == -1:
+            return False
+        # A '|' after another ':' means several values in the packet,
+        # e.g. `name:1|c:2|c`. Leave these to the regular parser.
+        next_colon = packet.find(':', name_end + 1)
+        if next_colon != -1 and packet.find('|', next_colon) != -1:
+            return False
+
+        key = packet[:name_end] + packet[value_end:]
+        entry = self._context_cache.get(key)
+        if entry is None:
+            entry = self._context_cache_old.get(key)
+            if entry is None:
+                # Miss: parse the whole packet and cache its resolved context
+                name, value, mtype, tags, sample_rate = self.parse_metric_packet(packet)[0]
+                hostname, device_name, tags = self._extract_magic_tags(tags)
+                # Same context as the one built in submit_metric
+                hostname = hostname if hostname is not None else self.hostname
+                context = self._context(name, tags, hostname, device_name)
+                self._cache_context(key, (context, tags, mtype, sample_rate))
+                if shedding_ratio > 1:
+                    sample_rate = sample_rate / float(shedding_ratio)
+                self._sample_context(context, tags, value, mtype, sample_rate=sample_rate)
+                return True
+            self._cache_context(key, entry)
+
+        context, tags, mtype, sample_rate = entry
+        raw_value = packet[name_end + 1:value_end]
+        if mtype in self.ALLOW_STRINGS:
+            value = raw_value
+        else:
+            # Same casting as in parse_metric_packet
+            try:
+                value = int(raw_value)
+            except ValueError:
+                try:
+                    value = float(raw_value)
+                except ValueError:
+                    raise UnparseablePacket('Metric value must be a number: %s, %s' % (context[0], raw_value))
+        if shedding_ratio > 1:
+            sample_rate = sample_rate / float(shedding_ratio)
+        self._sample_context(context, tags, value, mtype, sample_rate=sample_rate)
+        return True
+
+    def _cache_context(self, key, entry):
+        if len(self._context_cache) * 2 >= self.context_cache_size:
+            self._context_cache_old = self._context_cache
+            self._context_cache = {}
+        self._context_cache[key] = entry
 
     def _extract_magic_tags(self, tags):
         """Magic tags (host, device) override metric hostname and device_name attributes"""
@@ -635,6 +1567,30 @@ class Aggregator(object):
         """ Add a metric to be aggregated """
         raise NotImplementedError()
 
+    def _context(self, name, tags, hostname, device_name):
+        """ The context of a metric: `(name, sorted deduplicated tags, hostname, device_name)` """
+        interned = self.interned
+        # Avoid calling extra functions to dedupe tags if there are none
+        if tags is None:
+            tags = tuple()
+        else:
+            tags = interned.tags(tuple(sorted(set(tags))))
+        if interned.size:
+            name = interned.string(name)
+            # The default hostname is already shared by all the contexts
+            if hostname is not self.hostname:
+                hostname = interned.string(hostname)
+            if device_name is not None:
+                device_name = interned.string(device_name)
+        return (name, tags, hostname, device_name)
+
+    def _sample_context(self, context, tags, value, mtype, timestamp=None, sample_rate=1):
+        """
+        Add a point to the metric of a resolved context, i.e.
+        `(name, sorted deduplicated tags, hostname, device_name)`
+        """
+        raise NotImplementedError()
+
     def event(self, title, text, date_happened=None, alert_type=None, aggregation_key=None, source_type_name=None, priority=None, tags=None, hostname=None):
         event = {
             'msg_title': title,
@@ -659,7 +1615,8 @@ class Aggregator(object):
         else:
             event['host'] = self.hostname
 
-        self.events.append(event)
+        with self._lock:
+            self.events.append(event)
 
     def service_check(self, check_name, status, tags=None, timestamp=None,
                       hostname=None, message=None):
@@ -678,46 +1635,80 @@ class Aggregator(object):
         if message is not None:
             service_check['message'] = message
 
-        self.service_checks.append(service_check)
+        with self._lock:
+            self.service_checks.append(service_check)
 
     def flush(self):
         """ Flush aggregated metrics """
         raise NotImplementedError()
 
     def flush_events(self):
-        events = self.events
-        self.events = []
+        with self._lock:
+            events = self.events
+            self.events = []
 
-        self.total_count += self.event_count
-        self.event_count = 0
+            self.total_count += self.event_count
+            self.event_count = 0
 
         log.debug("Received %d events since last flush" % len(events))
+        if self.coalesce_events:
+            events = coalesce_events(events)
 
         return events
 
     def flush_service_checks(self):
-        service_checks = self.service_checks
-        self.service_checks = []
+        with self._lock:
+            service_checks = self.service_checks
+            self.service_checks = []
 
-        self.total_count += self.service_check_count
-        self.service_check_count = 0
+            self.total_count += self.service_check_count
+            self.service_check_count = 0
 
         log.debug("Received {0} service check runs since last flush".format(len(service_checks)))
+        if self.coalesce_service_checks:
+            service_checks = coalesce_service_checks(service_checks)
 
         return service_checks
 
     def send_packet_count(self, metric_name):
         self.submit_metric(metric_name, self.count, 'g')
 
+    def pop_context_limiter_stats(self):
+        """ The stats of the context limiter since the last call, None if there's no limit """
+        if self.context_limiter is None:
+            return None
+        with self._lock:
+            return self.context_limiter.pop_stats()
+
+    def pop_load_shedder_stats(self):
+        """ The stats of the load shedder since the last call, None if there's no CPU budget """
+        if self.load_shedder is None:
+            return None
+        with self._lock:
+            return self.load_shedder.pop_stats()
+
 class MetricsBucketAggregator(Aggregator):
     """
     A metric aggregator class.
+
+    Dogstatsd submits metrics from its server thread while the reporter
+    thread flushes them. `_lock` also serializes the sampling of a metric
+    with the detaching of the closed buckets: `flush` and `dump` only hold
+    it to pop these buckets, and format and expire them once released.
+
+    With a `flush_delay`, the buckets are only flushed once they've been
+    closed for that many seconds, for the buckets of the same interval
+    shipped by the dogstatsd workers to be merged first.
     """
 
     def __init__(self, hostname, interval=1.0, expiry_seconds=300,
             formatter=None, recent_point_threshold=None,
             histogram_aggregates=None, histogram_percentiles=None,
-            utf8_decoding=False):
+            utf8_decoding=False, context_cache_size=0,
+            histogram_sketch_prefixes=None, histogram_sketch_accuracy=None,
+            set_hyperloglog_threshold=None, set_hyperloglog_precision=None,
+            intern_table_size=0, max_contexts=0, max_contexts_per_metric=0, context_overflow=True,
+            cpu_budget=0, coalesce_service_checks=False, coalesce_events=False, flush_delay=0):
         super(MetricsBucketAggregator, self).__init__(
             hostname,
             interval,
@@ -726,13 +1717,27 @@ class MetricsBucketAggregator(Aggregator):
             recent_point_threshold,
             histogram_aggregates,
             histogram_percentiles,
-            utf8_decoding
+            utf8_decoding,
+            context_cache_size,
+            histogram_sketch_prefixes,
+            histogram_sketch_accuracy,
+            set_hyperloglog_threshold,
+            set_hyperloglog_precision,
+            intern_table_size,
+            max_contexts,
+            max_contexts_per_metric,
+            context_overflow,
+            cpu_budget,
+            coalesce_service_checks,
+            coalesce_events
         )
         self.metric_by_bucket = {}
-        self.last_sample_time_by_context = {}
+        # Counters keep reporting 0 in the buckets they're not sampled in, until they expire
+        self.counter_expiry = ContextExpiryIndex()
         self.current_bucket = None
-        self.current_mbc = {}
+        self.current_mbc = None
         self.last_flush_cutoff_time = 0
+        self.flush_delay = flush_delay
         self.metric_type_to_class = {
             'g': BucketGauge,
             'c': Counter,
@@ -740,24 +1745,28 @@ class MetricsBucketAggregator(Aggregator):
             'ms': Histogram,
             's': Set,
         }
+        # Stored in the columns of the buckets rather than as Metric objects
+        self.metric_class_to_kind = {
+            BucketGauge: GAUGE_KIND,
+            Counter: COUNTER_KIND,
+        }
 
     def calculate_bucket_start(self, timestamp):
         return timestamp - (timestamp % self.interval)
 
     def submit_metric(self, name, value, mtype, tags=None, hostname=None,
                       device_name=None, timestamp=None, sample_rate=1):
-        # Avoid calling extra functions to dedupe tags if there are none
         # Note: if you change the way that context is created, please also change create_empty_metrics,
         #  which counts on this order
 
         # Keep hostname with empty string to unset it
         hostname = hostname if hostname is not None else self.hostname
 
-        if tags is None:
-            context = (name, tuple(), hostname, device_name)
-        else:
-            context = (name, tuple(sorted(set(tags))), hostname, device_name)
+        context = self._context(name, tags, hostname, device_name)
+        self._sample_context(context, tags, value, mtype, timestamp, sample_rate)
 
+    def _sample_context(self, context, tags, value, mtype, timestamp=None, sample_rate=1):
+        name, _, hostname, device_name = context
         cur_time = time()
         # Check to make sure that the timestamp that is passed in (if any) is not older than
         #  recent_point_threshold.  If so, discard the point.
@@ -768,83 +1777,238 @@ class MetricsBucketAggregator(Aggregator):
             timestamp = timestamp or cur_time
             # Keep track of the buckets using the timestamp at the start time of the bucket
             bucket_start_timestamp = self.calculate_bucket_start(timestamp)
-            if bucket_start_timestamp == self.current_bucket:
-                metric_by_context = self.current_mbc
-            else:
-                if bucket_start_timestamp not in self.metric_by_bucket:
-                    self.metric_by_bucket[bucket_start_timestamp] = {}
-                metric_by_context = self.metric_by_bucket[bucket_start_timestamp]
-                self.current_bucket = bucket_start_timestamp
-                self.current_mbc = metric_by_context
-
-            if context not in metric_by_context:
-                metric_class = self.metric_type_to_class[mtype]
-                metric_by_context[context] = metric_class(self.formatter, name, tags,
-                    hostname, device_name, self.metric_config.get(metric_class))
+            with self._lock:
+                if self.context_limiter is not None:
+                    limited_context = self.context_limiter.admit(context)
+                    if limited_context is not context:
+                        if limited_context is None:
+                            return
+                        context = limited_context
+                        tags = OVERFLOW_TAGS
+
+                if bucket_start_timestamp == self.current_bucket:
+                    bucket = self.current_mbc
+                else:
+                    bucket = self.metric_by_bucket.get(bucket_start_timestamp)
+                    if bucket is None:
+                        bucket = self.metric_by_bucket[bucket_start_timestamp] = MetricBucket()
+                    self.current_bucket = bucket_start_timestamp
+                    self.current_mbc = bucket
+
+                slot = bucket.slot_by_context.get(context)
+                if slot is not None:
+                    bucket.sample_slot(slot, value, sample_rate)
+                    return
+
+                metric = bucket.metric_by_context.get(context)
+                if metric is None:
+                    metric_class = self._metric_class(name, mtype)
+                    kind = self.metric_class_to_kind.get(metric_class)
+                    if kind is not None:
+                        bucket.sample_slot(bucket.add_slot(context, kind), value, sample_rate)
+                        return
+                    metric = bucket.metric_by_context[context] = metric_class(self.formatter, name, tags,
+                        hostname, device_name, self.metric_config.get(metric_class))
+
+                metric.sample(value, sample_rate, timestamp)
+
+    def _detach_closed_buckets(self, flush_cutoff_time):
+        """
+        Pop the buckets started before `flush_cutoff_time`. Their metrics
+        won't be sampled anymore, so they can be flushed without the lock.
+        Returns them, with the number of packets received since the last call.
+        """
+        with self._lock:
+            closed_buckets = {}
+            for bucket_start_timestamp in self.metric_by_bucket.keys():
+                if bucket_start_timestamp < flush_cutoff_time:
+                    closed_buckets[bucket_start_timestamp] = self.metric_by_bucket.pop(bucket_start_timestamp)
+            if self.current_bucket in closed_buckets:
+                self.current_bucket = None
+                self.current_mbc = None
+            count = self.count
+            self.count = 0
+            if self.context_limiter is not None:
+                self.context_limiter.rotate()
+        return closed_buckets, count
+
+    def dump(self):
+        """
+        Detach the closed buckets, the events and the service checks, and return
+        them as a picklable payload that another aggregator can `merge`.
+        Used by dogstatsd workers to ship their aggregates to the reporting process.
+        """
+        closed_buckets, count = self._detach_closed_buckets(self.calculate_bucket_start(time()))
+        buckets = {}
+        for bucket_start_timestamp, bucket in closed_buckets.iteritems():
+            buckets[bucket_start_timestamp] = bucket.dump()
+
+        with self._lock:
+            payload = {
+                'buckets': buckets,
+                'events': self.events,
+                'service_checks': self.service_checks,
+                'count': count,
+                'event_count': self.event_count,
+                'service_check_count': self.service_check_count,
+                'num_discarded_old_points': self.num_discarded_old_points,
+                'num_malformed_packets': self.num_malformed_packets,
+            }
+            self.events = []
+            self.service_checks = []
+            self.total_count += count + self.event_count + self.service_check_count
+            self.event_count = 0
+            self.service_check_count = 0
+            self.num_discarded_old_points = 0
+            self.num_malformed_packets = 0
+        return payload
 
-            metric_by_context[context].sample(value, sample_rate, timestamp)
+    def merge(self, payload):
+        """
+        Merge a payload returned by `dump` into this aggregator. Counters and
+        histogram samples add up, sets are unioned and gauges keep the latest write.
 
-    def create_empty_metrics(self, sample_time_by_context, expiry_timestamp, flush_timestamp, metrics):
+        A bucket already flushed here is merged into the oldest one that isn't,
+        rather than being flushed as a second point of the same timestamp.
+        """
+        with self._lock:
+            late = 0
+            for bucket_start_timestamp, dumped_by_context in payload['buckets'].iteritems():
+                if bucket_start_timestamp < self.last_flush_cutoff_time:
+                    late += 1
+                    bucket_start_timestamp = self.last_flush_cutoff_time
+                bucket = self.metric_by_bucket.get(bucket_start_timestamp)
+                if bucket is None:
+                    bucket = self.metric_by_bucket[bucket_start_timestamp] = MetricBucket()
+                for context, (metric_class, state) in dumped_by_context.iteritems():
+                    kind = self.metric_class_to_kind.get(metric_class)
+                    if kind is not None:
+                        # Counter and gauge states both start with the value and the last sample time
+                        value, last_sample_time = state[:2]
+                        if value is None:
+                            continue
+                        slot = bucket.slot_by_context.get(context)
+                        if slot is None:
+                            bucket.add_slot(context, kind, value, last_sample_time)
+                        else:
+                            bucket.merge_slot(slot, value, last_sample_time)
+                        continue
+
+                    metric = bucket.metric_by_context.get(context)
+                    if metric is None:
+                        # This counts on the ordering of the context created in submit_metric not changing
+                        metric = metric_class(self.formatter, context[0], context[1] or None,
+                            context[2], context[3], self.metric_config.get(metric_class))
+                        bucket.metric_by_context[context] = metric
+                    metric.merge(state)
+
+            self.events.extend(payload['events'])
+            self.service_checks.extend(payload['service_checks'])
+            self.count += payload['count']
+            self.event_count += payload['event_count']
+            self.service_check_count += payload['service_check_count']
+            self.num_discarded_old_points += payload['num_discarded_old_points']
+            self.num_malformed_packets += payload['num_malformed_packets']
+        if late:
+            log.warning("%s worker bucket(s) arrived after being flushed, merged into the next bucket", late)
+
+    def create_empty_metrics(self, bucket, flush_timestamp, metrics):
         # Even if no data is submitted, Counters keep reporting "0" for expiry_seconds.  The other Metrics
         #  (Set, Gauge, Histogram) do not report if no data is submitted
-        for context, last_sample_time in sample_time_by_context.items():
-            if last_sample_time < expiry_timestamp:
-                log.debug("%s hasn't been submitted in %ss. Expiring." % (context, self.expiry_seconds))
-                self.last_sample_time_by_context.pop(context, None)
-            else:
+        for context in self.counter_expiry:
+            if bucket is None or not bucket.is_counter(context):
                 # The expiration currently only applies to Counters
                 # This counts on the ordering of the context created in submit_metric not changing
                 metric = Counter(self.formatter, context[0], context[1], context[2], context[3])
                 metrics += metric.flush(flush_timestamp, self.interval)
 
+    def flush_columns(self, bucket, bucket_start_timestamp, expiry_timestamp, metrics):
+        """ Flush the gauges and counters stored in the columns of a closed bucket """
+        formatter = self.formatter
+        interval = self.interval
+        counter_expiry = self.counter_expiry
+        for context, kind, value, last_sample_time in izip(bucket.contexts, bucket.kinds, bucket.values,
+                                                          bucket.last_sample_times):
+            if last_sample_time < expiry_timestamp:
+                # This should never happen
+                log.warning("%s hasn't been submitted in %ss. Expiring." % (context, self.expiry_seconds))
+                counter_expiry.discard(context)
+                continue
+
+            # This counts on the ordering of the context created in submit_metric not changing
+            if kind == COUNTER_KIND:
+                metrics.append(formatter(
+                    metric=context[0],
+                    value=value / interval,
+                    timestamp=bucket_start_timestamp,
+                    tags=context[1] or None,
+                    hostname=context[2],
+                    device_name=context[3],
+                    metric_type=MetricTypes.RATE,
+                    interval=interval,
+                ))
+                counter_expiry.touch(context, last_sample_time)
+            else:
+                metrics.append(formatter(
+                    metric=context[0],
+                    timestamp=bucket_start_timestamp,
+                    value=value,
+                    tags=context[1] or None,
+                    hostname=context[2],
+                    device_name=context[3],
+                    metric_type=MetricTypes.GAUGE,
+                    interval=interval,
+                ))
+
     def flush(self):
         cur_time = time()
-        flush_cutoff_time = self.calculate_bucket_start(cur_time)
+        flush_cutoff_time = self.calculate_bucket_start(cur_time - self.flush_delay)
         expiry_timestamp = cur_time - self.expiry_seconds
 
         metrics = []
 
-        if self.metric_by_bucket:
+        # Only the detached buckets are used from here on, the server thread
+        #  keeps sampling into the open ones.
+        closed_buckets, count = self._detach_closed_buckets(flush_cutoff_time)
+
+        for context in self.counter_expiry.expire(expiry_timestamp):
+            log.debug("%s hasn't been submitted in %ss. Expiring." % (context, self.expiry_seconds))
+
+        if closed_buckets or self.metric_by_bucket:
             # We want to process these in order so that we can check for and expired metrics and
-            #  re-create non-expired metrics.  We also mutate self.metric_by_bucket.
-            for bucket_start_timestamp in sorted(self.metric_by_bucket.keys()):
-                metric_by_context = self.metric_by_bucket[bucket_start_timestamp]
-                if bucket_start_timestamp < flush_cutoff_time:
-                    not_sampled_in_this_bucket = self.last_sample_time_by_context.copy()
-                    # We mutate this dictionary while iterating so don't use an iterator.
-                    for context, metric in metric_by_context.items():
-                        if metric.last_sample_time < expiry_timestamp:
-                            # This should never happen
-                            log.warning("%s hasn't been submitted in %ss. Expiring." % (context, self.expiry_seconds))
-                            not_sampled_in_this_bucket.pop(context, None)
-                            self.last_sample_time_by_context.pop(context, None)
-                        else:
-                            metrics += metric.flush(bucket_start_timestamp, self.interval)
-                            if isinstance(metric, Counter):
-                                self.last_sample_time_by_context[context] = metric.last_sample_time
-                                not_sampled_in_this_bucket.pop(context, None)
-                    # We need to account for Metrics that have not expired and were not flushed for this bucket
-                    self.create_empty_metrics(not_sampled_in_this_bucket, expiry_timestamp, bucket_start_timestamp, metrics)
-
-                    del self.metric_by_bucket[bucket_start_timestamp]
+            #  re-create non-expired metrics.
+            for bucket_start_timestamp in sorted(closed_buckets.keys()):
+                bucket = closed_buckets[bucket_start_timestamp]
+                for context, metric in bucket.metric_by_context.iteritems():
+                    if metric.last_sample_time < expiry_timestamp:
+                        # This should never happen
+                        log.warning("%s hasn't been submitted in %ss. Expiring." % (context, self.expiry_seconds))
+                        self.counter_expiry.discard(context)
+                    else:
+                        metrics += metric.flush(bucket_start_timestamp, self.interval)
+                        if isinstance(metric, Counter):
+                            self.counter_expiry.touch(context, metric.last_sample_time)
+                self.flush_columns(bucket, bucket_start_timestamp, expiry_timestamp, metrics)
+                # We need to account for Metrics that have not expired and were not flushed for this bucket
+                self.create_empty_metrics(bucket, bucket_start_timestamp, metrics)
         else:
             # Even if there are no metrics in this flush, there may be some non-expired counters
             #  We should only create these non-expired metrics if we've passed an interval since the last flush
             if flush_cutoff_time >= self.last_flush_cutoff_time + self.interval:
-                self.create_empty_metrics(self.last_sample_time_by_context.copy(), expiry_timestamp,
-                                          flush_cutoff_time-self.interval, metrics)
+                self.create_empty_metrics(None, flush_cutoff_time-self.interval, metrics)
 
         # Log a warning regarding metrics with old timestamps being submitted
         if self.num_discarded_old_points > 0:
             log.warn('%s points were discarded as a result of having an old timestamp' % self.num_discarded_old_points)
             self.num_discarded_old_points = 0
 
+        if self.num_malformed_packets > 0:
+            log.warn('%s malformed packets were discarded' % self.num_malformed_packets)
+            self.num_malformed_packets = 0
+
         # Save some stats.
-        log.debug("received %s payloads since last flush" % self.count)
-        self.total_count += self.count
-        self.count = 0
-        self.current_bucket = None
-        self.current_mbc = {}
+        log.debug("received %s payloads since last flush" % count)
+        self.total_count += count
         self.last_flush_cutoff_time = flush_cutoff_time
         return metrics
 
@@ -857,7 +2021,11 @@ class MetricsAggregator(Aggregator):
     def __init__(self, hostname, interval=1.0, expiry_seconds=300,
             formatter=None, recent_point_threshold=None,
             histogram_aggregates=None, histogram_percentiles=None,
-            utf8_decoding=False):
+            utf8_decoding=False, context_cache_size=0,
+            histogram_sketch_prefixes=None, histogram_sketch_accuracy=None,
+            set_hyperloglog_threshold=None, set_hyperloglog_precision=None,
+            intern_table_size=0, max_contexts=0, max_contexts_per_metric=0, context_overflow=True,
+            cpu_budget=0, coalesce_service_checks=False, coalesce_events=False):
         super(MetricsAggregator, self).__init__(
             hostname,
             interval,
@@ -866,9 +2034,26 @@ class MetricsAggregator(Aggregator):
             recent_point_threshold,
             histogram_aggregates,
             histogram_percentiles,
-            utf8_decoding
+            utf8_decoding,
+            context_cache_size,
+            histogram_sketch_prefixes,
+            histogram_sketch_accuracy,
+            set_hyperloglog_threshold,
+            set_hyperloglog_precision,
+            intern_table_size,
+            max_contexts,
+            max_contexts_per_metric,
+            context_overflow,
+            cpu_budget,
+            coalesce_service_checks,
+            coalesce_events
         )
         self.metrics = {}
+        # Flushing a metric that wasn't sampled since the last flush is a
+        # no-op, except for Counters which report 0 until they expire.
+        self.metric_expiry = ContextExpiryIndex()
+        self.sampled_contexts = set()
+        self.counter_contexts = set()
         self.metric_type_to_class = {
             'g': Gauge,
             'ct': Count,
@@ -882,25 +2067,38 @@ class MetricsAggregator(Aggregator):
 
     def submit_metric(self, name, value, mtype, tags=None, hostname=None,
                       device_name=None, timestamp=None, sample_rate=1):
-        # Avoid calling extra functions to dedupe tags if there are none
-
         # Keep hostname with empty string to unset it
         hostname = hostname if hostname is not None else self.hostname
 
-        if tags is None:
-            context = (name, tuple(), hostname, device_name)
-        else:
-            context = (name, tuple(sorted(set(tags))), hostname, device_name)
-        if context not in self.metrics:
-            metric_class = self.metric_type_to_class[mtype]
-            self.metrics[context] = metric_class(self.formatter, name, tags,
-                hostname, device_name, self.metric_config.get(metric_class))
+        context = self._context(name, tags, hostname, device_name)
+        self._sample_context(context, tags, value, mtype, timestamp, sample_rate)
+
+    def _sample_context(self, context, tags, value, mtype, timestamp=None, sample_rate=1):
+        name, _, hostname, device_name = context
         cur_time = time()
         if timestamp is not None and cur_time - int(timestamp) > self.recent_point_threshold:
             log.debug("Discarding %s - ts = %s , current ts = %s " % (name, timestamp, cur_time))
             self.num_discarded_old_points += 1
-        else:
-            self.metrics[context].sample(value, sample_rate, timestamp)
+            return
+
+        if self.context_limiter is not None:
+            limited_context = self.context_limiter.admit(context)
+            if limited_context is not context:
+                if limited_context is None:
+                    return
+                context = limited_context
+                tags = OVERFLOW_TAGS
+
+        metric = self.metrics.get(context)
+        if metric is None:
+            metric_class = self._metric_class(name, mtype)
+            metric = self.metrics[context] = metric_class(self.formatter, name, tags,
+                hostname, device_name, self.metric_config.get(metric_class))
+            if isinstance(metric, Counter):
+                self.counter_contexts.add(context)
+        metric.sample(value, sample_rate, timestamp)
+        self.metric_expiry.touch(context, metric.last_sample_time)
+        self.sampled_contexts.add(context)
 
     def gauge(self, name, value, tags=None, hostname=None, device_name=None, timestamp=None):
         self.submit_metric(name, value, 'g', tags, hostname, device_name, timestamp)
@@ -932,21 +2130,35 @@ class MetricsAggregator(Aggregator):
         timestamp = time()
         expiry_timestamp = timestamp - self.expiry_seconds
 
-        # Flush points and remove expired metrics. We mutate this dictionary
-        # while iterating so don't use an iterator.
+        # Remove expired metrics, then flush the ones sampled since the last
+        # flush and the counters.
+        for context in self.metric_expiry.expire(expiry_timestamp):
+            log.debug("%s hasn't been submitted in %ss. Expiring." % (context, self.expiry_seconds))
+            del self.metrics[context]
+            self.counter_contexts.discard(context)
+
+        if self.context_limiter is not None:
+            self.context_limiter.rotate()
+
         metrics = []
-        for context, metric in self.metrics.items():
-            if metric.last_sample_time < expiry_timestamp:
-                log.debug("%s hasn't been submitted in %ss. Expiring." % (context, self.expiry_seconds))
-                del self.metrics[context]
-            else:
+        sampled_contexts = self.sampled_contexts
+        self.sampled_contexts = set()
+        for context in sampled_contexts:
+            metric = self.metrics.get(context)
+            if metric is not None and context not in self.counter_contexts:
                 metrics += metric.flush(timestamp, self.interval)
+        for context in self.counter_contexts:
+            metrics += self.metrics[context].flush(timestamp, self.interval)
 
         # Log a warning regarding metrics with old timestamps being submitted
         if self.num_discarded_old_points > 0:
             log.warn('%s points were discarded as a result of having an old timestamp' % self.num_discarded_old_points)
             self.num_discarded_old_points = 0
 
+        if self.num_malformed_packets > 0:
+            log.warn('%s malformed packets were discarded' % self.num_malformed_packets)
+            self.num_malformed_packets = 0
+
         # Save some stats.
         log.debug("received %s payloads since last flush" % self.count)
         self.total_count += self.count
@@ -957,15 +2169,25 @@ def get_formatter(config):
     formatter = api_formatter
 
     if config['statsd_metric_namespace']:
+        metric_prefix = config['statsd_metric_namespace']
+        if metric_prefix[-1] != '.':
+            metric_prefix += '.'
+        # The prefixed names, shared by the metrics flushed with the same name
+        prefixed_names = {}
+        prefixed_names_size = config.get('dogstatsd_intern_table_size') or 0
+
         def metric_namespace_formatter_wrapper(metric, value, timestamp, tags,
                                                hostname=None, device_name=None,
                                                metric_type=None, interval=None):
-
-            metric_prefix = config['statsd_metric_namespace']
-            if metric_prefix[-1] != '.':
-                metric_prefix += '.'
-
-            return api_formatter(metric_prefix + metric, value, timestamp, tags, hostname,
+            prefixed_name = prefixed_names.get(metric)
+            if prefixed_name is None:
+                prefixed_name = metric_prefix + metric
+                if prefixed_names_size:
+                    if len(prefixed_names) >= prefixed_names_size:
+                        prefixed_names.clear()
+                    prefixed_names[metric] = prefixed_name
+
+            return api_formatter(prefixed_name, value, timestamp, tags, hostname,
                                  device_name, metric_type, interval)
 
         formatter = metric_namespace_formatter_wrapper
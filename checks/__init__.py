@@ -329,7 +329,11 @@ class AgentCheck(object):
             formatter=agent_formatter,
             recent_point_threshold=agentConfig.get('recent_point_threshold', None),
             histogram_aggregates=agentConfig.get('histogram_aggregates'),
-            histogram_percentiles=agentConfig.get('histogram_percentiles')
+            histogram_percentiles=agentConfig.get('histogram_percentiles'),
+            histogram_sketch_prefixes=agentConfig.get('histogram_sketch_prefixes'),
+            histogram_sketch_accuracy=agentConfig.get('histogram_sketch_accuracy'),
+            set_hyperloglog_threshold=agentConfig.get('set_hyperloglog_threshold'),
+            set_hyperloglog_precision=agentConfig.get('set_hyperloglog_precision')
         )
 
         self.events = []
@@ -716,7 +716,8 @@ class DogstatsdStatus(AgentStatus):
     NAME = 'Dogstatsd'
 
     def __init__(self, flush_count=0, packet_count=0, packets_per_second=0,
-            metric_count=0, event_count=0, service_check_count=0):
+            metric_count=0, event_count=0, service_check_count=0, context_limiter_stats=None,
+            latency_stats=None, spool_stats=None):
         AgentStatus.__init__(self)
         self.flush_count = flush_count
         self.packet_count = packet_count
@@ -724,6 +725,9 @@ class DogstatsdStatus(AgentStatus):
         self.metric_count = metric_count
         self.event_count = event_count
         self.service_check_count = service_check_count
+        self.context_limiter_stats = context_limiter_stats
+        self.latency_stats = latency_stats
+        self.spool_stats = spool_stats
 
     def has_error(self):
         return self.flush_count == 0 and self.packet_count == 0 and self.metric_count == 0
@@ -737,6 +741,22 @@ class DogstatsdStatus(AgentStatus):
             "Event count: %s" % self.event_count,
             "Service check count: %s" % self.service_check_count,
         ]
+        if self.context_limiter_stats is not None:
+            lines.append("Context count: %s" % self.context_limiter_stats['contexts'])
+            lines.append("Samples over the context limits: %s" % self.context_limiter_stats['rejected'])
+            for name, count in self.context_limiter_stats['top_rejected']:
+                lines.append("  %s: %s" % (name, count))
+        if self.latency_stats:
+            lines.append("Latency of the last flush:")
+            for endpoint, stats in sorted(self.latency_stats.iteritems()):
+                lines.append("  %s: %s request%s, %sms avg, %sms max" % (
+                    endpoint, stats['count'], plural(stats['count']), stats['avg'], stats['max']))
+        if self.spool_stats is not None:
+            lines.append("Spooled payloads: %s (%s bytes in %s segment%s)" % (
+                self.spool_stats['records'], self.spool_stats['size'],
+                self.spool_stats['segments'], plural(self.spool_stats['segments'])))
+            lines.append("Spool replay: %s spooled, %s replayed, %s evicted since startup" % (
+                self.spool_stats['spooled'], self.spool_stats['replayed'], self.spool_stats['evicted']))
         return lines
 
     def to_dict(self):
@@ -748,6 +768,9 @@ class DogstatsdStatus(AgentStatus):
             'metric_count': self.metric_count,
             'event_count': self.event_count,
             'service_check_count': self.service_check_count,
+            'context_limiter_stats': self.context_limiter_stats,
+            'latency_stats': self.latency_stats,
+            'spool_stats': self.spool_stats,
         })
         return status_info
 
@@ -757,13 +780,23 @@ class ForwarderStatus(AgentStatus):
     NAME = 'Forwarder'
 
     def __init__(self, queue_length=0, queue_size=0, flush_count=0, transactions_received=0,
-            transactions_flushed=0):
+            transactions_flushed=0, in_flight=0, window=0, drain_rate=0, size_by_priority=None,
+            evicted=None, spool_stats=None, batch_sizes=None):
         AgentStatus.__init__(self)
         self.queue_length = queue_length
         self.queue_size = queue_size
         self.flush_count = flush_count
         self.transactions_received = transactions_received
         self.transactions_flushed = transactions_flushed
+        self.in_flight = in_flight
+        self.window = window
+        self.drain_rate = drain_rate
+        # Bytes queued and transactions evicted, by priority
+        self.size_by_priority = size_by_priority or {}
+        self.evicted = evicted or {}
+        self.spool_stats = spool_stats
+        # [transactions per batch, number of batches] of the coalesced transactions
+        self.batch_sizes = batch_sizes
         self.proxy_data = get_config(parse_args=False).get('proxy_settings')
         self.hidden_username = None
         self.hidden_password = None
@@ -780,8 +813,27 @@ class ForwarderStatus(AgentStatus):
             "Flush Count: %s" % self.flush_count,
             "Transactions received: %s" % self.transactions_received,
             "Transactions flushed: %s" % self.transactions_flushed,
-            ""
+            "Transactions in flight: %s (window of %s)" % (self.in_flight, self.window),
+            "Drain rate: %.1f transactions/s" % self.drain_rate,
         ]
+        priorities = ('low', 'normal', 'high')
+        if self.size_by_priority:
+            lines.append("Queue Size by priority: %s" % ', '.join(
+                "%s %s bytes" % (p, self.size_by_priority.get(p, 0)) for p in priorities))
+        if self.evicted:
+            lines.append("Transactions evicted: %s (%s)" % (sum(self.evicted.values()), ', '.join(
+                "%s %s" % (p, self.evicted.get(p, 0)) for p in priorities)))
+        if self.spool_stats is not None:
+            lines.append("Spooled transactions: %s (%s bytes in %s segment%s)" % (
+                self.spool_stats['records'], self.spool_stats['size'],
+                self.spool_stats['segments'], plural(self.spool_stats['segments'])))
+            lines.append("Spool replay: %s spooled, %s replayed, %s evicted since startup" % (
+                self.spool_stats['spooled'], self.spool_stats['replayed'], self.spool_stats['evicted']))
+        if self.batch_sizes:
+            lines.append("Batches sent: %s (by transactions per batch: %s)" % (
+                sum(count for _, count in self.batch_sizes),
+                ', '.join("%s: %s" % (size, count) for size, count in self.batch_sizes)))
+        lines.append("")
 
         if self.proxy_data:
             lines += [
@@ -808,6 +860,13 @@ class ForwarderStatus(AgentStatus):
             'flush_count': self.flush_count,
             'queue_length': self.queue_length,
             'queue_size': self.queue_size,
+            'in_flight': self.in_flight,
+            'window': self.window,
+            'drain_rate': self.drain_rate,
+            'size_by_priority': self.size_by_priority,
+            'evicted': self.evicted,
+            'spool_stats': self.spool_stats,
+            'batch_sizes': self.batch_sizes,
             'proxy_data': self.proxy_data,
             'hidden_username': self.hidden_username,
             'hidden_password': self.hidden_password,
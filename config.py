@@ -421,6 +421,28 @@ def get_config(parse_args=True, cfg_path=None, options=None):
         if config.has_option('Main', 'histogram_percentiles'):
             agentConfig['histogram_percentiles'] = get_histogram_percentiles(config.get('Main', 'histogram_percentiles'))
 
+        # Histograms kept in bounded memory sketches: all of them, or the ones
+        # starting with some prefixes
+        agentConfig['histogram_sketch_prefixes'] = None
+        if config.has_option('Main', 'histogram_sketch') and _is_affirmative(config.get('Main', 'histogram_sketch')):
+            agentConfig['histogram_sketch_prefixes'] = ['']
+        elif config.has_option('Main', 'histogram_sketch_prefixes'):
+            prefixes = [p.strip() for p in config.get('Main', 'histogram_sketch_prefixes').split(',')]
+            agentConfig['histogram_sketch_prefixes'] = [p for p in prefixes if p] or None
+
+        agentConfig['histogram_sketch_accuracy'] = None
+        if config.has_option('Main', 'histogram_sketch_accuracy'):
+            agentConfig['histogram_sketch_accuracy'] = float(config.get('Main', 'histogram_sketch_accuracy'))
+
+        # Sets switched to HyperLogLogs past a number of elements
+        agentConfig['set_hyperloglog_threshold'] = None
+        if config.has_option('Main', 'set_hyperloglog_threshold'):
+            agentConfig['set_hyperloglog_threshold'] = int(config.get('Main', 'set_hyperloglog_threshold'))
+
+        agentConfig['set_hyperloglog_precision'] = None
+        if config.has_option('Main', 'set_hyperloglog_precision'):
+            agentConfig['set_hyperloglog_precision'] = int(config.get('Main', 'set_hyperloglog_precision'))
+
         # Disable Watchdog (optionally)
         if config.has_option('Main', 'watchdog'):
             if config.get('Main', 'watchdog').lower() in ('no', 'false'):
@@ -459,6 +481,114 @@ def get_config(parse_args=True, cfg_path=None, options=None):
             if _is_affirmative(config.get('Main', 'dogstatsd_use_ddurl')):
                 agentConfig['dogstatsd_target'] = agentConfig['dd_url']
 
+        # Dogstatsd receive batching: number of datagrams and bytes drained
+        # from the socket per wakeup. A batch size of 1 disables batching.
+        agentConfig['dogstatsd_batch_size'] = 1
+        if config.has_option('Main', 'dogstatsd_batch_size'):
+            agentConfig['dogstatsd_batch_size'] = int(config.get('Main', 'dogstatsd_batch_size'))
+
+        agentConfig['dogstatsd_batch_bytes'] = 1024 * 1024
+        if config.has_option('Main', 'dogstatsd_batch_bytes'):
+            agentConfig['dogstatsd_batch_bytes'] = int(config.get('Main', 'dogstatsd_batch_bytes'))
+
+        # Optional unix domain datagram socket for dogstatsd, and the maximum
+        # size of the datagrams read from it
+        agentConfig['dogstatsd_socket'] = None
+        if config.has_option('Main', 'dogstatsd_socket'):
+            agentConfig['dogstatsd_socket'] = config.get('Main', 'dogstatsd_socket') or None
+
+        agentConfig['dogstatsd_socket_buffer_size'] = 8 * 1024
+        if config.has_option('Main', 'dogstatsd_socket_buffer_size'):
+            agentConfig['dogstatsd_socket_buffer_size'] = int(config.get('Main', 'dogstatsd_socket_buffer_size'))
+
+        # Number of metric contexts cached by the dogstatsd packet parser, 0 to disable
+        agentConfig['dogstatsd_context_cache_size'] = 0
+        if config.has_option('Main', 'dogstatsd_context_cache_size'):
+            agentConfig['dogstatsd_context_cache_size'] = int(config.get('Main', 'dogstatsd_context_cache_size'))
+
+        # Number of tag sets and unicode names interned by dogstatsd, 0 to disable
+        agentConfig['dogstatsd_intern_table_size'] = 100000
+        if config.has_option('Main', 'dogstatsd_intern_table_size'):
+            agentConfig['dogstatsd_intern_table_size'] = int(config.get('Main', 'dogstatsd_intern_table_size'))
+
+        # Limits of the number of contexts sampled by dogstatsd in a flush interval, 0 for no limit
+        agentConfig['dogstatsd_max_contexts'] = 0
+        if config.has_option('Main', 'dogstatsd_max_contexts'):
+            agentConfig['dogstatsd_max_contexts'] = int(config.get('Main', 'dogstatsd_max_contexts'))
+
+        agentConfig['dogstatsd_max_contexts_per_metric'] = 0
+        if config.has_option('Main', 'dogstatsd_max_contexts_per_metric'):
+            agentConfig['dogstatsd_max_contexts_per_metric'] = int(config.get('Main', 'dogstatsd_max_contexts_per_metric'))
+
+        agentConfig['dogstatsd_context_overflow'] = True
+        if config.has_option('Main', 'dogstatsd_context_overflow'):
+            agentConfig['dogstatsd_context_overflow'] = _is_affirmative(config.get('Main', 'dogstatsd_context_overflow'))
+
+        # Share of a CPU core dogstatsd spends aggregating packets before shedding some, 0 for no limit
+        agentConfig['dogstatsd_cpu_budget'] = 0
+        if config.has_option('Main', 'dogstatsd_cpu_budget'):
+            agentConfig['dogstatsd_cpu_budget'] = float(config.get('Main', 'dogstatsd_cpu_budget'))
+
+        # Whether dogstatsd only sends the latest run of the same service check in a flush
+        agentConfig['dogstatsd_coalesce_service_checks'] = False
+        if config.has_option('Main', 'dogstatsd_coalesce_service_checks'):
+            agentConfig['dogstatsd_coalesce_service_checks'] = _is_affirmative(
+                config.get('Main', 'dogstatsd_coalesce_service_checks'))
+
+        # Whether dogstatsd only sends the latest of the events sharing an aggregation key in a flush
+        agentConfig['dogstatsd_coalesce_events'] = False
+        if config.has_option('Main', 'dogstatsd_coalesce_events'):
+            agentConfig['dogstatsd_coalesce_events'] = _is_affirmative(config.get('Main', 'dogstatsd_coalesce_events'))
+
+        # Size limits of the series payloads sent by dogstatsd, before and after compression
+        agentConfig['dogstatsd_max_payload_size'] = 4 * 1024 * 1024
+        if config.has_option('Main', 'dogstatsd_max_payload_size'):
+            agentConfig['dogstatsd_max_payload_size'] = int(config.get('Main', 'dogstatsd_max_payload_size'))
+
+        agentConfig['dogstatsd_max_compressed_payload_size'] = 2 * 1024 * 1024
+        if config.has_option('Main', 'dogstatsd_max_compressed_payload_size'):
+            agentConfig['dogstatsd_max_compressed_payload_size'] = int(
+                config.get('Main', 'dogstatsd_max_compressed_payload_size'))
+
+        # Size in bytes of the disk spool of the dogstatsd payloads that failed to be sent, 0 to drop them
+        agentConfig['dogstatsd_spool_size'] = 0
+        if config.has_option('Main', 'dogstatsd_spool_size'):
+            agentConfig['dogstatsd_spool_size'] = int(config.get('Main', 'dogstatsd_spool_size'))
+
+        # Directory of the spool, defaults to dogstatsd-spool in the run directory
+        agentConfig['dogstatsd_spool_dir'] = None
+        if config.has_option('Main', 'dogstatsd_spool_dir'):
+            agentConfig['dogstatsd_spool_dir'] = config.get('Main', 'dogstatsd_spool_dir')
+
+        # Spooled payloads replayed per second of flush interval
+        agentConfig['dogstatsd_spool_replay_rate'] = 10
+        if config.has_option('Main', 'dogstatsd_spool_replay_rate'):
+            agentConfig['dogstatsd_spool_replay_rate'] = int(config.get('Main', 'dogstatsd_spool_replay_rate'))
+
+        # File dogstatsd records the datagrams it receives to, for tests/core/benchmark_replay.py
+        agentConfig['dogstatsd_capture_path'] = None
+        if config.has_option('Main', 'dogstatsd_capture_path'):
+            agentConfig['dogstatsd_capture_path'] = config.get('Main', 'dogstatsd_capture_path')
+
+        # Share of the datagrams captured, and size in bytes the capture stops at
+        agentConfig['dogstatsd_capture_sample_rate'] = 1.0
+        if config.has_option('Main', 'dogstatsd_capture_sample_rate'):
+            agentConfig['dogstatsd_capture_sample_rate'] = float(config.get('Main', 'dogstatsd_capture_sample_rate'))
+
+        agentConfig['dogstatsd_capture_max_size'] = 100 * 1024 * 1024
+        if config.has_option('Main', 'dogstatsd_capture_max_size'):
+            agentConfig['dogstatsd_capture_max_size'] = int(config.get('Main', 'dogstatsd_capture_max_size'))
+
+        # Number of dogstatsd processes sharing the dogstatsd port (Linux only)
+        agentConfig['dogstatsd_workers'] = 1
+        if config.has_option('Main', 'dogstatsd_workers'):
+            agentConfig['dogstatsd_workers'] = int(config.get('Main', 'dogstatsd_workers'))
+
+        # Number of slots of the ring between the dogstatsd receive loop and parser thread, 0 to parse inline
+        agentConfig['dogstatsd_ring_size'] = 0
+        if config.has_option('Main', 'dogstatsd_ring_size'):
+            agentConfig['dogstatsd_ring_size'] = int(config.get('Main', 'dogstatsd_ring_size'))
+
         # Optional config
         # FIXME not the prettiest code ever...
         if config.has_option('Main', 'use_mount'):
@@ -505,6 +635,28 @@ def get_config(parse_args=True, cfg_path=None, options=None):
             # Default to False as there are some issues with the curl client and ELB
             agentConfig["use_curl_http_client"] = False
 
+        # Maximum number of transactions the forwarder sends concurrently
+        if config.has_option("Main", "forwarder_max_in_flight"):
+            agentConfig["forwarder_max_in_flight"] = int(config.get("Main", "forwarder_max_in_flight"))
+
+        # Size in bytes of the disk spool of the transactions that don't fit in the forwarder queue, 0 to drop them
+        agentConfig["forwarder_spool_size"] = 0
+        if config.has_option("Main", "forwarder_spool_size"):
+            agentConfig["forwarder_spool_size"] = int(config.get("Main", "forwarder_spool_size"))
+
+        # Directory of the spool, defaults to forwarder-spool in the run directory
+        agentConfig["forwarder_spool_dir"] = None
+        if config.has_option("Main", "forwarder_spool_dir"):
+            agentConfig["forwarder_spool_dir"] = config.get("Main", "forwarder_spool_dir")
+
+        # Maximum size in bytes of the batches of series payloads, 0 not to coalesce them
+        if config.has_option("Main", "forwarder_series_batch_size"):
+            agentConfig["forwarder_series_batch_size"] = int(config.get("Main", "forwarder_series_batch_size"))
+
+        # Maximum time in seconds a series payload waits for others to be sent with
+        if config.has_option("Main", "forwarder_series_batch_wait"):
+            agentConfig["forwarder_series_batch_wait"] = float(config.get("Main", "forwarder_series_batch_wait"))
+
         if config.has_section('WMI'):
             agentConfig['WMI'] = {}
             for key, value in config.items('WMI'):
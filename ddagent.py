@@ -18,6 +18,7 @@ from datetime import timedelta
 import logging
 import os
 from Queue import Full, Queue
+import re
 from socket import error as socket_error, gaierror
 import sys
 import threading
@@ -48,7 +49,13 @@ from config import (
     get_version
 )
 import modules
-from transaction import Transaction, TransactionManager
+from transaction import (
+    PRIORITY_HIGH,
+    PRIORITY_LOW,
+    PRIORITY_NORMAL,
+    Transaction,
+    TransactionManager,
+)
 from util import (
     get_hostname,
     get_tornado_ioloop,
@@ -57,6 +64,8 @@ from util import (
     Watchdog,
 )
 from utils.logger import RedactedLogRecord
+from utils.pidfile import PidFile
+from utils.spool import DiskSpool
 
 
 logging.LogRecord = RedactedLogRecord
@@ -79,8 +88,21 @@ MAX_WAIT_FOR_REPLAY = timedelta(seconds=90)
 # Maximum queue size in bytes (when this is reached, old messages are dropped)
 MAX_QUEUE_SIZE = 30 * 1024 * 1024  # 30MB
 
+# Delay between two transactions while the intake is overloaded or unreachable
 THROTTLING_DELAY = timedelta(microseconds=1000000/2)  # 2 msg/second
 
+# Maximum number of transactions sent concurrently
+MAX_IN_FLIGHT = 8
+
+# Maximum size of the batches of series payloads, and time a payload waits for others
+SERIES_BATCH_SIZE = 1024 * 1024  # 1MB
+SERIES_BATCH_WAIT = 1  # 1 second
+
+# The start and the end of a `{"series": [...]}` payload, around its series
+SERIES_HEADER = re.compile(r'\s*\{\s*"series"\s*:\s*')
+SERIES_FOOTER = re.compile(r'\s*\}\s*$')
+JSON_DECODER = json.JSONDecoder()
+
 
 class EmitterThread(threading.Thread):
 
@@ -175,7 +197,7 @@ class AgentTransaction(Transaction):
 
         cls._endpoints.append(DD_ENDPOINT)
 
-    def __init__(self, data, headers, msg_type=""):
+    def __init__(self, data, headers, msg_type="", enqueue=True):
         self._data = data
         self._headers = headers
         self._headers['DD-Forwarder-Version'] = get_version()
@@ -184,17 +206,35 @@ class AgentTransaction(Transaction):
         # Call after data has been set (size is computed in Transaction's init)
         Transaction.__init__(self)
 
+        # A transaction rebuilt from the spool, or sending a batch of others,
+        # is queued or sent by the manager
+        if enqueue:
+            self._enqueue()
+
+    def _enqueue(self):
         # Emitters operate outside the regular transaction framework
         if self._emitter_manager is not None:
-            self._emitter_manager.send(data, headers)
+            self._emitter_manager.send(self._data, self._headers)
 
         # Insert the transaction in the Manager
         self._trManager.append(self)
         log.debug("Created transaction %d" % self.get_id())
         self._trManager.flush()
 
-    def __sizeof__(self):
-        return sys.getsizeof(self._data)
+    def dump(self):
+        meta = {
+            'type': self.__class__.__name__,
+            'msg_type': self._msg_type,
+            'headers': dict(self._headers),
+        }
+        return json.dumps(meta) + '\n' + (self._data or '')
+
+    def compute_size(self):
+        # The bytes of the payload and of its headers
+        size = len(self._data or '')
+        for name, value in self._headers.items():
+            size += len(name) + len(str(value))
+        return size
 
     def get_url(self, endpoint):
         endpoint_base_url = get_url_endpoint(self._application._agentConfig[endpoint])
@@ -266,7 +306,9 @@ class AgentTransaction(Transaction):
     def on_response(self, response):
         if response.error:
             log.error("Response: %s" % response)
-            self._trManager.tr_error(self)
+            # 599 is a timeout or a connection error
+            backoff = response.code >= 500 or response.code in (408, 429)
+            self._trManager.tr_error(self, backoff=backoff)
         else:
             self._trManager.tr_success(self)
 
@@ -276,9 +318,67 @@ class AgentTransaction(Transaction):
 class MetricTransaction(AgentTransaction):
     _type = "metrics"
 
+    def get_priority(self):
+        if self._msg_type == "metadata":
+            return PRIORITY_HIGH
+        elif self._msg_type == "metrics":
+            return PRIORITY_LOW
+        # The collector payloads
+        return PRIORITY_NORMAL
+
 
 class APIMetricTransaction(MetricTransaction):
 
+    def __init__(self, data, headers, msg_type="", enqueue=True):
+        MetricTransaction.__init__(self, data, headers, msg_type, enqueue=False)
+        # Bounds of the series in the payload, if it can be coalesced
+        self._series_span = None
+        self._coalesce_key = self._get_series_key()
+        if enqueue:
+            self._enqueue()
+
+    def _get_series_key(self):
+        """
+        Uncompressed `{"series": [...]}` payloads with the same headers can be
+        coalesced. The compressed ones are large enough to be sent on their own,
+        and merging them would mean decompressing them.
+
+        The series are decoded once to check that they're the only key of the
+        payload, and their bounds kept for `coalesce`.
+        """
+        data = self._data
+        if not data or self._headers.get('Content-Encoding'):
+            return None
+        header = SERIES_HEADER.match(data)
+        if not header:
+            return None
+        try:
+            series, end = JSON_DECODER.raw_decode(data, header.end())
+        except ValueError:
+            return None
+        if not isinstance(series, list) or not SERIES_FOOTER.match(data, end):
+            return None
+        # Inside the brackets
+        self._series_span = (data.index('[', header.end()) + 1, data.rindex(']', 0, end))
+        return ('series',) + tuple(sorted((name, value) for name, value in self._headers.items()
+                                          if name not in HEADERS_TO_REMOVE))
+
+    def get_priority(self):
+        return PRIORITY_LOW
+
+    def coalesce(self, transactions):
+        """ A transaction sending the series of `transactions` in one payload, with their headers """
+        series = []
+        for tr in transactions:
+            start, end = tr._series_span
+            if tr._data[start:end].strip():
+                series.append(tr._data[start:end])
+
+        data = '{"series": [' + ', '.join(series) + ']}'
+        batch = APIMetricTransaction(data, dict(self._headers), enqueue=False)
+        batch.set_coalesce_key(None)
+        return batch
+
     def get_url(self, endpoint):
         endpoint_base_url = get_url_endpoint(self._application._agentConfig[endpoint])
         config = self._application._agentConfig
@@ -292,6 +392,7 @@ class APIMetricTransaction(MetricTransaction):
 
 class APIServiceCheckTransaction(AgentTransaction):
     _type = "service checks"
+    _priority = PRIORITY_HIGH
 
     def get_url(self, endpoint):
         endpoint_base_url = get_url_endpoint(self._application._agentConfig[endpoint])
@@ -301,6 +402,21 @@ class APIServiceCheckTransaction(AgentTransaction):
         return url
 
 
+SPOOLED_TRANSACTION_TYPES = dict((cls.__name__, cls) for cls in [
+    MetricTransaction,
+    APIMetricTransaction,
+    APIServiceCheckTransaction,
+])
+
+
+def load_transaction(record):
+    """ Rebuild a transaction from its spool record """
+    meta, data = record.split('\n', 1)
+    meta = json.loads(meta)
+    headers = dict((str(name), str(value)) for name, value in meta['headers'].iteritems())
+    return SPOOLED_TRANSACTION_TYPES[meta['type']](data, headers, str(meta['msg_type']), enqueue=False)
+
+
 class StatusHandler(tornado.web.RequestHandler):
 
     def get(self):
@@ -391,8 +507,23 @@ class Application(tornado.web.Application):
         self._metrics = {}
         AgentTransaction.set_application(self)
         AgentTransaction.set_endpoints()
+        spool = None
+        spool_size = agentConfig.get('forwarder_spool_size')
+        if spool_size:
+            spool_dir = agentConfig.get('forwarder_spool_dir') or os.path.join(PidFile.get_dir(), 'forwarder-spool')
+            try:
+                spool = DiskSpool(spool_dir, spool_size)
+            except (IOError, OSError) as e:
+                log.warning("Unable to spool the transactions to %s, they'll be dropped when the queue is full: %s",
+                            spool_dir, e)
         self._tr_manager = TransactionManager(MAX_WAIT_FOR_REPLAY,
-                                              MAX_QUEUE_SIZE, THROTTLING_DELAY)
+                                              MAX_QUEUE_SIZE, THROTTLING_DELAY,
+                                              agentConfig.get('forwarder_max_in_flight', MAX_IN_FLIGHT),
+                                              spool=spool, load_transaction=load_transaction,
+                                              batch_max_size=agentConfig.get('forwarder_series_batch_size',
+                                                                             SERIES_BATCH_SIZE),
+                                              batch_max_wait=timedelta(seconds=agentConfig.get(
+                                                  'forwarder_series_batch_wait', SERIES_BATCH_WAIT)))
         AgentTransaction.set_tr_manager(self._tr_manager)
 
         self._watchdog = None
@@ -526,6 +657,7 @@ class Application(tornado.web.Application):
         tr_sched.start()
 
         self.mloop.start()
+        self._tr_manager.close()
         log.info("Stopped")
 
     def stop(self):
@@ -12,12 +12,18 @@ from utils.proxy import set_no_proxy_settings  # noqa
 set_no_proxy_settings()
 
 # stdlib
+import errno
 import logging
+import multiprocessing
 import optparse
 import os
+from Queue import Empty
+import random
 import select
 import signal
 import socket
+import stat
+import struct
 import sys
 import threading
 from time import sleep, time
@@ -29,16 +35,20 @@ os.umask(022)
 
 # 3rd party
 import requests
+from requests.adapters import HTTPAdapter
 import simplejson as json
 
 # project
-from aggregator import get_formatter, MetricsBucketAggregator
+from aggregator import get_formatter, MetricsBucketAggregator, UnparseablePacket
 from checks.check_status import DogstatsdStatus
+from checks.libs.thread_pool import Pool
 from checks.metric_types import MetricTypes
 from config import get_config, get_version
 from daemon import AgentSupervisor, Daemon
 from util import chunks, get_hostname, get_uuid, plural
 from utils.pidfile import PidFile
+from utils.platform import Platform
+from utils.spool import DiskSpool
 
 # urllib3 logs a bunch of stuff at the info level
 requests_log = logging.getLogger("requests.packages.urllib3")
@@ -63,7 +73,36 @@ FLUSH_LOGGING_PERIOD = 70
 FLUSH_LOGGING_INITIAL = 10
 FLUSH_LOGGING_COUNT = 5
 EVENT_CHUNK_SIZE = 50
+# The series, events and service checks are posted concurrently, on
+# as many kept-alive connections
+REPORTER_CONCURRENCY = 3
+HTTP_TIMEOUT = 5
+# Besides the 5xx errors, the responses after which a payload is spooled
+RETRIED_STATUS_CODES = (408, 429)
+# Spooled payloads replayed per second of flush interval
+SPOOL_REPLAY_RATE = 10
 COMPRESS_THRESHOLD = 1024
+# Series serialized in a single call, and bytes buffered before being compressed
+SERIALIZATION_CHUNK_SIZE = 64
+COMPRESS_BUFFER_SIZE = 64 * 1024
+# Receive batching defaults, see Server._receive_batch
+RECV_BATCH_SIZE = 1
+RECV_BATCH_BYTES = 1024 * 1024
+# How often dogstatsd workers ship their closed buckets to the reporter, in seconds
+WORKER_SHIP_INTERVAL = 1
+# How long the closed buckets are held before being flushed when there are
+# workers, for the last shipment of their buckets to be merged, in seconds
+WORKER_FLUSH_DELAY = 2 * WORKER_SHIP_INTERVAL
+# Not exposed by the socket module on python 2, this is the Linux value
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+# How often the parser thread reports the state of the datagram ring, in seconds
+RING_REPORT_INTERVAL = 10
+# Capture files: the magic and start time, then each datagram preceded by
+# the microseconds since the previous one and its length
+CAPTURE_MAGIC = 'DSDCAP1\n'
+CAPTURE_HEADER = struct.Struct('<d')
+CAPTURE_RECORD = struct.Struct('<II')
+CAPTURE_MAX_SIZE = 100 * 1024 * 1024
 
 
 def add_serialization_status_metric(status, hostname):
@@ -99,27 +138,161 @@ def unicode_metrics(metrics):
     return metrics
 
 
-def serialize_metrics(metrics, hostname):
+def compress_bound(size):
+    """ The largest size `size` bytes can deflate to, see zlib's compressBound """
+    return size + (size >> 12) + (size >> 14) + (size >> 25) + 13
+
+
+class SeriesPayload(object):
+    """
+    A `{"series": [...]}` payload, compressed as its series are added rather
+    than serialized and compressed as a whole.
+
+    The compressed size of what's been added but not output by the compressor
+    yet is bounded by `compress_bound`. Close to the limit, the exact size is
+    measured by flushing a copy of the compressor.
+    """
+
+    HEADER = '{"series": ['
+    SEPARATOR = ', '
+    FOOTER = ']}'
+
+    def __init__(self):
+        self._compressor = zlib.compressobj()
+        self._compressed = []
+        self.compressed_size = 0
+        # Input not passed to the compressor yet
+        self._pending = []
+        self._pending_size = 0
+        # The payload as is, until it's too large not to be compressed
+        self._raw = []
+        self.size = 0
+        self.count = 0
+        # Compressed size measured with a flush, and the bytes added since
+        self._measured_size = 0
+        self._unmeasured = 0
+        self._write(self.HEADER)
+
+    def _write(self, data):
+        self.size += len(data)
+        self._unmeasured += len(data)
+        if self._raw is not None:
+            self._raw.append(data)
+            if self.size > COMPRESS_THRESHOLD:
+                self._raw = None
+        self._pending.append(data)
+        self._pending_size += len(data)
+        if self._pending_size >= COMPRESS_BUFFER_SIZE:
+            self._compress_pending()
+
+    def _compress_pending(self):
+        compressed = self._compressor.compress(''.join(self._pending))
+        self._pending = []
+        self._pending_size = 0
+        if compressed:
+            self._compressed.append(compressed)
+            self.compressed_size += len(compressed)
+
+    def fits(self, length, max_size=None, max_compressed_size=None):
+        """ Whether `length` more bytes can be added without the payload going over the limits """
+        added = length + len(self.SEPARATOR) + len(self.FOOTER)
+        if max_size and self.size + added > max_size:
+            return False
+        if max_compressed_size:
+            if self._measured_size + compress_bound(self._unmeasured + added) <= max_compressed_size:
+                return True
+            self._compress_pending()
+            self._measured_size = self.compressed_size + len(self._compressor.copy().flush())
+            self._unmeasured = 0
+            return self._measured_size + compress_bound(added) <= max_compressed_size
+        return True
+
+    def add(self, series, count=1):
+        """ Add `count` serialized series, separated by `SEPARATOR` """
+        if self.count:
+            self._write(self.SEPARATOR)
+        self._write(series)
+        self.count += count
+
+    def close(self):
+        """ The body of the payload and its headers """
+        if self._raw is not None:
+            self._raw.append(self.FOOTER)
+            return ''.join(self._raw), {'Content-Type': 'application/json'}
+        self._pending.append(self.FOOTER)
+        self._compress_pending()
+        self._compressed.append(self._compressor.flush())
+        headers = {'Content-Type': 'application/json',
+                   'Content-Encoding': 'deflate'}
+        return ''.join(self._compressed), headers
+
+
+def serialize_series(metric):
+    """
+    Serialize a series, replacing its invalid characters if it has some.
+    Returns it with its serialization status.
+    """
     try:
-        metrics.append(add_serialization_status_metric("success", hostname))
-        serialized = json.dumps({"series": metrics})
+        return json.dumps(metric), "success"
     except UnicodeDecodeError as e:
-        log.exception("Unable to serialize payload. Trying to replace bad characters. %s", e)
-        metrics.append(add_serialization_status_metric("failure", hostname))
+        log.warning("Unable to serialize %s. Trying to replace bad characters. %s", metric.get('metric'), e)
         try:
-            log.error(metrics)
-            serialized = json.dumps({"series": unicode_metrics(metrics)})
+            return json.dumps(unicode_metrics([metric])[0]), "failure"
         except Exception as e:
-            log.exception("Unable to serialize payload. Giving up. %s", e)
-            serialized = json.dumps({"series": [add_serialization_status_metric("permanent_failure", hostname)]})
+            log.exception("Unable to serialize %s. Giving up. %s", metric.get('metric'), e)
+            return None, "permanent_failure"
 
-    if len(serialized) > COMPRESS_THRESHOLD:
-        headers = {'Content-Type': 'application/json',
-                   'Content-Encoding': 'deflate'}
-        serialized = zlib.compress(serialized)
-    else:
-        headers = {'Content-Type': 'application/json'}
-    return serialized, headers
+
+def iter_serialized_metrics(metrics, hostname, max_payload_size=None, max_compressed_payload_size=None):
+    """
+    Serialize `metrics` into a sequence of payloads of at most
+    `max_payload_size` bytes, and `max_compressed_payload_size` bytes once
+    compressed. Payloads are yielded as `(body, headers)` as soon as they're
+    full, the whole series are never held in a single string.
+
+    Each payload ends with a `datadog.dogstatsd.serialization_status` series,
+    tagged with the worst status of the series it holds.
+    """
+    statuses = ("success", "failure", "permanent_failure")
+    payload = SeriesPayload()
+    status = "success"
+    # Room for the status series of the payload
+    status_room = len(json.dumps(add_serialization_status_metric("permanent_failure", hostname))) + \
+        len(SeriesPayload.SEPARATOR)
+
+    for chunk in chunks(metrics, SERIALIZATION_CHUNK_SIZE):
+        # Serializing series one by one is much slower, only do it at the
+        # end of a payload, or to find the invalid ones
+        try:
+            serialized = json.dumps(chunk)[1:-1]
+            if serialized and payload.fits(len(serialized) + status_room, max_payload_size,
+                                           max_compressed_payload_size):
+                payload.add(serialized, len(chunk))
+                continue
+        except UnicodeDecodeError:
+            pass
+
+        for metric in chunk:
+            series, series_status = serialize_series(metric)
+            if statuses.index(series_status) > statuses.index(status):
+                status = series_status
+            if series is None:
+                continue
+            if payload.count and not payload.fits(len(series) + status_room, max_payload_size,
+                                                  max_compressed_payload_size):
+                payload.add(json.dumps(add_serialization_status_metric(status, hostname)))
+                yield payload.close()
+                payload = SeriesPayload()
+                status = series_status
+            payload.add(series)
+
+    payload.add(json.dumps(add_serialization_status_metric(status, hostname)))
+    yield payload.close()
+
+
+def serialize_metrics(metrics, hostname):
+    """ Serialize `metrics` into a single payload, returned with its headers """
+    return next(iter_serialized_metrics(metrics, hostname))
 
 
 def serialize_event(event):
@@ -133,11 +306,15 @@ class Reporter(threading.Thread):
     """
 
     def __init__(self, interval, metrics_aggregator, api_host, api_key=None,
-                 use_watchdog=False, event_chunk_size=None):
+                 use_watchdog=False, event_chunk_size=None, worker_queue=None,
+                 max_payload_size=None, max_compressed_payload_size=None, spool=None,
+                 spool_replay_rate=None):
         threading.Thread.__init__(self)
         self.interval = int(interval)
         self.finished = threading.Event()
         self.metrics_aggregator = metrics_aggregator
+        # Aggregates shipped by the dogstatsd workers, if any
+        self.worker_queue = worker_queue
         self.flush_count = 0
         self.log_count = 0
         self.hostname = get_hostname()
@@ -150,6 +327,28 @@ class Reporter(threading.Thread):
         self.api_key = api_key
         self.api_host = api_host
         self.event_chunk_size = event_chunk_size or EVENT_CHUNK_SIZE
+        # Size limits of the series payloads, 0 or None for no limit
+        self.max_payload_size = max_payload_size
+        self.max_compressed_payload_size = max_compressed_payload_size
+
+        # Connections to the intake are kept alive between flushes
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=REPORTER_CONCURRENCY, pool_block=True)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        # Started with the thread, flushes are submitted serially without it
+        self.pool = None
+        # Latencies of the POSTs of the current flush, by endpoint
+        self.latencies = {}
+        self.latencies_lock = threading.Lock()
+
+        # The payloads that failed to be submitted are spooled to disk, and
+        # replayed once the flushes succeed again
+        self.spool = spool
+        self.spool_replay_rate = spool_replay_rate or SPOOL_REPLAY_RATE
+        # Counted by the threads of the pool
+        self.failed_submissions = 0
+        self.failed_submissions_lock = threading.Lock()
 
     def stop(self):
         log.info("Stopping reporter")
@@ -159,50 +358,97 @@ class Reporter(threading.Thread):
 
         log.info("Reporting to %s every %ss" % (self.api_host, self.interval))
         log.debug("Watchdog enabled: %s" % bool(self.watchdog))
+        self.pool = Pool(REPORTER_CONCURRENCY, name="Reporter")
 
         # Persist a start-up message.
         DogstatsdStatus().persist()
 
         while not self.finished.isSet():  # Use camel case isSet for 2.4 support.
             self.finished.wait(self.interval)
+            self.merge_worker_payloads()
             self.metrics_aggregator.send_packet_count('datadog.dogstatsd.packet.count')
             self.flush()
             if self.watchdog:
                 self.watchdog.reset()
 
+        self.pool.terminate()
+        self.pool.join()
+        self.session.close()
+        if self.spool is not None:
+            self.spool.close()
+
         # Clean up the status messages.
         log.debug("Stopped reporter")
         DogstatsdStatus.remove_latest_status()
 
+    def merge_worker_payloads(self):
+        """
+        Merge the aggregates shipped by the dogstatsd workers into our
+        aggregator, so that they're flushed and serialized together.
+        """
+        if self.worker_queue is None:
+            return
+
+        merged = 0
+        while True:
+            try:
+                payload = self.worker_queue.get_nowait()
+            except Empty:
+                break
+            try:
+                self.metrics_aggregator.merge(payload)
+                merged += 1
+            except Exception:
+                log.exception("Unable to merge a worker payload")
+        log.debug("Merged %s worker payload%s" % (merged, plural(merged)))
+
     def flush(self):
         try:
             self.flush_count += 1
             self.log_count += 1
             packets_per_second = self.metrics_aggregator.packets_per_second(self.interval)
             packet_count = self.metrics_aggregator.total_count
+            context_limiter_stats = self.report_context_limiter_stats()
+            self.report_load_shedder_stats()
 
+            submissions = []
             metrics = self.metrics_aggregator.flush()
             count = len(metrics)
             if self.flush_count % FLUSH_LOGGING_PERIOD == 0:
                 self.log_count = 0
             if count:
-                self.submit(metrics)
+                submissions.append((self.submit, metrics))
 
             events = self.metrics_aggregator.flush_events()
             event_count = len(events)
             if event_count:
-                self.submit_events(events)
+                submissions.append((self.submit_events, events))
 
             service_checks = self.metrics_aggregator.flush_service_checks()
             service_check_count = len(service_checks)
             if service_check_count:
-                self.submit_service_checks(service_checks)
+                submissions.append((self.submit_service_checks, service_checks))
+
+            flush_start = time()
+            with self.failed_submissions_lock:
+                failed_submissions = self.failed_submissions
+            self.run_submissions(submissions)
+            flush_duration = time() - flush_start
+
+            spool_stats = None
+            if self.spool is not None:
+                with self.failed_submissions_lock:
+                    flush_failed = self.failed_submissions != failed_submissions
+                if not flush_failed:
+                    self.replay_spool()
+                spool_stats = self.report_spool_stats()
+            latency_stats = self.report_latencies()
 
             should_log = self.flush_count <= FLUSH_LOGGING_INITIAL or self.log_count <= FLUSH_LOGGING_COUNT
             log_func = log.info
             if not should_log:
                 log_func = log.debug
-            log_func("Flush #%s: flushed %s metric%s, %s event%s, and %s service check run%s" % (self.flush_count, count, plural(count), event_count, plural(event_count), service_check_count, plural(service_check_count)))
+            log_func("Flush #%s: flushed %s metric%s, %s event%s, and %s service check run%s in %.3fs" % (self.flush_count, count, plural(count), event_count, plural(event_count), service_check_count, plural(service_check_count), flush_duration))
             if self.flush_count == FLUSH_LOGGING_INITIAL:
                 log.info("First flushes done, %s flushes will be logged every %s flushes." % (FLUSH_LOGGING_COUNT, FLUSH_LOGGING_PERIOD))
 
@@ -215,6 +461,9 @@ class Reporter(threading.Thread):
                 metric_count=count,
                 event_count=event_count,
                 service_check_count=service_check_count,
+                context_limiter_stats=context_limiter_stats,
+                latency_stats=latency_stats,
+                spool_stats=spool_stats,
             ).persist()
 
         except Exception:
@@ -223,13 +472,94 @@ class Reporter(threading.Thread):
             else:
                 log.exception("Error flushing metrics")
 
+    def report_context_limiter_stats(self):
+        """
+        Submit the number of contexts and of samples rejected by the context
+        limiter of the aggregator, if it has one, and return its stats.
+        """
+        stats = self.metrics_aggregator.pop_context_limiter_stats()
+        if stats is None:
+            return None
+
+        submit_metric = self.metrics_aggregator.submit_metric
+        submit_metric('datadog.dogstatsd.contexts', stats['contexts'], 'g')
+        submit_metric('datadog.dogstatsd.contexts.rejected', stats['rejected'], 'c')
+        for name, count in stats['top_rejected']:
+            submit_metric('datadog.dogstatsd.contexts.rejected_by_metric', count, 'c',
+                          tags=['metric_name:%s' % name])
+        if stats['rejected']:
+            log.warning("%s samples of new contexts were over the context limits, mostly of %s",
+                        stats['rejected'], ', '.join(name for name, _ in stats['top_rejected']))
+        return stats
+
+    def report_load_shedder_stats(self):
+        """
+        Submit the share of the metric packets shed by the load shedder of
+        the aggregator since the last flush, if it has one.
+        """
+        stats = self.metrics_aggregator.pop_load_shedder_stats()
+        if stats is None:
+            return
+
+        shed_ratio = float(stats['shed']) / stats['packets'] if stats['packets'] else 0.0
+        submit_metric = self.metrics_aggregator.submit_metric
+        submit_metric('datadog.dogstatsd.shedding.ratio', shed_ratio, 'g')
+        submit_metric('datadog.dogstatsd.shedding.shed', stats['shed'], 'c')
+        if stats['shed']:
+            log.warning("Shed %s of %s metric packets over the CPU budget, keeping 1 in %s",
+                        stats['shed'], stats['packets'], stats['ratio'])
+
+    def report_spool_stats(self):
+        """ Submit the size of the spool, and return its stats """
+        stats = self.spool.stats()
+        submit_metric = self.metrics_aggregator.submit_metric
+        submit_metric('datadog.dogstatsd.spool.payloads', stats['records'], 'g')
+        submit_metric('datadog.dogstatsd.spool.bytes', stats['size'], 'g')
+        return stats
+
+    def run_submissions(self, submissions):
+        """
+        Run the `(submit_func, payload)` submissions concurrently on the
+        pool if the reporter is running, and wait for all of them.
+        """
+        if self.pool is None:
+            for func, payload in submissions:
+                func(payload)
+            return
+
+        results = [self.pool.apply_async(func, (payload,)) for func, payload in submissions]
+        for result in results:
+            try:
+                result.get()
+            except Exception:
+                log.exception("Unable to submit payload.")
+
+    def report_latencies(self):
+        """
+        Submit the latencies of the POSTs of the flush to a histogram per
+        endpoint, and return their count, average and maximum, in ms.
+        """
+        with self.latencies_lock:
+            latencies, self.latencies = self.latencies, {}
+
+        stats = {}
+        for endpoint, durations in latencies.iteritems():
+            for duration in durations:
+                self.metrics_aggregator.submit_metric('datadog.dogstatsd.http.latency', duration, 'h',
+                                                      tags=['endpoint:%s' % endpoint])
+            stats[endpoint] = {
+                'count': len(durations),
+                'avg': round(sum(durations) / len(durations), 1),
+                'max': round(max(durations), 1),
+            }
+        return stats
+
     def submit(self, metrics):
-        body, headers = serialize_metrics(metrics, self.hostname)
-        params = {}
-        if self.api_key:
-            params['api_key'] = self.api_key
-        url = '%s/api/v1/series?%s' % (self.api_host, urlencode(params))
-        self.submit_http(url, body, headers)
+        # Each payload is sent as soon as it's serialized, so only one is
+        # in memory at a time
+        for body, headers in iter_serialized_metrics(metrics, self.hostname, self.max_payload_size,
+                                                     self.max_compressed_payload_size):
+            self.submit_http('/api/v1/series', body, headers)
 
     def submit_events(self, events):
         headers = {'Content-Type':'application/json'}
@@ -244,43 +574,238 @@ class Reporter(threading.Thread):
                 'uuid': get_uuid(),
                 'internalHostname': get_hostname()
             }
-            params = {}
-            if self.api_key:
-                params['api_key'] = self.api_key
-            url = '%s/intake?%s' % (self.api_host, urlencode(params))
 
-            self.submit_http(url, json.dumps(payload), headers)
+            self.submit_http('/intake', json.dumps(payload), headers)
 
-    def submit_http(self, url, data, headers):
+    def submit_http(self, path, data, headers, spool=True):
+        """
+        POST a payload to the `path` endpoint of the intake. If it fails
+        with an error worth retrying, it's spooled when `spool` is set, and
+        False is returned.
+        """
         headers["DD-Dogstatsd-Version"] = get_version()
+        params = {}
+        if self.api_key:
+            params['api_key'] = self.api_key
+        url = '%s%s?%s' % (self.api_host, path, urlencode(params))
+        endpoint = path.rsplit('/', 1)[-1]
+
         log.debug("Posting payload to %s" % url)
+        r = None
         try:
             start_time = time()
-            r = requests.post(url, data=data, timeout=5, headers=headers)
+            try:
+                r = self.session.post(url, data=data, timeout=HTTP_TIMEOUT, headers=headers)
+            finally:
+                duration = round((time() - start_time) * 1000.0, 4)
+                with self.latencies_lock:
+                    self.latencies.setdefault(endpoint, []).append(duration)
             r.raise_for_status()
 
             if r.status_code >= 200 and r.status_code < 205:
                 log.debug("Payload accepted")
 
             status = r.status_code
-            duration = round((time() - start_time) * 1000.0, 4)
             log.debug("%s POST %s (%sms)" % (status, url, duration))
+            return True
         except Exception:
             log.exception("Unable to post payload.")
-            try:
+            if r is not None:
                 log.error("Received status code: {0}".format(r.status_code))
-            except Exception:
-                pass
+
+        # The intake or the network is down, rather than the payload invalid
+        if r is not None and r.status_code < 500 and r.status_code not in RETRIED_STATUS_CODES:
+            return True
+        with self.failed_submissions_lock:
+            self.failed_submissions += 1
+        if spool and self.spool is not None:
+            record = '%s\n%s' % (json.dumps({'path': path, 'headers': headers}), data)
+            self.spool.append(record, compress=headers.get('Content-Encoding') != 'deflate')
+        return False
+
+    def replay_spool(self):
+        """
+        Resubmit the spooled payloads, oldest first, at most
+        `spool_replay_rate` per second of flush interval, and for half of
+        it, so that the live flushes still go first. Stops at the first
+        failure.
+        """
+        replayed = 0
+        deadline = time() + self.interval / 2.0
+        while replayed < self.spool_replay_rate * self.interval and time() < deadline:
+            record = self.spool.peek()
+            if record is None:
+                break
+            meta, data = record.split('\n', 1)
+            meta = json.loads(meta)
+            if not self.submit_http(meta['path'], data, meta['headers'], spool=False):
+                break
+            self.spool.pop()
+            replayed += 1
+
+        if replayed:
+            log.info("Replayed %s spooled payload%s, %s left", replayed, plural(replayed), len(self.spool))
+        return replayed
 
     def submit_service_checks(self, service_checks):
         headers = {'Content-Type':'application/json'}
+        self.submit_http('/api/v1/check_run', json.dumps(service_checks), headers)
 
-        params = {}
-        if self.api_key:
-            params['api_key'] = self.api_key
 
-        url = '{0}/api/v1/check_run?{1}'.format(self.api_host, urlencode(params))
-        self.submit_http(url, json.dumps(service_checks), headers)
+class DatagramCapture(object):
+    """
+    Records the datagrams received by a `Server`, with the time they were
+    received at, to a binary file that `read_capture` reads back. Only a
+    `sample_rate` share of the datagrams is recorded, and the capture stops
+    once the file reaches `max_size` bytes.
+    """
+
+    def __init__(self, path, sample_rate=None, max_size=None):
+        self.path = path
+        self.sample_rate = float(sample_rate or 1)
+        self.max_size = int(max_size or CAPTURE_MAX_SIZE)
+        self.start_time = time()
+        self.last_time = self.start_time
+        self.count = 0
+        self.size = len(CAPTURE_MAGIC) + CAPTURE_HEADER.size
+        self.file = open(path, 'wb', 1024 * 1024)
+        self.file.write(CAPTURE_MAGIC + CAPTURE_HEADER.pack(self.start_time))
+
+    def write(self, datagram, timestamp=None):
+        if self.file is None or not datagram:
+            return
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return
+        if self.size + CAPTURE_RECORD.size + len(datagram) > self.max_size:
+            log.warning("The capture reached %s bytes, stopping it. %s datagrams were captured to %s",
+                        self.max_size, self.count, self.path)
+            self.close()
+            return
+        timestamp = timestamp or time()
+        delay = min(max(int((timestamp - self.last_time) * 1000000), 0), 0xffffffff)
+        self.last_time = timestamp
+        self.file.write(CAPTURE_RECORD.pack(delay, len(datagram)))
+        self.file.write(datagram)
+        self.count += 1
+        self.size += CAPTURE_RECORD.size + len(datagram)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def read_capture(path):
+    """ Yield the `(timestamp, datagram)` of a capture file """
+    with open(path, 'rb') as f:
+        if f.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError("%s isn't a dogstatsd capture" % path)
+        timestamp = CAPTURE_HEADER.unpack(f.read(CAPTURE_HEADER.size))[0]
+        while True:
+            record = f.read(CAPTURE_RECORD.size)
+            if len(record) < CAPTURE_RECORD.size:
+                return
+            delay, length = CAPTURE_RECORD.unpack(record)
+            datagram = f.read(length)
+            if len(datagram) < length:
+                return
+            timestamp += delay / 1000000.0
+            yield timestamp, datagram
+
+
+class DatagramRing(object):
+    """
+    A fixed-size ring of datagrams between the thread that receives them and
+    the one that parses them. It's preallocated: `slots` slots of `slot_size`
+    bytes each, that datagrams are received into with `recv_into`.
+
+    There's a single writer and a single reader: the writer only moves
+    `_tail` forward and the reader `_head`. When the ring is full, datagrams
+    are still read from the socket, so that they're not counted as kernel
+    drops, but they're dropped and counted in `drops`.
+    """
+
+    def __init__(self, slots, slot_size):
+        self.slots = int(slots)
+        self.slot_size = int(slot_size)
+        self._buffer = bytearray(self.slots * self.slot_size)
+        view = memoryview(self._buffer)
+        self._slot_views = [view[i * self.slot_size:(i + 1) * self.slot_size] for i in xrange(self.slots)]
+        self._sizes = [0] * self.slots
+        # Datagrams dropped when the ring is full are read here
+        self._scratch = memoryview(bytearray(self.slot_size))
+        self._head = 0
+        self._tail = 0
+        # Set by the writer when there's something to read
+        self.ready = threading.Event()
+
+        self.drops = 0
+        self.high_water_mark = 0
+
+    def __len__(self):
+        return self._tail - self._head
+
+    def receive(self, sock, size):
+        """
+        Receive the datagrams ready on `sock`, until it would block.
+        Returns the number of datagrams read, dropped ones included.
+        """
+        recv_into = sock.recv_into
+        slots = self.slots
+        size = min(size, self.slot_size)
+        ready = self.ready
+
+        count = 0
+        while True:
+            tail = self._tail
+            full = tail - self._head >= slots
+            if full:
+                target = self._scratch
+            else:
+                target = self._slot_views[tail % slots]
+
+            try:
+                nbytes = recv_into(target, size)
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            count += 1
+
+            if full:
+                self.drops += 1
+                continue
+
+            self._sizes[tail % slots] = nbytes
+            self._tail = tail + 1
+            depth = self._tail - self._head
+            if depth > self.high_water_mark:
+                self.high_water_mark = depth
+            if not ready.isSet():
+                ready.set()
+
+        return count
+
+    def read(self):
+        """ Return the list of datagrams in the ring, and empty it. """
+        head = self._head
+        tail = self._tail
+        slots = self.slots
+        slot_views = self._slot_views
+        sizes = self._sizes
+
+        datagrams = []
+        for i in xrange(head, tail):
+            slot = i % slots
+            datagrams.append(slot_views[slot][:sizes[slot]].tobytes())
+        self._head = tail
+        return datagrams
+
+    def reset_stats(self):
+        """ Return the drops and the high water mark since the last call, and reset them. """
+        drops, self.drops = self.drops, 0
+        high_water_mark, self.high_water_mark = self.high_water_mark, len(self)
+        return drops, high_water_mark
 
 
 class Server(object):
@@ -288,12 +813,47 @@ class Server(object):
     A statsd udp server.
     """
 
-    def __init__(self, metrics_aggregator, host, port, forward_to_host=None, forward_to_port=None):
+    def __init__(self, metrics_aggregator, host, port, forward_to_host=None, forward_to_port=None,
+                 batch_size=None, batch_bytes=None, reuse_port=False, workers=None,
+                 socket_path=None, socket_buffer_size=None, ring_size=None,
+                 capture_path=None, capture_sample_rate=None, capture_max_size=None):
         self.host = host
         self.port = int(port)
         self.address = (self.host, self.port)
         self.metrics_aggregator = metrics_aggregator
         self.buffer_size = 1024 * 8
+        self.socket = None
+
+        # Optional unix domain datagram socket, alongside the UDP one or
+        # instead of it when the port is 0. Senders block instead of losing
+        # packets when it's full, and it takes datagrams bigger than 8KB.
+        self.socket_path = socket_path
+        self.socket_buffer_size = int(socket_buffer_size or self.buffer_size)
+        self.unix_socket = None
+
+        # Receive batching: when batch_size > 1, every wakeup drains up to
+        # batch_size datagrams (and about batch_bytes bytes) from the socket
+        self.batch_size = max(1, int(batch_size or RECV_BATCH_SIZE))
+        self.batch_bytes = max(self.buffer_size, int(batch_bytes or RECV_BATCH_BYTES))
+        self._batch_buffer = None
+        self._batch_view = None
+
+        # With SO_REUSEPORT, the kernel shards the datagrams between all the
+        # sockets bound to our port: ours and the ones of our `workers`.
+        self.reuse_port = reuse_port
+        self.workers = workers or []
+
+        # With a ring size, the select loop only receives datagrams into a
+        # `DatagramRing`, and a parser thread submits them to the aggregator
+        self.ring_size = int(ring_size or 0)
+        self.ring = None
+
+        # Optionally record the datagrams received to a capture file, see
+        # DatagramCapture
+        self.capture_path = capture_path
+        self.capture_sample_rate = capture_sample_rate
+        self.capture_max_size = capture_max_size
+        self.capture = None
 
         self.running = False
 
@@ -312,40 +872,103 @@ class Server(object):
             except Exception:
                 log.exception("Error while setting up connection to external statsd server")
 
+    def _bind_unix_socket(self):
+        """ Returns False if the socket path is taken by something else than a socket """
+        path = self.socket_path
+        try:
+            mode = os.lstat(path).st_mode
+        except OSError:
+            mode = None
+        if mode is not None:
+            if not stat.S_ISSOCK(mode):
+                log.error("%s exists and isn't a socket, not listening on it. Check dogstatsd_socket." % path)
+                return False
+            # Remove the socket file left behind by a previous run
+            os.unlink(path)
+        self.unix_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.unix_socket.setblocking(0)
+        self.unix_socket.bind(path)
+        # Let any local user (e.g. applications in containers) write to it
+        os.chmod(path, 0722)
+        log.info('Listening on unix socket: %s' % path)
+        return True
+
     def start(self):
         """ Run the server. """
-        # Bind to the UDP socket.
-        # IPv4 only
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.socket.setblocking(0)
-        try:
-            self.socket.bind(self.address)
-        except socket.gaierror:
-            if self.address[0] == 'localhost':
-                log.warning("Warning localhost seems undefined in your host file, using 127.0.0.1 instead")
-                self.address = ('127.0.0.1', self.address[1])
+        sockets = []
+        if self.port:
+            # Bind to the UDP socket.
+            # IPv4 only
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.socket.setblocking(0)
+            if self.reuse_port:
+                self.socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+            try:
                 self.socket.bind(self.address)
+            except socket.gaierror:
+                if self.address[0] == 'localhost':
+                    log.warning("Warning localhost seems undefined in your host file, using 127.0.0.1 instead")
+                    self.address = ('127.0.0.1', self.address[1])
+                    self.socket.bind(self.address)
+
+            log.info('Listening on host & port: %s' % str(self.address))
+            sockets.append(self.socket)
 
-        log.info('Listening on host & port: %s' % str(self.address))
+        if self.socket_path and self._bind_unix_socket():
+            sockets.append(self.unix_socket)
+
+        if not sockets:
+            log.error("Neither a UDP port nor a unix socket to listen on, not starting")
+            return
+
+        capture = None
+        if self.capture_path:
+            capture = self.capture = DatagramCapture(self.capture_path, self.capture_sample_rate,
+                                                     self.capture_max_size)
+            log.info('Capturing %.0f%% of the datagrams received to %s' % (
+                capture.sample_rate * 100, self.capture_path))
 
         # Inline variables for quick look-up.
-        buffer_size = self.buffer_size
         aggregator_submit = self.metrics_aggregator.submit_packets
-        sock = [self.socket]
-        socket_recv = self.socket.recv
+        recv_by_socket = dict((sock, (sock.recv, self._recv_size(sock))) for sock in sockets)
         select_select = select.select
         select_error = select.error
         timeout = UDP_SOCKET_TIMEOUT
         should_forward = self.should_forward
         forward_udp_sock = self.forward_udp_sock
+        should_batch = self.batch_size > 1
+        receive_batch = self._receive_batch
+        ring = None
+        parser = None
+        if self.ring_size:
+            ring = self.ring = DatagramRing(self.ring_size, max(self._recv_size(sock) for sock in sockets))
+            log.info('Receiving datagrams into a ring of %s slots of %s bytes' % (ring.slots, ring.slot_size))
+        elif should_batch:
+            log.info('Draining up to %s datagrams (%s bytes) per wakeup' % (self.batch_size, self.batch_bytes))
 
         # Run our select loop.
         self.running = True
+        if ring is not None:
+            parser = threading.Thread(target=self._parse_ring, name='dogstatsd-parser')
+            parser.daemon = True
+            parser.start()
+
         while self.running:
             try:
-                ready = select_select(sock, [], [], timeout)
-                if ready[0]:
+                ready = select_select(sockets, [], [], timeout)
+                for sock in ready[0]:
+                    if ring is not None:
+                        ring.receive(sock, recv_by_socket[sock][1])
+                        continue
+
+                    if should_batch:
+                        receive_batch(sock)
+                        continue
+
+                    socket_recv, buffer_size = recv_by_socket[sock]
                     message = socket_recv(buffer_size)
+                    if capture is not None:
+                        capture.write(message)
                     aggregator_submit(message)
 
                     if should_forward:
@@ -357,12 +980,193 @@ class Server(object):
                     raise
             except (KeyboardInterrupt, SystemExit):
                 break
+            except UnparseablePacket, e:
+                # The aggregator counts them and logs a summary when flushing
+                log.debug(e)
             except Exception:
                 log.exception('Error receiving datagram')
 
+        if parser is not None:
+            # It parses what's left in the ring before stopping
+            ring.ready.set()
+            parser.join()
+        self._close_sockets()
+
+    def _parse_ring(self):
+        """ The parser thread: submit the datagrams of the ring to the aggregator. """
+        ring = self.ring
+        aggregator = self.metrics_aggregator
+        next_report = time() + RING_REPORT_INTERVAL
+
+        while True:
+            ring.ready.clear()
+            datagrams = ring.read()
+            if datagrams:
+                if self.capture is not None:
+                    # Timestamped when they're parsed rather than received
+                    for datagram in datagrams:
+                        self.capture.write(datagram)
+                try:
+                    aggregator.submit_packets('\n'.join(datagrams), skip_malformed=True)
+                    if self.should_forward:
+                        for datagram in datagrams:
+                            self.forward_udp_sock.send(datagram)
+                except Exception:
+                    log.exception('Error parsing datagrams')
+            elif not self.running:
+                break
+            else:
+                ring.ready.wait(1)
+
+            if time() >= next_report:
+                next_report = time() + RING_REPORT_INTERVAL
+                self.report_ring_stats()
+
+    def report_ring_stats(self):
+        """ Submit the drops and the usage of the datagram ring as internal metrics. """
+        drops, high_water_mark = self.ring.reset_stats()
+        self.metrics_aggregator.submit_metric('datadog.dogstatsd.ring.drops', drops, 'c')
+        self.metrics_aggregator.submit_metric('datadog.dogstatsd.ring.high_water_mark', high_water_mark, 'g')
+        if drops:
+            log.warning("Dropped %s datagram%s, the ring of %s slots was full" % (drops, plural(drops), self.ring.slots))
+
+    def _recv_size(self, sock):
+        if sock is self.unix_socket:
+            return self.socket_buffer_size
+        return self.buffer_size
+
+    def _close_sockets(self):
+        if self.capture is not None:
+            self.capture.close()
+        for sock in (self.socket, self.unix_socket):
+            if sock is not None:
+                sock.close()
+        if self.unix_socket is not None:
+            try:
+                os.unlink(self.socket_path)
+            except OSError:
+                pass
+
+    def _receive_batch(self, sock):
+        """
+        Drain the datagrams ready on `sock` until it would block, or until
+        `batch_size` datagrams or `batch_bytes` bytes have been read, then
+        submit them to the aggregator at once. Returns the number of datagrams.
+
+        Datagrams are read with `recv_into` into a single preallocated buffer,
+        one after the other and separated by newlines, so a batch costs one
+        copy into a string instead of one buffer allocation per datagram.
+        """
+        if self._batch_buffer is None:
+            # One extra datagram of headroom so that the last read, started
+            # under the byte budget, can't overflow the buffer.
+            self._batch_buffer = bytearray(self.batch_bytes + max(self.buffer_size, self.socket_buffer_size) + 1)
+            self._batch_view = memoryview(self._batch_buffer)
+
+        buf = self._batch_buffer
+        view = self._batch_view
+        recv_into = sock.recv_into
+        buffer_size = self._recv_size(sock)
+        batch_size = self.batch_size
+        batch_bytes = self.batch_bytes
+        boundaries = [] if self.should_forward or self.capture is not None else None
+
+        count = 0
+        offset = 0
+        while count < batch_size and offset < batch_bytes:
+            try:
+                nbytes = recv_into(view[offset:], buffer_size)
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            if boundaries is not None:
+                boundaries.append((offset, offset + nbytes))
+            offset += nbytes
+            buf[offset] = 10  # '\n'
+            offset += 1
+            count += 1
+
+        if not count:
+            return 0
+
+        packets = view[:offset].tobytes()
+        self.metrics_aggregator.submit_packets(packets, skip_malformed=True)
+        self.metrics_aggregator.submit_metric('datadog.dogstatsd.datagrams_per_wakeup', count, 'h')
+
+        if boundaries:
+            for start, end in boundaries:
+                datagram = packets[start:end]
+                if self.capture is not None:
+                    self.capture.write(datagram)
+                if self.should_forward:
+                    self.forward_udp_sock.send(datagram)
+
+        return count
+
     def stop(self):
         self.running = False
 
+    def start_workers(self):
+        """ Fork the worker processes. Call it before starting any thread. """
+        for worker in self.workers:
+            worker.start()
+        if self.workers:
+            log.info("Started %s dogstatsd worker%s" % (len(self.workers), plural(len(self.workers))))
+
+    def stop_workers(self):
+        for worker in self.workers:
+            if worker.is_alive():
+                worker.terminate()
+        for worker in self.workers:
+            worker.join(UDP_SOCKET_TIMEOUT * 2)
+
+
+class Worker(multiprocessing.Process):
+    """
+    A dogstatsd worker process. It runs its own `Server` (bound to the same
+    port as the main one with SO_REUSEPORT) and aggregator, and ships the
+    closed buckets of its aggregator to the `Reporter` through `queue`.
+    """
+
+    def __init__(self, server, queue, ship_interval=WORKER_SHIP_INTERVAL):
+        multiprocessing.Process.__init__(self, name='dogstatsd-worker')
+        self.daemon = True
+        self.server = server
+        self.queue = queue
+        self.ship_interval = ship_interval
+
+    def _handle_sigterm(self, signum, frame):
+        self.server.stop()
+
+    def ship(self):
+        self.queue.put(self.server.metrics_aggregator.dump())
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._handle_sigterm)
+        # The parent process handles keyboard interrupts and stops us
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+        finished = threading.Event()
+
+        def ship_loop():
+            while not finished.isSet():
+                finished.wait(self.ship_interval)
+                try:
+                    self.ship()
+                except Exception:
+                    log.exception("Unable to ship aggregates to the reporter")
+
+        shipper = threading.Thread(target=ship_loop, name='dogstatsd-shipper')
+        shipper.daemon = True
+        shipper.start()
+
+        try:
+            self.server.start()
+        finally:
+            finished.set()
+            shipper.join()
+
 
 class Dogstatsd(Daemon):
     """ This class is the dogstatsd daemon. """
@@ -383,6 +1187,9 @@ class Dogstatsd(Daemon):
         # Handle Keyboard Interrupt
         signal.signal(signal.SIGINT, self._handle_sigterm)
 
+        # Fork the workers before starting any thread
+        self.server.start_workers()
+
         # Start the reporting thread before accepting data
         self.reporter.start()
 
@@ -394,7 +1201,8 @@ class Dogstatsd(Daemon):
                 raise e
         finally:
             # The server will block until it's done. Once we're here, shutdown
-            # the reporting thread.
+            # the workers and the reporting thread.
+            self.server.stop_workers()
             self.reporter.stop()
             self.reporter.join()
             log.info("Dogstatsd is stopped")
@@ -432,6 +1240,20 @@ def init(config_path=None, use_watchdog=False, use_forwarder=False, args=None):
     forward_to_host = c.get('statsd_forward_host')
     forward_to_port = c.get('statsd_forward_port')
     event_chunk_size = c.get('event_chunk_size')
+    batch_size = c.get('dogstatsd_batch_size')
+    batch_bytes = c.get('dogstatsd_batch_bytes')
+    worker_count = c.get('dogstatsd_workers', 1)
+    socket_path = c.get('dogstatsd_socket')
+    socket_buffer_size = c.get('dogstatsd_socket_buffer_size')
+    ring_size = c.get('dogstatsd_ring_size')
+    capture_path = c.get('dogstatsd_capture_path')
+    capture_sample_rate = c.get('dogstatsd_capture_sample_rate')
+    capture_max_size = c.get('dogstatsd_capture_max_size')
+    max_payload_size = c.get('dogstatsd_max_payload_size')
+    max_compressed_payload_size = c.get('dogstatsd_max_compressed_payload_size')
+    spool_size = c.get('dogstatsd_spool_size')
+    spool_dir = c.get('dogstatsd_spool_dir') or os.path.join(PidFile.get_dir(), 'dogstatsd-spool')
+    spool_replay_rate = c.get('dogstatsd_spool_replay_rate')
     recent_point_threshold = c.get('recent_point_threshold', None)
 
     target = c['dd_url']
@@ -444,18 +1266,29 @@ def init(config_path=None, use_watchdog=False, use_forwarder=False, args=None):
     # server and reporting threads.
     assert 0 < interval
 
-    aggregator = MetricsBucketAggregator(
-        hostname,
-        aggregator_interval,
-        recent_point_threshold=recent_point_threshold,
-        formatter=get_formatter(c),
-        histogram_aggregates=c.get('histogram_aggregates'),
-        histogram_percentiles=c.get('histogram_percentiles'),
-        utf8_decoding=c['utf8_decoding']
-    )
-
-    # Start the reporting thread.
-    reporter = Reporter(interval, aggregator, target, api_key, use_watchdog, event_chunk_size)
+    def create_aggregator(flush_delay=0):
+        return MetricsBucketAggregator(
+            hostname,
+            aggregator_interval,
+            recent_point_threshold=recent_point_threshold,
+            formatter=get_formatter(c),
+            histogram_aggregates=c.get('histogram_aggregates'),
+            histogram_percentiles=c.get('histogram_percentiles'),
+            utf8_decoding=c['utf8_decoding'],
+            context_cache_size=c.get('dogstatsd_context_cache_size'),
+            histogram_sketch_prefixes=c.get('histogram_sketch_prefixes'),
+            histogram_sketch_accuracy=c.get('histogram_sketch_accuracy'),
+            set_hyperloglog_threshold=c.get('set_hyperloglog_threshold'),
+            set_hyperloglog_precision=c.get('set_hyperloglog_precision'),
+            intern_table_size=c.get('dogstatsd_intern_table_size'),
+            max_contexts=c.get('dogstatsd_max_contexts'),
+            max_contexts_per_metric=c.get('dogstatsd_max_contexts_per_metric'),
+            context_overflow=c.get('dogstatsd_context_overflow', True),
+            cpu_budget=c.get('dogstatsd_cpu_budget'),
+            coalesce_service_checks=c.get('dogstatsd_coalesce_service_checks', False),
+            coalesce_events=c.get('dogstatsd_coalesce_events', False),
+            flush_delay=flush_delay,
+        )
 
     # Start the server on an IPv4 stack
     # Default to loopback
@@ -464,7 +1297,45 @@ def init(config_path=None, use_watchdog=False, use_forwarder=False, args=None):
     if non_local_traffic:
         server_host = ''
 
-    server = Server(aggregator, server_host, port, forward_to_host=forward_to_host, forward_to_port=forward_to_port)
+    def create_server(aggregator, reuse_port=False, workers=None, socket_path=None, capture_path=None):
+        return Server(aggregator, server_host, port, forward_to_host=forward_to_host, forward_to_port=forward_to_port,
+                      batch_size=batch_size, batch_bytes=batch_bytes, reuse_port=reuse_port, workers=workers,
+                      socket_path=socket_path, socket_buffer_size=socket_buffer_size, ring_size=ring_size,
+                      capture_path=capture_path, capture_sample_rate=capture_sample_rate,
+                      capture_max_size=capture_max_size)
+
+    # Optionally spread the ingestion over several processes. The main process
+    # is one of them, and merges the aggregates of the others before flushing.
+    workers = []
+    worker_queue = None
+    if worker_count > 1 and not int(port):
+        log.warning("dogstatsd_workers requires a UDP port to share. Using a single process.")
+    elif worker_count > 1 and not Platform.is_linux():
+        log.warning("dogstatsd_workers requires SO_REUSEPORT, which is only supported on Linux. Using a single process.")
+    elif worker_count > 1:
+        worker_queue = multiprocessing.Queue()
+        workers = [Worker(create_server(create_aggregator(), reuse_port=True), worker_queue)
+                   for _ in xrange(worker_count - 1)]
+
+    # The main aggregator waits for the workers' buckets of an interval before flushing it
+    aggregator = create_aggregator(WORKER_FLUSH_DELAY if workers else 0)
+
+    spool = None
+    if spool_size:
+        try:
+            spool = DiskSpool(spool_dir, spool_size)
+        except (IOError, OSError) as e:
+            log.warning("Unable to spool the failed flushes to %s, they'll be dropped: %s", spool_dir, e)
+
+    # Start the reporting thread.
+    reporter = Reporter(interval, aggregator, target, api_key, use_watchdog, event_chunk_size,
+                        worker_queue=worker_queue, max_payload_size=max_payload_size,
+                        max_compressed_payload_size=max_compressed_payload_size, spool=spool,
+                        spool_replay_rate=spool_replay_rate)
+
+    # Only the main process listens on the unix socket, and captures
+    server = create_server(aggregator, reuse_port=bool(workers), workers=workers, socket_path=socket_path,
+                           capture_path=capture_path)
 
     return reporter, server, c
 
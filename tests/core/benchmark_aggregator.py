@@ -2,7 +2,28 @@
 """
 Performance tests for the agent/dogstatsd metrics aggregator.
 """
-from aggregator import MetricsAggregator, MetricsBucketAggregator
+# stdlib
+import gc
+import random
+import time
+
+# 3p
+import psutil
+
+# project
+from aggregator import (
+    api_formatter,
+    BucketGauge,
+    Counter,
+    COUNTER_KIND,
+    GAUGE_KIND,
+    Histogram,
+    MetricBucket,
+    MetricsAggregator,
+    MetricsBucketAggregator,
+    SketchHistogram,
+)
+from tests.core.test_packet_parser import reference_parse_metric_packet
 
 
 class TestAggregatorPerf(object):
@@ -12,8 +33,56 @@ class TestAggregatorPerf(object):
     METRIC_COUNT = 5
 
     def test_dogstatsd_aggregation_perf(self):
-        ma = MetricsBucketAggregator('my.host')
+        self._dogstatsd_aggregation(MetricsBucketAggregator('my.host'))
+
+    def test_dogstatsd_aggregation_perf_with_context_cache(self):
+        self._dogstatsd_aggregation(MetricsBucketAggregator('my.host', context_cache_size=10000))
+
+    def test_dogstatsd_aggregation_perf_with_interning(self):
+        self._dogstatsd_aggregation(MetricsBucketAggregator('my.host', intern_table_size=100000))
+
+    INTERNED_CONTEXTS = 300000
+
+    def test_interning_memory_perf(self):
+        # Many contexts repeating a few names and tags
+        process = psutil.Process()
+        packets = [
+            'service.%s.requests:1|c|#env:prod,service:web,host_group:%s,endpoint:/api/v%s' % (i % 10, i % 7, i)
+            for i in xrange(self.INTERNED_CONTEXTS)
+        ]
+        # Both aggregators are kept, the second one can't reuse the memory of the first
+        aggregators = []
+        for intern_table_size in (0, 100000):
+            ma = MetricsBucketAggregator('my.host', interval=10, intern_table_size=intern_table_size)
+            aggregators.append(ma)
+            gc.collect()
+            rss = process.memory_info().rss
+            start = time.time()
+            for packet in packets:
+                ma.submit_packets(packet)
+            duration = time.time() - start
+            stored_rss = process.memory_info().rss - rss
+            print "intern_table_size %s: %.0f bytes per context, %.0f packets/s" % (
+                intern_table_size, float(stored_rss) / self.INTERNED_CONTEXTS, len(packets) / duration)
+
+    SHEDDING_PACKETS = 200000
 
+    def test_load_shedding_perf(self):
+        # Hot counter contexts, aggregated at fixed shedding ratios
+        packets = ['service.%s.requests:1|c|#env:prod,endpoint:%s' % (i % 50, i % 20)
+                   for i in xrange(self.SHEDDING_PACKETS)]
+        for ratio in (1, 4, 16):
+            ma = MetricsBucketAggregator('my.host', interval=10, cpu_budget=1)
+            ma.load_shedder.ratio = ratio
+            # Keep the ratio fixed
+            ma.load_shedder.account = lambda start, end, packet_count: None
+            start = time.time()
+            for packet in packets:
+                ma.submit_packets(packet)
+            duration = time.time() - start
+            print "Keeping 1 in %s packets: %.0f packets/s" % (ratio, len(packets) / duration)
+
+    def _dogstatsd_aggregation(self, ma):
         for _ in xrange(self.FLUSH_COUNT):
             for i in xrange(self.LOOPS_PER_FLUSH):
                 for j in xrange(self.METRIC_COUNT):
@@ -38,6 +107,127 @@ class TestAggregatorPerf(object):
 
             ma.flush()
 
+    PARSED_PACKETS = [
+        'counter:1|c',
+        'gauge:12.5|g|#env:prod,role:db',
+        'histogram:250|h|@0.5|#env:prod,role:db,az:us-east-1a',
+        'histogram:250|h|#prod,db,us-east-1a|@0.5',
+        'set:user-1234|s|#env:prod',
+        'multi:1|c|#env:prod:2|c|#env:prod:3|c|#env:prod',
+    ]
+    PARSE_LOOPS = 100000
+
+    def _parse(self, parse):
+        start = time.time()
+        for _ in xrange(self.PARSE_LOOPS):
+            for packet in self.PARSED_PACKETS:
+                parse(packet)
+        return self.PARSE_LOOPS * len(self.PARSED_PACKETS) / (time.time() - start)
+
+    def test_parse_metric_packet_perf(self):
+        ma = MetricsBucketAggregator('my.host')
+        reference = self._parse(lambda packet: reference_parse_metric_packet(packet, ma.ALLOW_STRINGS))
+        single_pass = self._parse(ma.parse_metric_packet)
+        print "split parser: %.0f packets/s, single pass parser: %.0f packets/s" % (reference, single_pass)
+
+    IDLE_CONTEXTS = 200000
+    ACTIVE_CONTEXTS = 100
+
+    def test_flush_with_idle_contexts_perf(self):
+        # Flushes should cost what changed since the last one, not what's
+        # waiting to expire
+        ma = MetricsAggregator('my.host')
+        for i in xrange(self.IDLE_CONTEXTS):
+            ma.gauge('gauge.idle', i, tags=['context:%s' % i])
+            ma.histogram('histogram.idle', i, tags=['context:%s' % i])
+        ma.flush()
+
+        start = time.time()
+        for _ in xrange(self.FLUSH_COUNT):
+            for i in xrange(self.ACTIVE_CONTEXTS):
+                ma.gauge('gauge.active', i, tags=['context:%s' % i])
+            ma.flush()
+        print "%s flushes with %s idle contexts: %.3fs" % (self.FLUSH_COUNT, 2 * self.IDLE_CONTEXTS, time.time() - start)
+
+    BUCKET_CONTEXTS = 1000000
+
+    def test_bucket_memory_perf(self):
+        # A bucket of BUCKET_CONTEXTS gauges and counters, as Metric objects
+        # like before and in the columns of a MetricBucket
+        process = psutil.Process()
+        contexts = [('my.metric', ('context:%s' % i, ), 'my.host', None) for i in xrange(self.BUCKET_CONTEXTS)]
+        half = self.BUCKET_CONTEXTS / 2
+
+        def build_objects():
+            metric_by_context = {}
+            for i, context in enumerate(contexts):
+                metric_class = Counter if i < half else BucketGauge
+                metric = metric_by_context[context] = metric_class(api_formatter, context[0], context[1],
+                                                                   context[2], context[3])
+                metric.sample(i, 1)
+            return metric_by_context
+
+        def flush_objects(metric_by_context):
+            metrics = []
+            for metric in metric_by_context.itervalues():
+                metrics += metric.flush(1000, 10)
+            return metrics
+
+        def build_columns():
+            bucket = MetricBucket()
+            for i, context in enumerate(contexts):
+                bucket.sample_slot(bucket.add_slot(context, COUNTER_KIND if i < half else GAUGE_KIND), i, 1)
+            return bucket
+
+        def flush_columns(bucket):
+            metrics = []
+            MetricsBucketAggregator('my.host', interval=10).flush_columns(bucket, 1000, 0, metrics)
+            return metrics
+
+        for name, build, flush in (('columns', build_columns, flush_columns),
+                                   ('objects', build_objects, flush_objects)):
+            gc.collect()
+            rss = process.memory_info().rss
+            start = time.time()
+            stored = build()
+            build_duration = time.time() - start
+            stored_rss = process.memory_info().rss - rss
+            start = time.time()
+            metrics = flush(stored)
+            flush_duration = time.time() - start
+            assert len(metrics) == self.BUCKET_CONTEXTS
+            print "%s: %.0f MB (%.0f bytes per context), sampled in %.2fs, flushed in %.2fs" % (
+                name, stored_rss / 1e6, float(stored_rss) / self.BUCKET_CONTEXTS, build_duration, flush_duration)
+            del stored, metrics
+
+    HISTOGRAM_SAMPLES = 50000
+
+    def test_histogram_sketch_perf(self):
+        # A hot timer: HISTOGRAM_SAMPLES samples per flush
+        rand = random.Random(42)
+        samples = [rand.lognormvariate(3, 1.5) for _ in xrange(self.HISTOGRAM_SAMPLES)]
+        percentiles = [0.5, 0.95, 0.99]
+        results = {}
+
+        for metric_class in (Histogram, SketchHistogram):
+            histogram = metric_class(lambda **kwargs: kwargs, 'my.histogram', None, 'my.host', None,
+                                     {'percentiles': percentiles})
+            start = time.time()
+            for _ in xrange(self.FLUSH_COUNT):
+                for value in samples:
+                    histogram.sample(value, 1)
+                bins = len(getattr(histogram, 'bins', histogram.samples))
+                metrics = histogram.flush(time.time(), 10)
+            duration = time.time() - start
+            results[metric_class] = dict((m['metric'], m['value']) for m in metrics)
+            print "%s: %.0f samples/s, %s values held before a flush" % (
+                metric_class.__name__, self.FLUSH_COUNT * len(samples) / duration, bins)
+
+        for name, value in sorted(results[Histogram].iteritems()):
+            print "%s: exact %.3f, sketch %.3f (%.3f%% error)" % (
+                name, value, results[SketchHistogram][name],
+                100 * abs(results[SketchHistogram][name] - value) / value)
+
     def test_checksd_aggregation_perf(self):
         ma = MetricsAggregator('my.host')
 
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+Performance tests for the dogstatsd server transports and serialization.
+"""
+# stdlib
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import zlib
+
+# project
+from aggregator import api_formatter, MetricsBucketAggregator
+from dogstatsd import iter_serialized_metrics, Server
+
+
+def free_udp_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class TestTransportPerf(object):
+    """
+    Send the same load to dogstatsd over loopback UDP and over a unix domain
+    datagram socket, and compare the throughput and the packet loss.
+    """
+
+    PACKET_COUNT = 200000
+    PACKET = 'benchmark.counter:1|c|#tag1,tag2'
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def run_server(self, server, client, address):
+        thread = threading.Thread(target=server.start)
+        thread.start()
+        # Let the server bind
+        time.sleep(0.5)
+
+        start = time.time()
+        for _ in xrange(self.PACKET_COUNT):
+            client.sendto(self.PACKET, address)
+        send_duration = time.time() - start
+
+        # Let the server drain its socket
+        received = -1
+        while received != server.metrics_aggregator.count:
+            received = server.metrics_aggregator.count
+            time.sleep(0.5)
+
+        server.stop()
+        client.sendto('', address)
+        thread.join()
+
+        print "%s: sent %s packets in %.2fs (%.0f packets/s), received %s (%.2f%% lost)" % (
+            client.family == socket.AF_UNIX and 'unix socket' or 'loopback UDP',
+            self.PACKET_COUNT, send_duration, self.PACKET_COUNT / send_duration,
+            received, 100.0 * (self.PACKET_COUNT - received) / self.PACKET_COUNT)
+        return received
+
+    def test_udp(self):
+        port = free_udp_port()
+        server = Server(MetricsBucketAggregator('my.host'), '127.0.0.1', port)
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.run_server(server, client, ('127.0.0.1', port))
+
+    def test_udp_with_ring(self):
+        port = free_udp_port()
+        server = Server(MetricsBucketAggregator('my.host'), '127.0.0.1', port, ring_size=4096)
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.run_server(server, client, ('127.0.0.1', port))
+        print "ring: %s datagrams dropped, high water mark %s" % server.ring.reset_stats()
+
+    def test_unix_socket(self):
+        path = os.path.join(self.tmp_dir, 'dogstatsd.sock')
+        server = Server(MetricsBucketAggregator('my.host'), '127.0.0.1', 0, socket_path=path)
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        received = self.run_server(server, client, path)
+        # Senders block instead of dropping packets
+        assert received == self.PACKET_COUNT
+
+
+class TestSerializationPerf(object):
+    """
+    Serialize a large flush at once, then as a stream of size-bounded
+    payloads, and compare the time and the largest payload held in memory.
+    """
+
+    SERIES_COUNT = 200000
+
+    def test_serialization(self):
+        metrics = [api_formatter('benchmark.metric.%s' % (i % 100), i, 1000 + i,
+                                 ('tag1', 'id:%s' % i), 'my.host')
+                   for i in xrange(self.SERIES_COUNT)]
+
+        start = time.time()
+        serialized = json.dumps({'series': metrics})
+        compressed = zlib.compress(serialized)
+        elapsed = time.time() - start
+        print "Single payload: %.2fs, %s bytes (%s compressed) held at once" % \
+            (elapsed, len(serialized) + len(compressed), len(compressed))
+        del serialized, compressed
+
+        for max_size, max_compressed_size in [(None, None), (4 * 1024 * 1024, 2 * 1024 * 1024),
+                                              (1024 * 1024, 256 * 1024)]:
+            start = time.time()
+            count = largest = 0
+            for body, headers in iter_serialized_metrics(metrics, 'my.host', max_size,
+                                                         max_compressed_size):
+                count += 1
+                largest = max(largest, len(body))
+            elapsed = time.time() - start
+            print "Streaming, limits %s/%s: %.2fs, %s payloads, %s bytes held at most" % \
+                (max_size, max_compressed_size, elapsed, count, largest)
+
+
+if __name__ == '__main__':
+    t = TestTransportPerf()
+    for test in (t.test_udp, t.test_udp_with_ring, t.test_unix_socket):
+        t.setUp()
+        try:
+            test()
+        finally:
+            t.tearDown()
+    TestSerializationPerf().test_serialization()
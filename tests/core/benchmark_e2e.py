@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+"""
+End-to-end dogstatsd benchmark: client processes send a synthetic load to
+a `Server`, and a `Reporter` flushes it to a local stub intake, so that
+every stage is covered, from the socket to the HTTP POSTs:
+
+    python tests/core/benchmark_e2e.py --contexts 20000 --types c:40,g:20,h:30,s:10 --json
+
+It reports the sustained packets/s, the flush durations, the payload bytes
+received by the intake and the peak memory of the server.
+"""
+# stdlib
+import math
+import multiprocessing
+import optparse
+import random
+import socket
+import sys
+import threading
+import time
+
+# 3p
+import psutil
+import simplejson as json
+
+# project
+from aggregator import MetricsBucketAggregator
+from dogstatsd import Reporter, Server
+from tests.core.benchmark_dogstatsd import free_udp_port
+from tests.core.test_dogstatsd import StubIntake
+
+METRIC_TYPES = ('c', 'g', 'h', 'ms', 's')
+# Distinct metric names of each type, the contexts are spread over them
+METRIC_NAMES = 50
+# The packets of a client are cycled through, with different values
+MIN_PACKETS = 10000
+
+
+def parse_type_mix(mix):
+    """ The `[(type, weight)]` of a `c:50,g:20,h:30` type mix """
+    weights = []
+    for item in mix.split(','):
+        metric_type, _, weight = item.strip().partition(':')
+        if metric_type not in METRIC_TYPES:
+            raise ValueError("Unknown metric type %r, expected one of %s" % (metric_type, ', '.join(METRIC_TYPES)))
+        weights.append((metric_type, float(weight or 1)))
+    return weights
+
+
+def build_packets(contexts, type_mix, tag_count, sample_rate=1, first_context=0):
+    """
+    Build the packets of a load of `contexts` contexts, numbered from
+    `first_context`, their types drawn from the `type_mix` weights, each
+    with `tag_count` tags. Counters and histograms are sent with `sample_rate`.
+    """
+    rand = random.Random(first_context)
+    total = sum(weight for _, weight in type_mix)
+
+    def draw_type():
+        point = rand.random() * total
+        for metric_type, weight in type_mix:
+            point -= weight
+            if point < 0:
+                return metric_type
+        return type_mix[-1][0]
+
+    context_prefixes = []
+    for i in xrange(first_context, first_context + contexts):
+        metric_type = draw_type()
+        if tag_count:
+            name = 'benchmark.%s.metric%s' % (metric_type, i % METRIC_NAMES)
+            tags = ['context:%s' % i] + ['tag%s:value%s' % (j, j) for j in xrange(1, tag_count)]
+        else:
+            name = 'benchmark.%s.metric%s' % (metric_type, i)
+            tags = []
+        suffix = '|' + metric_type
+        if sample_rate < 1 and metric_type in ('c', 'h', 'ms'):
+            suffix += '|@%s' % sample_rate
+        if tags:
+            suffix += '|#' + ','.join(tags)
+        context_prefixes.append((metric_type, name + ':', suffix))
+
+    packets = []
+    for i in xrange(max(contexts, MIN_PACKETS)):
+        metric_type, prefix, suffix = context_prefixes[i % contexts]
+        if metric_type == 'c':
+            value = '1'
+        elif metric_type == 's':
+            value = 'user%s' % rand.randint(0, 999)
+        else:
+            value = '%.3f' % (rand.random() * 1000)
+        packets.append(prefix + value + suffix)
+    return packets
+
+
+def send_load(address, packets, rate, duration, packets_per_datagram, sent):
+    """
+    Send `packets` to `address` in a loop for `duration` seconds, at
+    `rate` packets per second or as fast as possible if None, and count
+    the packets sent in the `sent` shared value.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    datagrams = ['\n'.join(packets[i:i + packets_per_datagram])
+                 for i in xrange(0, len(packets), packets_per_datagram)]
+    sizes = [datagram.count('\n') + 1 for datagram in datagrams]
+
+    count = 0
+    start = time.time()
+    end = start + duration
+    while time.time() < end:
+        # Paced by bursts of 100 datagrams
+        for i in xrange(0, len(datagrams), 100):
+            for j in xrange(i, min(i + 100, len(datagrams))):
+                try:
+                    sock.sendto(datagrams[j], address)
+                    count += sizes[j]
+                except socket.error:
+                    pass
+            now = time.time()
+            if now >= end:
+                break
+            if rate:
+                delay = float(count) / rate - (now - start)
+                if delay > 0:
+                    time.sleep(delay)
+    sock.close()
+    with sent.get_lock():
+        sent.value += count
+
+
+class TimedReporter(Reporter):
+    """ A reporter recording the duration of its flushes """
+
+    def __init__(self, *args, **kwargs):
+        Reporter.__init__(self, *args, **kwargs)
+        self.flush_durations = []
+
+    def flush(self):
+        start = time.time()
+        Reporter.flush(self)
+        self.flush_durations.append(time.time() - start)
+
+
+def percentile(values, p):
+    """ The `p` percentile of `values`, the nearest rank """
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[max(int(math.ceil(p * len(values))) - 1, 0)]
+
+
+class EndToEndBenchmark(object):
+
+    def __init__(self, contexts=10000, type_mix='c:40,g:20,h:30,s:10', tag_count=3, sample_rate=1,
+                 clients=1, rate=None, duration=20, flush_interval=2, packets_per_datagram=1,
+                 intake_delay=0, aggregator_options=None):
+        self.contexts = contexts
+        self.type_mix = parse_type_mix(type_mix)
+        self.tag_count = tag_count
+        self.sample_rate = sample_rate
+        self.clients = clients
+        self.rate = rate
+        self.duration = duration
+        self.flush_interval = flush_interval
+        self.packets_per_datagram = packets_per_datagram
+        self.intake_delay = intake_delay
+        self.aggregator_options = aggregator_options or {}
+
+        self.rss_max = 0
+        self.process = psutil.Process()
+
+    def received_count(self):
+        aggregator = self.aggregator
+        return aggregator.total_count + aggregator.count
+
+    def sample_memory(self, finished):
+        while not finished.wait(0.1) and not finished.isSet():
+            self.rss_max = max(self.rss_max, self.process.memory_info().rss)
+
+    def run(self):
+        # The contexts are split between the clients
+        client_contexts = max(self.contexts // self.clients, 1)
+        loads = [build_packets(client_contexts, self.type_mix, self.tag_count, self.sample_rate,
+                               first_context=i * client_contexts) for i in xrange(self.clients)]
+
+        intake = StubIntake(self.intake_delay, keep_bodies=False)
+        port = free_udp_port()
+        self.aggregator = MetricsBucketAggregator('benchmark.host', interval=self.flush_interval,
+                                                  **self.aggregator_options)
+        server = Server(self.aggregator, '127.0.0.1', port)
+        reporter = TimedReporter(self.flush_interval, self.aggregator, intake.url, 'apikey')
+
+        server_thread = threading.Thread(target=server.start)
+        server_thread.start()
+        finished = threading.Event()
+        sampler = threading.Thread(target=self.sample_memory, args=(finished,))
+        sampler.start()
+        sent = multiprocessing.Value('L', 0)
+        try:
+            while not server.running:
+                time.sleep(0.01)
+            reporter.start()
+
+            rate = float(self.rate) / self.clients if self.rate else None
+            senders = [multiprocessing.Process(target=send_load,
+                                               args=(('127.0.0.1', port), packets, rate, self.duration,
+                                                     self.packets_per_datagram, sent))
+                       for packets in loads]
+            start = time.time()
+            for sender in senders:
+                sender.start()
+            for sender in senders:
+                sender.join()
+            elapsed = time.time() - start
+
+            # Let the server drain its socket
+            received = self.received_count()
+            while True:
+                time.sleep(0.5)
+                if self.received_count() == received:
+                    break
+                received = self.received_count()
+        finally:
+            reporter.stop()
+            if reporter.is_alive():
+                reporter.join()
+            server.stop()
+            wakeup = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            wakeup.sendto('', ('127.0.0.1', port))
+            wakeup.close()
+            server_thread.join()
+            finished.set()
+            sampler.join()
+            intake.stop()
+
+        sent = sent.value
+        received = self.received_count()
+        durations = reporter.flush_durations
+        payloads = dict((path.rsplit('/', 1)[-1], {'payloads': stats[0], 'bytes': stats[1], 'raw_bytes': stats[2]})
+                        for path, stats in intake.stats.iteritems())
+        return {
+            'duration': round(elapsed, 3),
+            'contexts': self.contexts,
+            'packets_sent': sent,
+            'packets_received': received,
+            'drop_rate': round(1 - float(received) / sent, 4) if sent else 0,
+            'packets_per_second': round(received / elapsed, 1) if elapsed > 0 else 0,
+            'flush_count': len(durations),
+            'flush_duration_avg': round(sum(durations) / len(durations), 4) if durations else 0,
+            'flush_duration_p99': round(percentile(durations, 0.99), 4),
+            'flush_duration_max': round(max(durations), 4) if durations else 0,
+            'payloads': payloads,
+            'payload_bytes': sum(stats['bytes'] for stats in payloads.itervalues()),
+            'rss_max': self.rss_max,
+        }
+
+
+class TestEndToEndPerf(object):
+
+    def test_end_to_end(self):
+        results = EndToEndBenchmark(duration=10).run()
+        print json.dumps(results, indent=2, sort_keys=True)
+
+
+def main():
+    parser = optparse.OptionParser("%prog [options]")
+    parser.add_option('--contexts', type='int', default=10000)
+    parser.add_option('--types', default='c:40,g:20,h:30,s:10',
+                      help="Weights of the metric types, among %s" % ', '.join(METRIC_TYPES))
+    parser.add_option('--tags', type='int', default=3, help="Tags per packet")
+    parser.add_option('--sample-rate', type='float', default=1,
+                      help="Sample rate of the counters and histograms")
+    parser.add_option('--clients', type='int', default=1, help="Client processes")
+    parser.add_option('--rate', type='float', default=None,
+                      help="Packets per second sent by all the clients, as fast as possible by default")
+    parser.add_option('--duration', type='float', default=20)
+    parser.add_option('--flush-interval', type='int', default=2)
+    parser.add_option('--packets-per-datagram', type='int', default=1)
+    parser.add_option('--intake-delay', type='float', default=0,
+                      help="Seconds the intake waits before answering")
+    parser.add_option('--context-cache-size', type='int', default=0)
+    parser.add_option('--json', action='store_true', default=False, help="Print the results as JSON")
+    opts, args = parser.parse_args()
+    # The agent config, loaded for the hostname, parses the command line too
+    sys.argv = sys.argv[:1]
+
+    benchmark = EndToEndBenchmark(
+        contexts=opts.contexts, type_mix=opts.types, tag_count=opts.tags, sample_rate=opts.sample_rate,
+        clients=opts.clients, rate=opts.rate, duration=opts.duration, flush_interval=opts.flush_interval,
+        packets_per_datagram=opts.packets_per_datagram, intake_delay=opts.intake_delay,
+        aggregator_options={'context_cache_size': opts.context_cache_size})
+    results = benchmark.run()
+    if opts.json:
+        print json.dumps(results, sort_keys=True)
+        return
+
+    print "Sent %(packets_sent)s packets of %(contexts)s contexts in %(duration)ss" % results
+    print "Received %(packets_received)s, drop rate %(drop_rate).2f%%, %(packets_per_second)s packets/s" % \
+        dict(results, drop_rate=results['drop_rate'] * 100)
+    print "Flushes: %(flush_count)s, %(flush_duration_avg)ss avg, %(flush_duration_p99)ss p99, " \
+        "%(flush_duration_max)ss max" % results
+    for endpoint, stats in sorted(results['payloads'].iteritems()):
+        print "Payloads to %s: %s, %s bytes (%s uncompressed)" % (
+            endpoint, stats['payloads'], stats['bytes'], stats['raw_bytes'])
+    print "Max RSS: %.1f MB" % (results['rss_max'] / 1024.0 / 1024)
+
+
+if __name__ == '__main__':
+    main()
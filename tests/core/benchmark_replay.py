@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""
+Replay a dogstatsd capture (see `dogstatsd_capture_path`) into a local
+dogstatsd server, and report how it kept up with it:
+
+    python tests/core/benchmark_replay.py dogstatsd.capture --speed 10x
+
+The capture is sent at its original pace (1x), N times faster (Nx) or as
+fast as possible (max), from another process. The aggregator is flushed
+every flush interval, and its series serialized, like the reporter does.
+"""
+# stdlib
+import multiprocessing
+import optparse
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+
+# 3p
+import psutil
+import simplejson as json
+
+# project
+from aggregator import MetricsBucketAggregator
+from dogstatsd import iter_serialized_metrics, read_capture, Server
+from tests.core.benchmark_dogstatsd import free_udp_port
+
+
+def parse_speed(speed):
+    """ The speed factor of `1x`, `10x`..., None for `max` """
+    if speed == 'max':
+        return None
+    speed = float(speed.rstrip('x'))
+    if speed <= 0:
+        raise ValueError("The speed must be positive")
+    return speed
+
+
+def send_capture(path, address, speed, family=socket.AF_INET, started=None):
+    """
+    Send the datagrams of a capture to `address`, at `speed` times their
+    pace. `started` is set once they're loaded, when the sending starts.
+    """
+    sock = socket.socket(family, socket.SOCK_DGRAM)
+    datagrams = list(read_capture(path))
+    if started is not None:
+        started.set()
+    if not datagrams:
+        return
+    first_timestamp = datagrams[0][0]
+    start = time.time()
+    for timestamp, datagram in datagrams:
+        if speed is not None:
+            delay = (timestamp - first_timestamp) / speed - (time.time() - start)
+            # Sleeping less than a millisecond isn't accurate, catch up later
+            if delay > 0.001:
+                time.sleep(delay)
+        try:
+            sock.sendto(datagram, address)
+        except socket.error:
+            # Full unix socket buffer, or nothing listening anymore
+            pass
+    sock.close()
+
+
+class Replayer(object):
+
+    def __init__(self, capture_path, speed=None, flush_interval=10, unix_socket=False,
+                 ring_size=None, batch_size=None, aggregator_options=None):
+        self.capture_path = capture_path
+        self.speed = speed
+        self.flush_interval = flush_interval
+        self.unix_socket = unix_socket
+        self.ring_size = ring_size
+        self.batch_size = batch_size
+        self.aggregator_options = aggregator_options or {}
+
+        self.flush_latencies = []
+        self.rss_max = 0
+        self.process = psutil.Process()
+
+    def received_count(self):
+        aggregator = self.aggregator
+        return aggregator.total_count + aggregator.count + aggregator.event_count + \
+            aggregator.service_check_count
+
+    def flush(self):
+        start = time.time()
+        metrics = self.aggregator.flush()
+        self.aggregator.flush_events()
+        self.aggregator.flush_service_checks()
+        for _ in iter_serialized_metrics(metrics, 'replay.host'):
+            pass
+        self.flush_latencies.append(time.time() - start)
+        self.rss_max = max(self.rss_max, self.process.memory_info().rss)
+
+    def flush_loop(self, finished):
+        while not finished.wait(self.flush_interval) and not finished.isSet():
+            self.flush()
+
+    def run(self):
+        sent = datagrams = 0
+        first_timestamp = last_timestamp = None
+        for timestamp, datagram in read_capture(self.capture_path):
+            datagrams += 1
+            sent += sum(1 for packet in datagram.splitlines() if packet.strip())
+            if first_timestamp is None:
+                first_timestamp = timestamp
+            last_timestamp = timestamp
+        duration = last_timestamp - first_timestamp if datagrams else 0
+
+        tmp_dir = tempfile.mkdtemp()
+        self.aggregator = MetricsBucketAggregator('replay.host', interval=self.flush_interval,
+                                                  **self.aggregator_options)
+        if self.unix_socket:
+            socket_path = os.path.join(tmp_dir, 'dogstatsd.sock')
+            server = Server(self.aggregator, '127.0.0.1', 0, socket_path=socket_path,
+                            ring_size=self.ring_size, batch_size=self.batch_size)
+            address, family = socket_path, socket.AF_UNIX
+        else:
+            port = free_udp_port()
+            server = Server(self.aggregator, '127.0.0.1', port, ring_size=self.ring_size,
+                            batch_size=self.batch_size)
+            address, family = ('127.0.0.1', port), socket.AF_INET
+
+        server_thread = threading.Thread(target=server.start)
+        server_thread.start()
+        finished = threading.Event()
+        flusher = threading.Thread(target=self.flush_loop, args=(finished,))
+        try:
+            while not server.running:
+                time.sleep(0.01)
+            flusher.start()
+
+            started = multiprocessing.Event()
+            sender = multiprocessing.Process(target=send_capture,
+                                             args=(self.capture_path, address, self.speed, family, started))
+            sender.start()
+            started.wait()
+            start = time.time()
+            sender.join()
+
+            # Wait for the server to be done with what it received
+            received = self.received_count()
+            last_received = time.time()
+            while time.time() - last_received < 0.5:
+                time.sleep(0.05)
+                if self.received_count() != received:
+                    received = self.received_count()
+                    last_received = time.time()
+            elapsed = last_received - start
+        finally:
+            finished.set()
+            if flusher.is_alive():
+                flusher.join()
+            server.stop()
+            wakeup = socket.socket(family, socket.SOCK_DGRAM)
+            wakeup.sendto('', address)
+            wakeup.close()
+            server_thread.join()
+            shutil.rmtree(tmp_dir)
+
+        self.flush()
+        received = self.received_count()
+        return {
+            'datagrams': datagrams,
+            'capture_duration': round(duration, 3),
+            'replay_duration': round(elapsed, 3),
+            'packets_sent': sent,
+            'packets_received': received,
+            'drop_rate': round(1 - float(received) / sent, 4) if sent else 0,
+            'packets_per_second': round(received / elapsed, 1) if elapsed > 0 else 0,
+            'flush_count': len(self.flush_latencies),
+            'flush_latency_avg': round(sum(self.flush_latencies) / len(self.flush_latencies), 4),
+            'flush_latency_max': round(max(self.flush_latencies), 4),
+            'rss_max': self.rss_max,
+        }
+
+
+def main():
+    parser = optparse.OptionParser("%prog <capture> [options]")
+    parser.add_option('--speed', default='1x', help="1x, 10x... or max")
+    parser.add_option('--flush-interval', type='float', default=10)
+    parser.add_option('--unix-socket', action='store_true', default=False,
+                      help="Replay over a unix socket rather than UDP")
+    parser.add_option('--ring-size', type='int', default=None)
+    parser.add_option('--batch-size', type='int', default=None)
+    parser.add_option('--context-cache-size', type='int', default=0)
+    parser.add_option('--json', action='store_true', default=False, help="Print the results as JSON")
+    opts, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error("A capture file is required")
+
+    replayer = Replayer(args[0], speed=parse_speed(opts.speed), flush_interval=opts.flush_interval,
+                        unix_socket=opts.unix_socket, ring_size=opts.ring_size, batch_size=opts.batch_size,
+                        aggregator_options={'context_cache_size': opts.context_cache_size})
+    results = replayer.run()
+    if opts.json:
+        print json.dumps(results, sort_keys=True)
+        return
+
+    print "Replayed %(datagrams)s datagrams (%(capture_duration)ss of traffic) in %(replay_duration)ss" % results
+    print "Packets: %(packets_sent)s sent, %(packets_received)s received, drop rate %(drop_rate).2f%%" % \
+        dict(results, drop_rate=results['drop_rate'] * 100)
+    print "Throughput: %(packets_per_second)s packets/s" % results
+    print "Flushes: %(flush_count)s, latency %(flush_latency_avg)ss avg, %(flush_latency_max)ss max" % results
+    print "Max RSS: %.1f MB" % (results['rss_max'] / 1024.0 / 1024)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+Performance tests for the forwarder transaction manager, with a queue of
+transactions built up during an intake outage.
+"""
+# stdlib
+from datetime import timedelta
+import time
+
+# project
+from transaction import Transaction, TransactionManager
+from util import get_tornado_ioloop
+
+
+class OutageTransaction(Transaction):
+    """ A transaction failing while `outage` is set """
+
+    outage = True
+
+    def __init__(self, size, manager):
+        Transaction.__init__(self)
+        self._trManager = manager
+        self._size = size
+
+    def flush(self):
+        if OutageTransaction.outage:
+            self._trManager.tr_error(self)
+        else:
+            self._trManager.tr_success(self)
+
+
+class DelayedTransaction(Transaction):
+    """ A transaction answered `latency` seconds after it's sent, on the IOLoop """
+
+    latency = 0
+
+    def __init__(self, manager):
+        Transaction.__init__(self)
+        self._trManager = manager
+        self._size = 1000
+
+    def flush(self):
+        get_tornado_ioloop().add_timeout(time.time() + self.latency, self.on_response)
+
+    def on_response(self):
+        self._trManager.tr_success(self)
+        self._trManager.flush_next()
+        if not self._trManager.get_transactions():
+            get_tornado_ioloop().stop()
+
+
+class TestTransactionManagerPerf(object):
+
+    TRANSACTION_COUNT = 100000
+    TRANSACTION_SIZE = 1000
+    EVICTION_COUNT = 1000
+    SUCCESS_COUNT = 10000
+
+    def run_flush(self, manager):
+        """ A flush and all the transactions it sends, without an IOLoop """
+        manager.flush()
+        while manager._trs_to_flush is not None:
+            manager.flush_next()
+
+    def test_outage_perf(self):
+        OutageTransaction.outage = True
+        manager = TransactionManager(timedelta(seconds=90), self.TRANSACTION_COUNT * self.TRANSACTION_SIZE,
+                                     timedelta(seconds=0))
+
+        start = time.time()
+        for _ in xrange(self.TRANSACTION_COUNT):
+            manager.append(OutageTransaction(self.TRANSACTION_SIZE, manager))
+        print "Queued %s transactions in %.3fs" % (self.TRANSACTION_COUNT, time.time() - start)
+
+        # Make them all due
+        for tr in manager.get_transactions():
+            tr._next_flush -= timedelta(seconds=1)
+        start = time.time()
+        self.run_flush(manager)
+        print "Flushed and failed %s transactions in %.3fs" % (self.TRANSACTION_COUNT, time.time() - start)
+
+        # Nothing is due during the outage, every tick still looks for something to flush
+        start = time.time()
+        for _ in xrange(10):
+            manager.flush()
+        print "10 flushes with nothing due in %.3fs" % (time.time() - start)
+
+        # The queue is full, every new transaction evicts an old one
+        start = time.time()
+        for _ in xrange(self.EVICTION_COUNT):
+            manager.append(OutageTransaction(self.TRANSACTION_SIZE, manager))
+        print "Queued %s transactions over the limit in %.3fs" % (self.EVICTION_COUNT, time.time() - start)
+        assert len(manager.get_transactions()) == self.TRANSACTION_COUNT
+
+        # The intake is back
+        OutageTransaction.outage = False
+        transactions = manager.get_transactions()[:self.SUCCESS_COUNT]
+        start = time.time()
+        for tr in transactions:
+            manager.tr_success(tr)
+        print "Completed %s transactions in %.3fs" % (self.SUCCESS_COUNT, time.time() - start)
+
+    DRAIN_COUNT = 1000
+    INTAKE_LATENCY = 0.02
+
+    def test_drain_perf(self):
+        # A backlog queued during an outage, sent once the intake is back
+        DelayedTransaction.latency = self.INTAKE_LATENCY
+        for max_in_flight in (1, 4, 8, 16):
+            manager = TransactionManager(timedelta(seconds=90), 30 * 1024 * 1024, timedelta(seconds=0.5),
+                                         max_in_flight)
+            for _ in xrange(self.DRAIN_COUNT):
+                manager.append(DelayedTransaction(manager))
+            for tr in manager.get_transactions():
+                tr._next_flush -= timedelta(seconds=1)
+
+            ioloop = get_tornado_ioloop()
+            ioloop.add_callback(manager.flush)
+            start = time.time()
+            ioloop.start()
+            duration = time.time() - start
+            print "Drained %s transactions (%.0fms intake latency) with up to %s in flight " \
+                "in %.2fs: %.0f transactions/s" % (self.DRAIN_COUNT, self.INTAKE_LATENCY * 1000,
+                                                   max_in_flight, duration, self.DRAIN_COUNT / duration)
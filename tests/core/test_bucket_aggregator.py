@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 # stdlib
+import cPickle as pickle
 import random
+import threading
 import time
 import unittest
 
@@ -1034,3 +1036,147 @@ class TestUnitMetricsBucketAggregator(unittest.TestCase):
         stats = MetricsBucketAggregator('myhost', interval=5)
         nt.assert_equal(stats.calculate_bucket_start(13284287), 13284285)
         nt.assert_equal(stats.calculate_bucket_start(13284280), 13284280)
+
+    def test_merge(self):
+        # Aggregates sharded over several aggregators and merged back together
+        # must be the same as if a single aggregator had received everything
+        ag_interval = self.interval
+        packets = [
+            'my.counter:1|c', 'my.counter:2|c|@0.5', 'my.counter:3|c',
+            'my.gauge:1|g', 'my.gauge:2|g', 'my.gauge:3|g',
+            'my.set:a|s', 'my.set:b|s', 'my.set:a|s', 'my.set:c|s',
+            'my.histogram:1|h', 'my.histogram:5|h', 'my.histogram:2|h|#t1',
+            'my.histogram:7|h', 'my.histogram:3|h', 'my.histogram:4|h|#t1',
+            '_e{5,4}:title|text', '_sc|my.check|0',
+        ]
+        reference = MetricsBucketAggregator('myhost', interval=ag_interval)
+        main = MetricsBucketAggregator('myhost', interval=ag_interval)
+        workers = [MetricsBucketAggregator('myhost', interval=ag_interval) for _ in range(2)]
+        shards = [main] + workers
+
+        self.wait_for_bucket_boundary(ag_interval)
+        for i, packet in enumerate(packets):
+            reference.submit_packets(packet)
+            shards[i % len(shards)].submit_packets(packet)
+
+        self.sleep_for_interval_length(ag_interval)
+        for worker in workers:
+            # Payloads go through a multiprocessing queue, so they must be picklable
+            main.merge(pickle.loads(pickle.dumps(worker.dump())))
+
+        nt.assert_equal(self.sort_metrics(main.flush()), self.sort_metrics(reference.flush()))
+        nt.assert_equal(main.flush_events(), reference.flush_events())
+        nt.assert_equal(main.flush_service_checks(), reference.flush_service_checks())
+        nt.assert_equal(main.total_count, reference.total_count)
+
+    def test_merge_delayed_flush(self):
+        # The buckets are held for the flush delay, for the worker buckets of
+        # the same interval to be merged before they're flushed
+        ag_interval = self.interval
+        main = MetricsBucketAggregator('myhost', interval=ag_interval, flush_delay=ag_interval)
+        worker = MetricsBucketAggregator('myhost', interval=ag_interval)
+
+        self.wait_for_bucket_boundary(ag_interval)
+        main.submit_packets('my.counter:1|c')
+        worker.submit_packets('my.counter:1|c')
+        self.sleep_for_interval_length(ag_interval)
+        nt.assert_equal(main.flush(), [])
+
+        main.merge(worker.dump())
+        self.sleep_for_interval_length(ag_interval)
+        metrics = main.flush()
+        nt.assert_equal(len(metrics), 1)
+        nt.assert_equal(metrics[0]['points'][0][1], 2.0 / ag_interval)
+
+    def test_merge_late_bucket(self):
+        # A worker bucket shipped after its interval was flushed is counted
+        # in the next one, not flushed as a second point of the same timestamp
+        ag_interval = self.interval
+        main = MetricsBucketAggregator('myhost', interval=ag_interval)
+        worker = MetricsBucketAggregator('myhost', interval=ag_interval)
+
+        self.wait_for_bucket_boundary(ag_interval)
+        main.submit_packets('my.counter:1|c')
+        worker.submit_packets('my.counter:1|c')
+        self.sleep_for_interval_length(ag_interval)
+        first = main.flush()
+        nt.assert_equal(len(first), 1)
+
+        main.merge(worker.dump())
+        self.sleep_for_interval_length(ag_interval)
+        second = main.flush()
+        nt.assert_equal(len(second), 1)
+        nt.assert_equal(second[0]['points'][0][1], 1.0 / ag_interval)
+        nt.assert_true(second[0]['points'][0][0] > first[0]['points'][0][0])
+
+    def test_dump_keeps_open_buckets(self):
+        stats = MetricsBucketAggregator('myhost', interval=10)
+        stats.submit_packets('my.counter:1|c')
+        # The current bucket is still open, it's not shipped yet
+        nt.assert_equal(stats.dump()['buckets'], {})
+        nt.assert_equal(len(stats.metric_by_bucket), 1)
+
+    def test_columns(self):
+        stats = MetricsBucketAggregator('myhost', interval=10)
+        stats.submit_packets('my.counter:1|c|#b,a\nmy.counter:2|c|@0.5|#a,b\nmy.gauge:1|g\nmy.gauge:5|g')
+        stats.submit_packets('my.histogram:1|h\nmy.histogram:2|c')
+        # Gauges and counters are in the columns of the bucket, the other metrics are objects
+        bucket = stats.current_mbc
+        nt.assert_equal(sorted(bucket.slot_by_context), [('my.counter', ('a', 'b'), 'myhost', None),
+                                                         ('my.gauge', (), 'myhost', None)])
+        nt.assert_equal(bucket.metric_by_context.keys(), [('my.histogram', (), 'myhost', None)])
+
+        metrics = []
+        stats.flush_columns(bucket, 1000, 0, metrics)
+        nt.assert_equal(self.sort_metrics(metrics), [
+            {'metric': 'my.counter', 'points': [(1000, 0.5)], 'tags': ('a', 'b'), 'host': 'myhost',
+             'device_name': None, 'type': 'rate', 'interval': 10},
+            {'metric': 'my.gauge', 'points': [(1000, 5)], 'tags': None, 'host': 'myhost',
+             'device_name': None, 'type': 'gauge', 'interval': 10},
+        ])
+
+    def test_columns_integers(self):
+        # The integer values stay exact integers, even above 2^53
+        stats = MetricsBucketAggregator('myhost', interval=10)
+        stats.submit_packets('my.gauge:9007199254740993|g\nother.gauge:5|g\nmy.counter:9007199254740993|c')
+        metrics = []
+        stats.flush_columns(stats.current_mbc, 1000, 0, metrics)
+        values = dict((m['metric'], m['points'][0][1]) for m in metrics)
+        nt.assert_equal(values['my.gauge'], 9007199254740993)
+        nt.assert_true(isinstance(values['my.gauge'], (int, long)))
+        nt.assert_equal(values['other.gauge'], 5)
+        nt.assert_true(isinstance(values['other.gauge'], int))
+
+    def test_concurrent_flush(self):
+        # The reporter thread flushes while the server thread submits: every
+        # sample must be flushed once, whatever the bucket it lands in
+        ag_interval = 0.05
+        stats = MetricsBucketAggregator('myhost', interval=ag_interval)
+        packet_count = 50000
+        submitted = threading.Event()
+        metrics = []
+
+        def submit():
+            for i in xrange(packet_count):
+                stats.submit_packets('my.counter:1|c\nmy.histogram:%s|h' % i)
+            submitted.set()
+
+        def flush():
+            while not submitted.isSet():
+                metrics.extend(stats.flush())
+
+        threads = [threading.Thread(target=submit), threading.Thread(target=flush)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.sleep_for_interval_length(ag_interval)
+        metrics.extend(stats.flush())
+
+        def total(name):
+            # Counts are flushed as rates
+            return sum(int(round(m['points'][0][1] * ag_interval)) for m in metrics if m['metric'] == name)
+
+        nt.assert_equal(total('my.counter'), packet_count)
+        nt.assert_equal(total('my.histogram.count'), packet_count)
+        nt.assert_equal(stats.total_count, 2 * packet_count)
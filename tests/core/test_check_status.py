@@ -6,6 +6,8 @@ from checks import AgentCheck
 from checks.check_status import (
     CheckStatus,
     CollectorStatus,
+    DogstatsdStatus,
+    ForwarderStatus,
     InstanceStatus,
     STATUS_ERROR,
     STATUS_OK,
@@ -70,3 +72,78 @@ def test_persistence_fail():
 
     status = CollectorStatus.load_latest_status()
     assert not status
+
+
+def test_dogstatsd_context_limiter_status():
+    status = DogstatsdStatus(context_limiter_stats={
+        'contexts': 100,
+        'rejected': 12,
+        'top_rejected': [('my.metric', 10), ('other.metric', 2)],
+    })
+    lines = status.body_lines()
+    nt.assert_equal(lines[-4:], [
+        "Context count: 100",
+        "Samples over the context limits: 12",
+        "  my.metric: 10",
+        "  other.metric: 2",
+    ])
+    nt.assert_equal(status.to_dict()['context_limiter_stats']['rejected'], 12)
+    # No limits, no lines
+    nt.assert_false(any('context' in line for line in DogstatsdStatus().body_lines()))
+
+
+def test_dogstatsd_latency_status():
+    status = DogstatsdStatus(latency_stats={
+        'series': {'count': 2, 'avg': 12.5, 'max': 20.1},
+        'intake': {'count': 1, 'avg': 8.0, 'max': 8.0},
+    })
+    nt.assert_equal(status.body_lines()[-3:], [
+        "Latency of the last flush:",
+        "  intake: 1 request, 8.0ms avg, 8.0ms max",
+        "  series: 2 requests, 12.5ms avg, 20.1ms max",
+    ])
+
+
+def test_dogstatsd_spool_status():
+    status = DogstatsdStatus(spool_stats={
+        'records': 12, 'size': 40960, 'segments': 1, 'spooled': 20, 'replayed': 8,
+        'evicted': 0, 'corrupted': 0,
+    })
+    nt.assert_equal(status.body_lines()[-2:], [
+        "Spooled payloads: 12 (40960 bytes in 1 segment)",
+        "Spool replay: 20 spooled, 8 replayed, 0 evicted since startup",
+    ])
+    nt.assert_false(any('Spool' in line for line in DogstatsdStatus().body_lines()))
+
+
+def test_forwarder_window_status():
+    status = ForwarderStatus(queue_length=120, flush_count=3, in_flight=4, window=6, drain_rate=12.25)
+    lines = status.body_lines()
+    nt.assert_true("Transactions in flight: 4 (window of 6)" in lines)
+    nt.assert_true("Drain rate: 12.2 transactions/s" in lines)
+    nt.assert_equal(status.to_dict()['in_flight'], 4)
+
+
+def test_forwarder_eviction_status():
+    status = ForwarderStatus(size_by_priority={'low': 1000, 'normal': 200, 'high': 34},
+                             evicted={'low': 10, 'normal': 2, 'high': 0})
+    lines = status.body_lines()
+    nt.assert_true("Queue Size by priority: low 1000 bytes, normal 200 bytes, high 34 bytes" in lines)
+    nt.assert_true("Transactions evicted: 12 (low 10, normal 2, high 0)" in lines)
+
+
+def test_forwarder_spool_status():
+    status = ForwarderStatus(spool_stats={
+        'records': 3, 'size': 2048, 'segments': 2, 'spooled': 5, 'replayed': 2,
+        'evicted': 0, 'corrupted': 0,
+    })
+    lines = status.body_lines()
+    nt.assert_true("Spooled transactions: 3 (2048 bytes in 2 segments)" in lines)
+    nt.assert_true("Spool replay: 5 spooled, 2 replayed, 0 evicted since startup" in lines)
+    nt.assert_false(any('Spool' in line for line in ForwarderStatus().body_lines()))
+
+
+def test_forwarder_batch_status():
+    status = ForwarderStatus(batch_sizes=[['1', 2], ['2', 0], ['3-4', 3]])
+    nt.assert_true("Batches sent: 5 (by transactions per batch: 1: 2, 2: 0, 3-4: 3)" in status.body_lines())
+    nt.assert_false(any('Batches' in line for line in ForwarderStatus().body_lines()))
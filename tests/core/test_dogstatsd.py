@@ -1,6 +1,11 @@
 # -*- coding: utf-8 -*-
 # stdlib
+import os
 import random
+import shutil
+import socket
+import tempfile
+import threading
 import time
 import unittest
 
@@ -9,7 +14,7 @@ from nose.plugins.attrib import attr
 import nose.tools as nt
 
 # project
-from aggregator import DEFAULT_HISTOGRAM_AGGREGATES, get_formatter, MetricsAggregator
+from aggregator import DEFAULT_HISTOGRAM_AGGREGATES, get_formatter, MetricsAggregator, MetricsBucketAggregator
 
 
 class TestUnitDogStatsd(unittest.TestCase):
@@ -170,6 +175,60 @@ class TestUnitDogStatsd(unittest.TestCase):
         serialized = dogstatsd.serialize_metrics([api_formatter("foo", 12, 1, ('tag',), 'host')], "test-host")
         assert '"tags": ["tag"]' in serialized[0]
 
+    def test_serialization_limits(self):
+        import json
+        import zlib
+        import dogstatsd
+        from aggregator import api_formatter
+
+        metrics = [api_formatter("my.metric.%s" % (i % 50), i, 1000 + i, ('id:%s' % i,), 'host')
+                   for i in xrange(20000)]
+
+        # A single payload without limits, compressed like before
+        payloads = list(dogstatsd.iter_serialized_metrics(metrics, "test-host"))
+        nt.assert_equal(len(payloads), 1)
+        body, headers = payloads[0]
+        nt.assert_equal(headers['Content-Encoding'], 'deflate')
+        series = json.loads(zlib.decompress(body))['series']
+        nt.assert_equal(series[:-1], json.loads(json.dumps(metrics)))
+        nt.assert_equal(series[-1]['metric'], 'datadog.dogstatsd.serialization_status')
+
+        for max_size, max_compressed_size in [(100000, None), (None, 20000), (200000, 30000)]:
+            payloads = list(dogstatsd.iter_serialized_metrics(metrics, "test-host", max_size,
+                                                              max_compressed_size))
+            assert len(payloads) > 1
+            sent = []
+            for body, headers in payloads:
+                if max_compressed_size:
+                    assert len(body) <= max_compressed_size
+                body = zlib.decompress(body)
+                if max_size:
+                    assert len(body) <= max_size
+                series = json.loads(body)['series']
+                nt.assert_equal(series[-1]['metric'], 'datadog.dogstatsd.serialization_status')
+                nt.assert_equal(series[-1]['tags'], ['status:success'])
+                sent.extend(series[:-1])
+            # Every series is sent once, in order
+            nt.assert_equal(sent, json.loads(json.dumps(metrics)))
+
+        # Small payloads stay uncompressed
+        body, headers = dogstatsd.serialize_metrics(metrics[:1], "test-host")
+        assert 'Content-Encoding' not in headers
+        nt.assert_equal(json.loads(body)['series'][0]['metric'], 'my.metric.0')
+
+    def test_serialization_status(self):
+        import json
+        import dogstatsd
+        from aggregator import api_formatter
+
+        metrics = [api_formatter("foo", 1, 1000, ('tag:\xe9',), 'host'),
+                   api_formatter("bar", 1, 1000, ('tag',), 'host')]
+        body, headers = dogstatsd.serialize_metrics(metrics, "test-host")
+        series = json.loads(body)['series']
+        # The invalid characters are replaced
+        nt.assert_equal([s['metric'] for s in series[:-1]], ['foo', 'bar'])
+        nt.assert_equal(series[-1]['tags'], ['status:failure'])
+
     def test_counter(self):
         stats = MetricsAggregator('myhost')
 
@@ -509,6 +568,37 @@ class TestUnitDogStatsd(unittest.TestCase):
             else:
                 assert False, 'invalid : %s' % packet
 
+    def test_context_cache(self):
+        # The context cache must not change what gets aggregated
+        packets = [
+            'my.counter:1|c', 'my.counter:2|c', 'my.counter:3|c|@0.5',
+            'my.gauge:1|g|#b,a', 'my.gauge:2.5|g|#b,a', 'my.gauge:3|g|#a,b',
+            'my.gauge:4|g|#a,a,b',
+            'my.gauge:5|g|#host:other,device:sda,a', 'my.gauge:6|g|#host:other,device:sda,a',
+            'my.set:a|s|#k:v', 'my.set:b|s|#k:v', 'my.set:a|s|#k:v',
+            'my.histogram:1|h|#k:v:w', 'my.histogram:2|h|#k:v:w',
+            'my.multi:1|c:2|c|#t', 'my.multi:3|c:4|c|#t',
+        ]
+        bad_packets = ['my.counter:abc|c', 'my.unknown:1|z', 'my.counter:1|c|', 'my.set:a:b|s']
+
+        for cache_size in (0, 4, 100):
+            stats = MetricsAggregator('myhost', context_cache_size=cache_size)
+            for packet in packets * 3:
+                stats.submit_packets(packet)
+            for packet in bad_packets * 2:
+                self.assertRaises(Exception, stats.submit_packets, packet)
+            # The cache stays bounded
+            self.assertTrue(len(stats._context_cache) + len(stats._context_cache_old) <= max(cache_size, 1))
+
+            metrics = self.sort_metrics(stats.flush())
+            for metric in metrics:
+                # Ignore the flush timestamps
+                metric['points'] = [value for _, value in metric['points']]
+            if not cache_size:
+                expected = metrics
+            else:
+                nt.assert_equal(metrics, expected)
+
     @attr(requires='core_integration')
     def test_metrics_expiry(self):
         # Ensure metrics eventually expire and stop submitting.
@@ -563,6 +653,168 @@ class TestUnitDogStatsd(unittest.TestCase):
         nt.assert_equal(metrics[0]['metric'], 'test.counter')
         nt.assert_equal(metrics[0]['points'][0][1], 123)
 
+    def test_context_expiry_index(self):
+        from aggregator import ContextExpiryIndex
+        index = ContextExpiryIndex()
+        index.touch('a', 100.2)
+        index.touch('b', 100.7)
+        index.touch('c', 101.5)
+        # Sampled again later: moved to the slot of second 105
+        index.touch('d', 100.1)
+        index.touch('d', 105.0)
+        index.discard('c')
+
+        nt.assert_equal(index.expire(100.0), [])
+        # The expiry timestamp is within the second of 'a' and 'b'
+        nt.assert_equal(index.expire(100.5), ['a'])
+        nt.assert_equal(sorted(index), ['b', 'd'])
+        nt.assert_equal(index.expire(104.0), ['b'])
+        nt.assert_equal(index.expire(105.0), [])
+        nt.assert_equal(index.expire(105.1), ['d'])
+        nt.assert_equal(len(index), 0)
+        nt.assert_equal(index._contexts_by_second, {})
+
+    def test_context_expiry_index_size(self):
+        from aggregator import ContextExpiryIndex
+        index = ContextExpiryIndex()
+        # Contexts sampled every flush interval, for longer than the expiry
+        for timestamp in xrange(1000, 1600, 10):
+            for context in xrange(200):
+                index.touch(context, timestamp + context / 1000.0)
+            nt.assert_equal(sum(len(contexts) for contexts in index._contexts_by_second.values()), 200)
+        nt.assert_equal(len(index._contexts_by_second), 1)
+
+    def test_interning(self):
+        stats = MetricsAggregator('myhost', intern_table_size=100, utf8_decoding=True)
+        stats.submit_packets('my.gauge:1|g|#b,a,device:sda')
+        stats.submit_packets('other.gauge:1|g|#a,b,device:sda')
+        stats.submit_packets('my.gauge:1|g|#c:x,device:sda')
+        stats.submit_packets(u'my.gauge:1|g|#c:x,t\xe9g'.encode('utf-8'))
+        contexts = sorted(stats.metrics)
+        nt.assert_equal(contexts, [
+            (u'my.gauge', (u'a', u'b'), 'myhost', u'sda'),
+            (u'my.gauge', (u'c:x', ), 'myhost', u'sda'),
+            (u'my.gauge', (u'c:x', u't\xe9g'), 'myhost', None),
+            (u'other.gauge', (u'a', u'b'), 'myhost', u'sda'),
+        ])
+
+        # Equal names, tags, tag tuples and device names are the same objects
+        ab, cx, cx_tag, other_ab = contexts
+        nt.assert_true(ab[0] is cx[0] is cx_tag[0])
+        nt.assert_true(ab[1] is other_ab[1])
+        nt.assert_true(cx[1][0] is cx_tag[1][0])
+        nt.assert_true(ab[3] is cx[3] is other_ab[3])
+
+        # The table of tag tuples and unicode strings stays bounded
+        for i in xrange(1000):
+            stats.submit_packets((u'my.gauge:1|g|#t\xe9g:%s' % i).encode('utf-8'))
+        nt.assert_true(len(stats.interned) <= 100)
+
+    def test_interning_disabled(self):
+        stats = MetricsAggregator('myhost')
+        stats.submit_packets('my.gauge:1|g|#b,a')
+        stats.submit_packets('other.gauge:1|g|#a,b')
+        (_, tags, _, _), (_, other_tags, _, _) = stats.metrics
+        nt.assert_equal(tags, other_tags)
+        nt.assert_false(tags is other_tags)
+
+    def test_context_limits(self):
+        stats = MetricsAggregator('myhost', max_contexts=6, max_contexts_per_metric=3)
+        for i in xrange(10):
+            stats.submit_packets('my.counter:1|c|#request:%s' % i)
+        stats.submit_packets('datadog.dogstatsd.internal:1|c|#request:1')
+        stats.submit_packets('other.counter:1|c|#a\nother.counter:1|c|#b')
+        # The global limit is reached, the overflow context of this one doesn't exist
+        stats.submit_packets('third.counter:1|c|#a')
+
+        values = dict(((m['metric'], m['tags']), m['points'][0][1]) for m in stats.flush())
+        nt.assert_equal(values, {
+            ('my.counter', ('request:0', )): 1,
+            ('my.counter', ('request:1', )): 1,
+            ('my.counter', ('request:2', )): 1,
+            ('my.counter', ('overflow:true', )): 7,
+            ('datadog.dogstatsd.internal', ('request:1', )): 1,
+            ('other.counter', ('a', )): 1,
+            ('other.counter', ('b', )): 1,
+        })
+        nt.assert_equal(stats.pop_context_limiter_stats(), {
+            'contexts': 6,
+            'rejected': 8,
+            'top_rejected': [('my.counter', 7), ('third.counter', 1)],
+        })
+        nt.assert_equal(stats.pop_context_limiter_stats()['rejected'], 0)
+
+        # The contexts of the previous interval keep their place
+        for i in xrange(10, 20):
+            stats.submit_packets('new.counter:1|c|#request:%s' % i)
+        stats.submit_packets('other.counter:1|c|#a')
+        stats.submit_packets('my.counter:1|c|#request:9')
+        values = dict(((m['metric'], m['tags']), m['points'][0][1]) for m in stats.flush())
+        nt.assert_equal(values[('other.counter', ('a', ))], 1)
+        nt.assert_equal(values[('my.counter', ('overflow:true', ))], 1)
+        nt.assert_false(any(name == 'new.counter' for name, _ in values))
+
+    def test_context_limits_drop(self):
+        stats = MetricsBucketAggregator('myhost', interval=1, max_contexts_per_metric=2, context_overflow=False)
+        for i in xrange(5):
+            stats.submit_packets('my.gauge:1|g|#request:%s\nmy.histogram:1|h|#request:%s' % (i, i))
+        nt.assert_equal(len(stats.current_mbc), 4)
+        nt.assert_equal(stats.pop_context_limiter_stats()['top_rejected'], [('my.gauge', 3), ('my.histogram', 3)])
+
+    def test_load_shedding(self):
+        for context_cache_size in (0, 100):
+            stats = MetricsAggregator('myhost', context_cache_size=context_cache_size, cpu_budget=0.5)
+            stats.load_shedder.ratio = 4
+            for i in xrange(100):
+                stats.submit_packets('my.counter:1|c|#a,b')
+                stats.submit_packets('my.counter:2|c|@0.5|#c')
+                stats.submit_packets('my.timer:%s|ms' % i)
+                stats.submit_packets('my.gauge:%s|g' % i)
+                stats.submit_packets('my.set:%s|s' % i)
+                stats.submit_packets('_sc|my.check|0')
+            # The packets of each context are shed deterministically and
+            # counted through their sample rate
+            nt.assert_equal(stats.pop_load_shedder_stats(), {'packets': 500, 'shed': 225, 'ratio': 4})
+            metrics = dict(((m['metric'], m['tags']), m['points'][0][1]) for m in stats.flush())
+            nt.assert_equal(metrics[('my.counter', ('a', 'b'))], 100)
+            nt.assert_equal(metrics[('my.counter', ('c', ))], 400)
+            nt.assert_equal(metrics[('my.timer.count', None)], 100)
+            nt.assert_equal(metrics[('my.gauge', None)], 99)
+            nt.assert_equal(metrics[('my.set', None)], 100)
+            nt.assert_equal(len(stats.flush_service_checks()), 100)
+
+    def test_load_shedder_ratio(self):
+        from aggregator import LoadShedder
+        shedder = LoadShedder(0.5)
+        shedder.window_start = 0
+        # Busy all the time, the ratio doubles every window
+        shedder.account(0, 1.0, 10)
+        nt.assert_equal(shedder.ratio, 2)
+        shedder.account(1.0, 2.0, 10)
+        nt.assert_equal(shedder.ratio, 4)
+        # Under the budget, but not by much
+        shedder.account(2.7, 3.0, 10)
+        nt.assert_equal(shedder.ratio, 4)
+        shedder.account(3.9, 4.0, 10)
+        nt.assert_equal(shedder.ratio, 2)
+        nt.assert_equal(shedder.pop_stats()['packets'], 40)
+
+    def test_load_shedding_low_rate(self):
+        # A context sending less than `ratio` packets per window is still
+        # kept 1 in `ratio` times, not once per window
+        stats = MetricsAggregator('myhost', cpu_budget=0.5)
+        shedder = stats.load_shedder
+        shedder.ratio = 4
+        for i in xrange(40):
+            # Each packet ends a window loaded within the budget
+            shedder.window_start = time.time() - 1.0
+            shedder.busy_time = 0.4
+            stats.submit_packets('my.counter:1|c')
+            nt.assert_equal(shedder.ratio, 4)
+        nt.assert_equal(stats.pop_load_shedder_stats(), {'packets': 40, 'shed': 30, 'ratio': 4})
+        metrics = dict((m['metric'], m['points'][0][1]) for m in stats.flush())
+        nt.assert_equal(metrics['my.counter'], 40)
+
     def test_diagnostic_stats(self):
         stats = MetricsAggregator('myhost')
         for i in xrange(10):
@@ -754,6 +1006,54 @@ class TestUnitDogStatsd(unittest.TestCase):
         nt.assert_equal(fourth['check'], 'check.4')
         nt.assert_equal(fourth['tags'], sorted(['t1', 't2:v2', 't3', 't4']))
 
+    def test_service_check_coalescing(self):
+        stats = MetricsAggregator('myhost', coalesce_service_checks=True)
+        for i in xrange(1000):
+            stats.submit_packets('_sc|check.1|%s|d:%s|#t2,t1' % (i % 3, 1000 + i))
+        stats.submit_packets('_sc|check.1|2|d:900|#t1,t2|m:older')
+        stats.submit_packets('_sc|check.1|0|#t1')
+        stats.submit_packets('_sc|check.1|0|h:otherhost|#t1,t2')
+        stats.submit_packets('_sc|check.2|1')
+
+        service_checks = stats.flush_service_checks()
+        nt.assert_equal(len(service_checks), 4)
+        first, second, third, fourth = service_checks
+        # The latest status, whatever the order the runs were received in
+        nt.assert_equal((first['check'], first['tags'], first['status'], first['timestamp']),
+                        ('check.1', ['t1', 't2'], 0, 1999))
+        nt.assert_equal(first['count'], 1001)
+        nt.assert_equal(second['tags'], ['t1'])
+        nt.assert_equal(third['host_name'], 'otherhost')
+        nt.assert_equal(fourth['check'], 'check.2')
+        for service_check in service_checks[1:]:
+            nt.assert_false('count' in service_check)
+
+    def test_event_coalescing(self):
+        stats = MetricsAggregator('myhost', coalesce_events=True)
+        for i in xrange(100):
+            stats.submit_packets('_e{5,5}:title|text%s|d:%s|k:key|#t1' % (i % 10, 1000 + i))
+        stats.submit_packets('_e{5,4}:title|text|d:2000|k:key|t:error|#t1')
+        stats.submit_packets('_e{5,4}:title|text|d:2000|k:other|#t1')
+        stats.submit_packets('_e{5,4}:title|text|d:2000')
+        stats.submit_packets('_e{5,4}:title|text|d:2000')
+
+        events = stats.flush_events()
+        nt.assert_equal(len(events), 5)
+        nt.assert_equal((events[0]['msg_text'], events[0]['timestamp'], events[0]['count']), ('text9', 1099, 100))
+        # A different alert type or aggregation key isn't coalesced, nor events without a key
+        nt.assert_equal(events[1]['alert_type'], 'error')
+        nt.assert_equal(events[2]['aggregation_key'], 'other')
+        for event in events[1:]:
+            nt.assert_false('count' in event)
+
+        # Off by default
+        stats = MetricsAggregator('myhost')
+        for i in xrange(10):
+            stats.submit_packets('_e{5,4}:title|text|k:key')
+            stats.submit_packets('_sc|check.1|0')
+        nt.assert_equal(len(stats.flush_events()), 10)
+        nt.assert_equal(len(stats.flush_service_checks()), 10)
+
     def test_recent_point_threshold(self):
         threshold = 100
         # The min is not enabled by default
@@ -866,3 +1166,435 @@ class TestUnitDogStatsd(unittest.TestCase):
         del env["https_proxy"]
         del env["HTTP_PROXY"]
         del env["HTTPS_PROXY"]
+
+
+class TestServerBatching(unittest.TestCase):
+
+    def setUp(self):
+        import dogstatsd
+        self.aggregator = MetricsAggregator('myhost')
+        self.server = dogstatsd.Server(self.aggregator, '127.0.0.1', 0, batch_size=4)
+        self.server.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.server.socket.setblocking(0)
+        self.server.socket.bind(('127.0.0.1', 0))
+        self.client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.client.connect(self.server.socket.getsockname())
+
+    def tearDown(self):
+        self.client.close()
+        self.server.socket.close()
+
+    def send(self, *packets):
+        for packet in packets:
+            self.client.send(packet)
+        # Let the datagrams reach the receive queue
+        time.sleep(0.1)
+
+    def test_receive_batch(self):
+        self.send('my.counter:1|c', 'my.counter:2|c\nmy.gauge:3|g', 'malformed', 'my.counter:4|c')
+
+        nt.assert_equal(self.server._receive_batch(self.server.socket), 4)
+        # The socket is drained, nothing else to read
+        nt.assert_equal(self.server._receive_batch(self.server.socket), 0)
+
+        metrics = dict((m['metric'], m) for m in self.aggregator.flush())
+        nt.assert_equal(metrics['my.counter']['points'][0][1], 7)
+        nt.assert_equal(metrics['my.gauge']['points'][0][1], 3)
+        nt.assert_equal(metrics['datadog.dogstatsd.datagrams_per_wakeup.max']['points'][0][1], 4)
+
+    def test_receive_batch_limits(self):
+        self.send(*['my.counter:1|c'] * 6)
+        nt.assert_equal(self.server._receive_batch(self.server.socket), 4)
+        nt.assert_equal(self.server._receive_batch(self.server.socket), 2)
+
+        # The byte budget stops the batch too
+        self.server.batch_bytes = len('my.counter:1|c') + 1
+        self.server._batch_buffer = None
+        self.send(*['my.counter:1|c'] * 3)
+        nt.assert_equal(self.server._receive_batch(self.server.socket), 1)
+
+
+class TestServerUnixSocket(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.tmp_dir, 'dogstatsd.sock')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_unix_socket(self):
+        import dogstatsd
+        aggregator = MetricsAggregator('myhost')
+        # Port 0: only listen on the unix socket
+        server = dogstatsd.Server(aggregator, '127.0.0.1', 0,
+                                  socket_path=self.socket_path, socket_buffer_size=64 * 1024)
+        thread = threading.Thread(target=server.start)
+        thread.start()
+        try:
+            for _ in xrange(50):
+                if os.path.exists(self.socket_path):
+                    break
+                time.sleep(0.1)
+
+            client = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            # Bigger than the 8KB UDP buffer
+            client.sendto('\n'.join(['my.counter:1|c'] * 2000), self.socket_path)
+            client.sendto('my.gauge:3|g', self.socket_path)
+            time.sleep(0.2)
+        finally:
+            server.stop()
+            # Wake the server up so that it notices it's stopped
+            client.sendto('', self.socket_path)
+            thread.join()
+
+        metrics = dict((m['metric'], m) for m in aggregator.flush())
+        nt.assert_equal(metrics['my.counter']['points'][0][1], 2000)
+        nt.assert_equal(metrics['my.gauge']['points'][0][1], 3)
+        # The socket file is cleaned up
+        self.assertFalse(os.path.exists(self.socket_path))
+
+    def test_unix_socket_path_taken(self):
+        import dogstatsd
+        # Not a socket: it's not deleted, and the server doesn't start
+        with open(self.socket_path, 'w') as f:
+            f.write('not a socket')
+        server = dogstatsd.Server(MetricsAggregator('myhost'), '127.0.0.1', 0, socket_path=self.socket_path)
+        server.start()
+        nt.assert_true(server.unix_socket is None)
+        with open(self.socket_path) as f:
+            nt.assert_equal(f.read(), 'not a socket')
+
+        # A socket left behind by a previous run is replaced
+        os.unlink(self.socket_path)
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        stale.bind(self.socket_path)
+        stale.close()
+        server = dogstatsd.Server(MetricsAggregator('myhost'), '127.0.0.1', 0, socket_path=self.socket_path)
+        try:
+            nt.assert_true(server._bind_unix_socket())
+        finally:
+            server._close_sockets()
+        self.assertFalse(os.path.exists(self.socket_path))
+
+
+class TestDatagramRing(unittest.TestCase):
+
+    def setUp(self):
+        self.reader, self.writer = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.reader.setblocking(0)
+
+    def tearDown(self):
+        self.reader.close()
+        self.writer.close()
+
+    def test_ring(self):
+        from dogstatsd import DatagramRing
+        ring = DatagramRing(4, 64)
+        for i in xrange(6):
+            self.writer.send('my.counter:%s|c' % i)
+
+        # Every datagram is read from the socket, the ones that don't fit are dropped
+        nt.assert_equal(ring.receive(self.reader, 64), 6)
+        nt.assert_equal(len(ring), 4)
+        nt.assert_true(ring.ready.isSet())
+        nt.assert_equal(ring.read(), ['my.counter:%s|c' % i for i in xrange(4)])
+        nt.assert_equal(len(ring), 0)
+        nt.assert_equal(ring.reset_stats(), (2, 4))
+
+        # The slots are reused once read
+        for i in xrange(3):
+            self.writer.send('my.gauge:%s|g' % i)
+        nt.assert_equal(ring.receive(self.reader, 64), 3)
+        nt.assert_equal(ring.read(), ['my.gauge:%s|g' % i for i in xrange(3)])
+        nt.assert_equal(ring.reset_stats(), (0, 3))
+        nt.assert_equal(ring.read(), [])
+
+    def test_server_with_ring(self):
+        import dogstatsd
+        tmp_dir = tempfile.mkdtemp()
+        socket_path = os.path.join(tmp_dir, 'dogstatsd.sock')
+        aggregator = MetricsAggregator('myhost')
+        server = dogstatsd.Server(aggregator, '127.0.0.1', 0, socket_path=socket_path, ring_size=16)
+        thread = threading.Thread(target=server.start)
+        thread.start()
+        try:
+            for _ in xrange(50):
+                if os.path.exists(socket_path):
+                    break
+                time.sleep(0.1)
+
+            client = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            for _ in xrange(10):
+                client.sendto('my.counter:1|c', socket_path)
+            client.sendto('malformed', socket_path)
+            client.sendto('my.gauge:3|g', socket_path)
+            time.sleep(0.2)
+        finally:
+            server.stop()
+            client.sendto('', socket_path)
+            thread.join()
+            shutil.rmtree(tmp_dir)
+
+        server.report_ring_stats()
+        metrics = dict((m['metric'], m) for m in aggregator.flush())
+        nt.assert_equal(metrics['my.counter']['points'][0][1], 10)
+        nt.assert_equal(metrics['my.gauge']['points'][0][1], 3)
+        nt.assert_equal(metrics['datadog.dogstatsd.ring.drops']['points'][0][1], 0)
+        nt.assert_true(metrics['datadog.dogstatsd.ring.high_water_mark']['points'][0][1] >= 1)
+
+
+class TestCapture(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'dogstatsd.capture')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_capture(self):
+        from dogstatsd import DatagramCapture, read_capture
+        capture = DatagramCapture(self.path)
+        start = capture.start_time
+        capture.write('my.counter:1|c', start + 0.5)
+        capture.write('', start + 0.6)
+        capture.write('my.counter:2|c\nmy.gauge:3|g', start + 1.25)
+        capture.close()
+        # Closed, nothing is written anymore
+        capture.write('my.counter:3|c')
+
+        records = list(read_capture(self.path))
+        nt.assert_equal([datagram for _, datagram in records],
+                        ['my.counter:1|c', 'my.counter:2|c\nmy.gauge:3|g'])
+        nt.assert_almost_equal(records[0][0], start + 0.5, places=5)
+        nt.assert_almost_equal(records[1][0], start + 1.25, places=5)
+
+        # A truncated record is ignored
+        with open(self.path, 'r+b') as f:
+            f.truncate(os.path.getsize(self.path) - 2)
+        nt.assert_equal(len(list(read_capture(self.path))), 1)
+
+        with open(self.path, 'wb') as f:
+            f.write('my.counter:1|c')
+        nt.assert_raises(ValueError, list, read_capture(self.path))
+
+    def test_capture_limits(self):
+        from dogstatsd import DatagramCapture, read_capture
+        random.seed(0)
+        capture = DatagramCapture(self.path, sample_rate=0.25)
+        for i in xrange(4000):
+            capture.write('my.counter:%s|c' % i)
+        capture.close()
+        nt.assert_true(800 < len(list(read_capture(self.path))) < 1200)
+
+        # It stops at its max size
+        capture = DatagramCapture(self.path, max_size=1024)
+        for i in xrange(100):
+            capture.write('my.counter:1|c')
+        nt.assert_true(capture.file is None)
+        nt.assert_true(capture.size <= 1024)
+        nt.assert_equal(len(list(read_capture(self.path))), capture.count)
+
+    def test_server_capture(self):
+        import dogstatsd
+        aggregator = MetricsAggregator('myhost')
+        server = dogstatsd.Server(aggregator, '127.0.0.1', 0, batch_size=4)
+        server.capture = dogstatsd.DatagramCapture(self.path)
+        server.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.socket.setblocking(0)
+        server.socket.bind(('127.0.0.1', 0))
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        client.connect(server.socket.getsockname())
+        try:
+            for packet in ['my.counter:1|c', 'my.counter:2|c\nmy.gauge:3|g', 'malformed']:
+                client.send(packet)
+            time.sleep(0.1)
+            nt.assert_equal(server._receive_batch(server.socket), 3)
+        finally:
+            client.close()
+            server._close_sockets()
+
+        nt.assert_equal([datagram for _, datagram in dogstatsd.read_capture(self.path)],
+                        ['my.counter:1|c', 'my.counter:2|c\nmy.gauge:3|g', 'malformed'])
+
+    def test_replay_speed(self):
+        from tests.core.benchmark_replay import parse_speed
+        nt.assert_equal(parse_speed('max'), None)
+        nt.assert_equal(parse_speed('10x'), 10)
+        nt.assert_equal(parse_speed('0.5'), 0.5)
+        nt.assert_raises(ValueError, parse_speed, '0x')
+        nt.assert_raises(ValueError, parse_speed, 'fast')
+
+    def test_send_capture(self):
+        from dogstatsd import DatagramCapture
+        from tests.core.benchmark_replay import send_capture
+        capture = DatagramCapture(self.path)
+        datagrams = ['my.counter:1|c\nmy.gauge:%s|g' % i for i in xrange(10)]
+        for i, datagram in enumerate(datagrams):
+            capture.write(datagram, capture.start_time + i * 0.001)
+        capture.close()
+
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receiver.bind(('127.0.0.1', 0))
+        receiver.settimeout(5)
+        started = threading.Event()
+        try:
+            send_capture(self.path, receiver.getsockname(), None, started=started)
+            nt.assert_true(started.isSet())
+            nt.assert_equal([receiver.recv(1024) for _ in datagrams], datagrams)
+        finally:
+            receiver.close()
+
+
+class StubIntake(object):
+    """
+    An HTTP intake answering every POST with `status` after `delay`
+    seconds. It counts the payloads and their bytes by path, and keeps
+    their bodies if `keep_bodies`.
+    """
+
+    def __init__(self, delay=0, keep_bodies=True):
+        import BaseHTTPServer
+        import SocketServer
+        import zlib
+
+        intake = self
+        self.delay = delay
+        self.status = 202
+        self.keep_bodies = keep_bodies
+        self.paths = []
+        self.bodies = []
+        self.client_ports = set()
+        # [payloads, bytes received, decompressed bytes] by path
+        self.stats = {}
+        self.lock = threading.Lock()
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                size = len(body)
+                if self.headers.get('Content-Encoding') == 'deflate':
+                    body = zlib.decompress(body)
+                intake.record(self.path.split('?')[0], body, size, self.client_address[1])
+                time.sleep(intake.delay)
+                self.send_response(intake.status)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        class ThreadingServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+
+        self.server = ThreadingServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%s' % self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def record(self, path, body, size, client_port):
+        with self.lock:
+            self.paths.append(path)
+            if self.keep_bodies:
+                self.bodies.append(body)
+            self.client_ports.add(client_port)
+            stats = self.stats.setdefault(path, [0, 0, 0])
+            stats[0] += 1
+            stats[1] += size
+            stats[2] += len(body)
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class TestReporter(unittest.TestCase):
+
+    def setUp(self):
+        import dogstatsd
+        self.intake = StubIntake(0.5)
+        self.aggregator = MetricsAggregator('myhost')
+        self.reporter = dogstatsd.Reporter(10, self.aggregator, self.intake.url, 'apikey')
+
+    def tearDown(self):
+        if self.reporter.pool is not None:
+            self.reporter.pool.terminate()
+            self.reporter.pool.join()
+        self.reporter.session.close()
+        self.intake.stop()
+
+    def submit_flush(self):
+        self.aggregator.submit_packets('my.counter:1|c')
+        self.aggregator.submit_packets('_e{5,4}:title|text')
+        self.aggregator.submit_packets('_sc|my.check|0')
+
+    def test_concurrent_submission(self):
+        from checks.libs.thread_pool import Pool
+        self.reporter.pool = Pool(3, name="Reporter")
+
+        for _ in xrange(2):
+            self.submit_flush()
+            start = time.time()
+            self.reporter.flush()
+            # The three POSTs are sent at once
+            nt.assert_true(time.time() - start < 1.4)
+
+        nt.assert_equal(sorted(set(self.intake.paths)), ['/api/v1/check_run', '/api/v1/series', '/intake'])
+        nt.assert_equal(len(self.intake.paths), 6)
+        # The connections of the first flush are reused by the second one
+        nt.assert_true(len(self.intake.client_ports) <= 3)
+
+        # The latencies of the previous flush are submitted with the next one
+        latencies = [m for m in self.aggregator.flush() if m['metric'].startswith('datadog.dogstatsd.http.latency')]
+        nt.assert_equal(
+            sorted(set(tuple(m['tags']) for m in latencies)),
+            [('endpoint:check_run',), ('endpoint:intake',), ('endpoint:series',)]
+        )
+
+    def test_serial_submission(self):
+        # Without the reporter thread, the flushes are sent serially
+        self.submit_flush()
+        start = time.time()
+        self.reporter.flush()
+        nt.assert_true(time.time() - start >= 1.5)
+        nt.assert_equal(len(self.intake.paths), 3)
+        nt.assert_equal(len(self.intake.client_ports), 1)
+
+    def test_spool(self):
+        import json
+        from utils.spool import DiskSpool
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            self.intake.delay = 0
+            self.reporter.spool = DiskSpool(tmp_dir, 1024 * 1024)
+            self.reporter.spool_replay_rate = 0.2
+
+            # The intake is down, the payloads are spooled
+            self.intake.status = 503
+            for i in xrange(2):
+                self.aggregator.submit_packets('my.counter:%s|c' % (i + 1))
+                self.aggregator.submit_packets('_sc|my.check|0')
+                self.reporter.flush()
+            nt.assert_equal(len(self.reporter.spool), 4)
+            # Invalid payloads aren't
+            self.intake.status = 400
+            self.reporter.submit_service_checks([])
+            nt.assert_equal(len(self.reporter.spool), 4)
+
+            # It's back, two spooled payloads are replayed per flush, oldest first
+            self.intake.status = 202
+            del self.intake.bodies[:]
+            self.reporter.flush()
+            nt.assert_equal(len(self.reporter.spool), 2)
+            series = [json.loads(body)['series'] for body in self.intake.bodies[1:] if 'series' in body]
+            nt.assert_equal([s['points'][0][1] for s in series[0] if s['metric'] == 'my.counter'], [1])
+
+            self.reporter.flush()
+            nt.assert_equal(len(self.reporter.spool), 0)
+            nt.assert_equal(self.reporter.spool.stats()['replayed'], 4)
+        finally:
+            shutil.rmtree(tmp_dir)
@@ -1,8 +1,10 @@
 # stdlib
+import math
+import random
 import unittest
 
 # project
-from aggregator import Histogram, MetricsAggregator
+from aggregator import Histogram, MetricsAggregator, SketchHistogram
 from config import get_histogram_aggregates, get_histogram_percentiles
 
 class TestHistogram(unittest.TestCase):
@@ -151,3 +153,103 @@ class TestHistogram(unittest.TestCase):
         self.assertEquals(value_by_type['median'], 9, value_by_type)
         self.assertEquals(value_by_type['max'], 19, value_by_type)
         self.assertEquals(value_by_type['95percentile'], 18, value_by_type)
+
+
+class TestSketchHistogram(unittest.TestCase):
+
+    @staticmethod
+    def value_by_type(metrics, name):
+        return dict((m['metric'][len(name)+1:], m['points'][0][1]) for m in metrics)
+
+    def test_relative_accuracy(self):
+        rand = random.Random(42)
+        distributions = {
+            'lognormal': lambda: rand.lognormvariate(3, 2),
+            'uniform': lambda: rand.uniform(0, 1000),
+            'signed': lambda: rand.uniform(-1000, 1000),
+            'integers': lambda: rand.randint(0, 100),
+        }
+        for relative_accuracy in (0.01, 0.05):
+            for name, draw in distributions.iteritems():
+                samples = [draw() for _ in xrange(10000)]
+                sketch = SketchHistogram(None, name, None, 'myhost', None, {'relative_accuracy': relative_accuracy})
+                for value in samples:
+                    sketch.sample(value, 1)
+                samples.sort()
+
+                min_, max_, median, avg = sketch._summarize()
+                self.assertEquals((min_, max_), (samples[0], samples[-1]))
+                self.assertAlmostEquals(avg, sum(samples) / float(len(samples)))
+                for p in (0.01, 0.25, 0.5, 0.75, 0.95, 0.99):
+                    # Within the relative accuracy of the sample of this rank
+                    exact = samples[int(math.ceil(p * len(samples))) - 1]
+                    self.assertTrue(abs(sketch._percentile(p) - exact) <= relative_accuracy * abs(exact) + 1e-9,
+                                    (name, relative_accuracy, p, sketch._percentile(p), exact))
+
+    def test_bounded_memory(self):
+        sketch = SketchHistogram(None, 'my.histogram', None, 'myhost', None, {'max_bins': 100})
+        for i in xrange(1, 100000):
+            sketch.sample(i, 1)
+            sketch.sample(-i, 1)
+        self.assertEquals(len(sketch.bins), 100)
+        self.assertEquals(len(sketch.negative_bins), 100)
+        # The merged bins are the ones closest to 0, the high percentiles are still accurate
+        self.assertTrue(abs(sketch._percentile(0.99) - 98000) <= 0.01 * 98000)
+        self.assertEquals(sketch.count, 2 * 99999)
+
+    def test_invalid_values(self):
+        sketch = SketchHistogram(None, 'my.histogram', None, 'myhost', None)
+        sketch.sample(10, 1)
+        for value in (float('nan'), float('inf'), float('-inf')):
+            self.assertRaises(ValueError, sketch.sample, value, 0.5)
+        # Nothing was counted
+        self.assertEquals(sketch.count, 1)
+        self.assertEquals(sketch.weight, 1)
+        self.assertEquals(sum(sketch.bins.values()), 1)
+        self.assertEquals((sketch.min, sketch.max, sketch.sum), (10, 10, 10))
+
+    def test_sample_rate(self):
+        stats = MetricsAggregator('myhost', histogram_sketch_prefixes=[''])
+        # Stands for 10 samples of 1
+        stats.submit_packets('my.histogram:1|h|@0.1')
+        for _ in xrange(9):
+            stats.submit_packets('my.histogram:100|h')
+
+        value_by_type = self.value_by_type(stats.flush(), 'my.histogram')
+        self.assertEquals(value_by_type['count'], 19)
+        self.assertEquals(value_by_type['median'], 1)
+        self.assertEquals(value_by_type['max'], 100)
+        self.assertAlmostEquals(value_by_type['avg'], (10 + 900) / 19.0)
+
+    def test_prefixes(self):
+        stats = MetricsAggregator('myhost', histogram_sketch_prefixes=['sketched.'],
+                                  histogram_percentiles=[0.5, 0.99])
+        for i in xrange(1, 101):
+            stats.submit_packets('sketched.histogram:{0}|h'.format(i))
+            stats.submit_packets('exact.histogram:{0}|h'.format(i))
+
+        classes = dict((context[0], metric.__class__) for context, metric in stats.metrics.iteritems())
+        self.assertEquals(classes, {'sketched.histogram': SketchHistogram, 'exact.histogram': Histogram})
+
+        metrics = stats.flush()
+        sketched = self.value_by_type([m for m in metrics if m['metric'].startswith('sketched.')], 'sketched.histogram')
+        exact = self.value_by_type([m for m in metrics if m['metric'].startswith('exact.')], 'exact.histogram')
+        # Same metrics, about the same values
+        self.assertEquals(sorted(sketched), sorted(exact))
+        for name, value in exact.iteritems():
+            self.assertTrue(abs(sketched[name] - value) <= 0.01 * value, (name, sketched[name], value))
+
+    def test_merge(self):
+        # Sketches of two halves of the samples merged together are the sketch of all of them
+        reference = SketchHistogram(None, 'my.histogram', None, 'myhost', None)
+        merged = SketchHistogram(None, 'my.histogram', None, 'myhost', None)
+        other = SketchHistogram(None, 'my.histogram', None, 'myhost', None)
+        for i in xrange(-50, 200):
+            reference.sample(i, 0.5)
+            (merged if i % 2 else other).sample(i, 0.5)
+        merged.merge(other.dump())
+
+        self.assertEquals(merged.count, reference.count)
+        self.assertEquals(merged._summarize(), reference._summarize())
+        for p in (0.1, 0.5, 0.9):
+            self.assertEquals(merged._percentile(p), reference._percentile(p))
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+# stdlib
+import random
+import unittest
+
+# 3p
+import nose.tools as nt
+
+# project
+from aggregator import MetricsBucketAggregator, UnparseablePacket
+
+
+def reference_parse_metric_packet(packet, allow_strings=('s', )):
+    """
+    The split based metric packet parser that `Aggregator.parse_metric_packet`
+    replaced, kept as the reference its output is checked against.
+    """
+    parsed_packets = []
+    name_and_metadata = packet.split(':', 1)
+
+    if len(name_and_metadata) != 2:
+        raise Exception('Unparseable metric packet: %s' % packet)
+
+    name = name_and_metadata[0]
+    broken_split = name_and_metadata[1].split(':')
+    data = []
+    partial_datum = None
+    for token in broken_split:
+        # We need to fix the tag groups that got broken by the : split
+        if partial_datum is None:
+            partial_datum = token
+        elif "|" not in token:
+            partial_datum += ":" + token
+        else:
+            data.append(partial_datum)
+            partial_datum = token
+    data.append(partial_datum)
+
+    for datum in data:
+        value_and_metadata = datum.split('|')
+
+        if len(value_and_metadata) < 2:
+            raise Exception('Unparseable metric packet: %s' % packet)
+
+        # Submit the metric
+        raw_value = value_and_metadata[0]
+        metric_type = value_and_metadata[1]
+
+        if metric_type in allow_strings:
+            value = raw_value
+        else:
+            # Try to cast as an int first to avoid precision issues, then as a
+            # float.
+            try:
+                value = int(raw_value)
+            except ValueError:
+                try:
+                    value = float(raw_value)
+                except ValueError:
+                    # Otherwise, raise an error saying it must be a number
+                    raise Exception('Metric value must be a number: %s, %s' % (name, raw_value))
+
+        # Parse the optional values - sample rate & tags.
+        sample_rate = 1
+        tags = None
+        for m in value_and_metadata[2:]:
+            # Parse the sample rate
+            if m[0] == '@':
+                sample_rate = float(m[1:])
+                assert 0 <= sample_rate <= 1
+            elif m[0] == '#':
+                tags = tuple(sorted(m[1:].split(',')))
+
+        parsed_packets.append((name, value, metric_type, tags, sample_rate))
+
+    return parsed_packets
+
+
+# Pieces the fuzzed packets are built from. No 'n' so that no value can be
+# parsed as nan (which never compares equal) or inf.
+TOKENS = [
+    'a', 'b', 'my.metric', '1', '2.5', '-3', '1e3', '.', ' ', '', ':', ':', '|', '|',
+    '@', '@0.5', '@1', '@2', '#', '#env:prod', ',', 'role:db', 'c', 'g', 'h', 's', 'ms', 'z',
+]
+
+
+def random_packet(rand):
+    """
+    A random packet, either made of random tokens or a valid packet with
+    a few mutations.
+    """
+    if rand.random() < 0.5:
+        return ''.join(rand.choice(TOKENS) for _ in xrange(rand.randint(1, 12)))
+
+    values = []
+    for _ in xrange(rand.randint(1, 3)):
+        datum = '%s|%s' % (rand.choice(['1', '2.5', '-3', 'x']), rand.choice(['c', 'g', 'h', 's', 'ms']))
+        metadata = ['@0.5', '#env:prod,role:db', '#a,b:c:d', '#']
+        rand.shuffle(metadata)
+        datum += ''.join('|' + m for m in metadata[:rand.randint(0, 3)])
+        values.append(datum)
+    packet = list('my.metric:' + ':'.join(values))
+
+    for _ in xrange(rand.randint(0, 2)):
+        position = rand.randint(0, len(packet))
+        action = rand.random()
+        if action < 0.4:
+            packet.insert(position, rand.choice(':|@#,.'))
+        elif position < len(packet):
+            if action < 0.7:
+                del packet[position]
+            else:
+                packet[position] = rand.choice(':|@#,.1 ')
+    return ''.join(packet)
+
+
+class TestPacketParser(unittest.TestCase):
+
+    def setUp(self):
+        self.aggregator = MetricsBucketAggregator('myhost')
+
+    def assert_same_parsing(self, packet):
+        try:
+            expected = reference_parse_metric_packet(packet, self.aggregator.ALLOW_STRINGS)
+        except Exception:
+            nt.assert_raises(UnparseablePacket, self.aggregator.parse_metric_packet, packet)
+        else:
+            nt.assert_equal(self.aggregator.parse_metric_packet(packet), expected, packet)
+
+    def test_parse(self):
+        nt.assert_equal(
+            self.aggregator.parse_metric_packet('my.metric:1|c|@0.5|#b,a:x'),
+            [('my.metric', 1, 'c', ('a:x', 'b'), 0.5)]
+        )
+        nt.assert_equal(
+            self.aggregator.parse_metric_packet('my.metric:1.5|h|@1|#a:b:user|s:2|g'),
+            [('my.metric', 1.5, 'h', ('a:b', ), 1.0), ('my.metric', 'user', 's', None, 1),
+             ('my.metric', 2, 'g', None, 1)]
+        )
+
+    def test_malformed(self):
+        for packet in ['my.metric', 'my.metric:1', 'my.metric:a|c', 'my.metric:1|c|',
+                       'my.metric:1|c||#a', 'my.metric:1|c|@a', 'my.metric:1|c|@2', 'my.metric:1:2|c']:
+            nt.assert_raises(UnparseablePacket, self.aggregator.parse_metric_packet, packet)
+            self.assert_same_parsing(packet)
+
+    def test_unicode(self):
+        self.assert_same_parsing(u'my.métric:1|c|#tàg:välue')
+
+    def test_fuzz(self):
+        rand = random.Random(4242)
+        for _ in xrange(50000):
+            self.assert_same_parsing(random_packet(rand))
@@ -0,0 +1,102 @@
+# stdlib
+import math
+import unittest
+
+# project
+from aggregator import DEFAULT_SET_HYPERLOGLOG_PRECISION, MetricsAggregator, MetricsBucketAggregator, Set
+
+
+class TestSet(unittest.TestCase):
+
+    @staticmethod
+    def flushed_value(s):
+        return s.flush(1000, 10)[0]['value']
+
+    def make_set(self, exact_threshold=None, precision=None):
+        return Set(lambda **kwargs: kwargs, 'my.set', None, 'myhost', None,
+                   {'exact_threshold': exact_threshold, 'precision': precision})
+
+    def test_exact_below_threshold(self):
+        s = self.make_set(exact_threshold=1000)
+        for i in xrange(1000):
+            s.sample('user-%s' % i, 1)
+            s.sample('user-%s' % i, 1)
+        self.assertTrue(s.registers is None)
+        self.assertEquals(self.flushed_value(s), 1000)
+
+    def test_switch_over(self):
+        s = self.make_set(exact_threshold=1000)
+        for i in xrange(1001):
+            s.sample('user-%s' % i, 1)
+        # The values are now counted in a few KB of registers
+        self.assertEquals(s.values, set())
+        self.assertEquals(len(s.registers), 2 ** DEFAULT_SET_HYPERLOGLOG_PRECISION)
+        for i in xrange(1001, 100000):
+            s.sample('user-%s' % i, 1)
+        self.assertEquals(len(s.registers), 2 ** DEFAULT_SET_HYPERLOGLOG_PRECISION)
+
+        self.assertTrue(abs(self.flushed_value(s) - 100000) < 5000)
+        # A flush starts an exact set again
+        self.assertTrue(s.registers is None)
+        s.sample('user-0', 1)
+        self.assertEquals(self.flushed_value(s), 1)
+
+    def test_error_bound(self):
+        # The documented standard error is 1.04/sqrt(2^precision), all the
+        # estimates must be within 3 standard errors, on the whole range of cardinalities
+        for precision in (10, 12):
+            standard_error = 1.04 / math.sqrt(2 ** precision)
+            for cardinality in (10, 100, 1000, 5000, 20000, 100000):
+                for run in xrange(2):
+                    s = self.make_set(exact_threshold=1, precision=precision)
+                    for i in xrange(cardinality):
+                        s.sample('session-%s-%s' % (run, i), 1)
+                    estimate = self.flushed_value(s)
+                    self.assertTrue(abs(estimate - cardinality) <= 3 * standard_error * cardinality,
+                                    (precision, cardinality, estimate))
+
+    def test_values_types(self):
+        s = self.make_set(exact_threshold=1)
+        for value in ['a', u'\xe9', 1, 1.5, 'a', u'\xe9']:
+            s.sample(value, 1)
+        self.assertEquals(self.flushed_value(s), 4)
+
+    def test_merge(self):
+        exact = self.make_set(exact_threshold=10000)
+        approximate = self.make_set(exact_threshold=10000)
+        for i in xrange(5000):
+            exact.sample('user-%s' % i, 1)
+        for i in xrange(2500, 30000):
+            approximate.sample('user-%s' % i, 1)
+        self.assertTrue(exact.registers is None)
+        self.assertTrue(approximate.registers is not None)
+
+        # Both ways, the merged set counts the union
+        reference = self.make_set(exact_threshold=1)
+        for i in xrange(30000):
+            reference.sample('user-%s' % i, 1)
+        expected = self.flushed_value(reference)
+
+        merged = self.make_set(exact_threshold=10000)
+        merged.merge(exact.dump())
+        merged.merge(approximate.dump())
+        self.assertEquals(self.flushed_value(merged), expected)
+
+        merged = self.make_set(exact_threshold=10000)
+        merged.merge(approximate.dump())
+        merged.merge(exact.dump())
+        self.assertEquals(self.flushed_value(merged), expected)
+
+    def test_aggregators(self):
+        stats = MetricsAggregator('myhost', set_hyperloglog_threshold=100)
+        for i in xrange(10000):
+            stats.submit_packets('my.set:%s|s' % i)
+            stats.submit_packets('my.set:%s|s' % i)
+        metrics = stats.flush()
+        self.assertEquals(len(metrics), 1)
+        self.assertTrue(abs(metrics[0]['points'][0][1] - 10000) < 500)
+
+        stats = MetricsBucketAggregator('myhost', set_hyperloglog_threshold=100)
+        for i in xrange(101):
+            stats.submit_packets('my.set:%s|s' % i)
+        self.assertTrue(stats.current_mbc.metric_by_context.values()[0].registers is not None)
@@ -0,0 +1,117 @@
+# stdlib
+import os
+import shutil
+import tempfile
+import unittest
+
+# 3p
+import nose.tools as nt
+
+# project
+from utils.spool import DiskSpool, RECORD_HEADER
+
+
+class TestDiskSpool(unittest.TestCase):
+
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'spool')
+
+    def tearDown(self):
+        shutil.rmtree(os.path.dirname(self.path))
+
+    def read_all(self, spool):
+        records = []
+        while True:
+            record = spool.peek()
+            if record is None:
+                return records
+            records.append(record)
+            spool.pop()
+
+    def segment_files(self):
+        return sorted(name for name in os.listdir(self.path) if name.endswith('.seg'))
+
+    def test_fifo(self):
+        spool = DiskSpool(self.path, 100000, segment_size=1000)
+        records = ['record %s ' % i * 20 for i in xrange(100)]
+        for record in records[:50]:
+            spool.append(record)
+        nt.assert_equal(spool.peek(), records[0])
+        # Peeking again returns the same record
+        nt.assert_equal(spool.peek(), records[0])
+        spool.pop()
+        for record in records[50:]:
+            spool.append(record, compress=False)
+        nt.assert_equal(len(spool), 99)
+        nt.assert_true(len(self.segment_files()) > 1)
+
+        nt.assert_equal(self.read_all(spool), records[1:])
+        nt.assert_equal(len(spool), 0)
+        nt.assert_equal(spool.replayed, 100)
+        # The read segments are deleted
+        nt.assert_equal(len(self.segment_files()), 1)
+
+        spool.append('last')
+        nt.assert_equal(self.read_all(spool), ['last'])
+
+    def test_size_cap(self):
+        spool = DiskSpool(self.path, 10000, segment_size=1000)
+        records = [os.urandom(100) for i in xrange(1000)]
+        for record in records:
+            spool.append(record, compress=False)
+            nt.assert_true(spool.size <= 10000)
+        nt.assert_true(spool.evicted > 0)
+        nt.assert_equal(spool.evicted + len(spool), 1000)
+
+        # The newest records are kept
+        nt.assert_equal(self.read_all(spool), records[spool.evicted:])
+
+        # Too large to ever fit
+        nt.assert_equal(spool.append('a' * 20000, compress=False), 0)
+        nt.assert_equal(len(spool), 0)
+
+    def test_recovery(self):
+        spool = DiskSpool(self.path, 100000, segment_size=500)
+        for i in xrange(30):
+            spool.append('record %s' % i)
+        for i in xrange(12):
+            spool.peek()
+            spool.pop()
+        spool.close()
+
+        spool = DiskSpool(self.path, 100000, segment_size=500)
+        nt.assert_equal(len(spool), 18)
+        nt.assert_equal(self.read_all(spool), ['record %s' % i for i in xrange(12, 30)])
+
+        spool.append('record 30')
+        spool.close()
+        spool = DiskSpool(self.path, 100000, segment_size=500)
+        nt.assert_equal(self.read_all(spool), ['record 30'])
+
+    def test_incomplete_record(self):
+        spool = DiskSpool(self.path, 100000)
+        spool.append('first')
+        spool.append('second')
+        spool.close()
+        # The agent stopped in the middle of a write
+        with open(os.path.join(self.path, self.segment_files()[-1]), 'ab') as f:
+            f.write(RECORD_HEADER.pack(100, 0, 0) + 'third')
+
+        spool = DiskSpool(self.path, 100000)
+        nt.assert_equal(len(spool), 2)
+        spool.append('fourth')
+        nt.assert_equal(self.read_all(spool), ['first', 'second', 'fourth'])
+
+    def test_corrupted_segment(self):
+        spool = DiskSpool(self.path, 100000, segment_size=10)
+        for record in ['first', 'second', 'third']:
+            spool.append(record, compress=False)
+        # Each record is in its own segment
+        segments = self.segment_files()
+        nt.assert_equal(len(segments), 3)
+        with open(os.path.join(self.path, segments[1]), 'r+b') as f:
+            f.seek(RECORD_HEADER.size)
+            f.write('X')
+
+        nt.assert_equal(self.read_all(spool), ['first', 'third'])
+        nt.assert_equal(spool.corrupted, 1)
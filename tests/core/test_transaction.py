@@ -1,6 +1,10 @@
 # stdlib
 from datetime import datetime, timedelta
+import shutil
+import tempfile
+import time
 import unittest
+import zlib
 
 # 3rd party
 from nose.plugins.attrib import attr
@@ -13,18 +17,27 @@ from config import get_version
 from ddagent import (
     APIMetricTransaction,
     APIServiceCheckTransaction,
+    load_transaction,
     MAX_QUEUE_SIZE,
     MetricTransaction,
     THROTTLING_DELAY,
 )
-from transaction import Transaction, TransactionManager
+from transaction import (
+    PRIORITY_HIGH,
+    PRIORITY_LOW,
+    PRIORITY_NORMAL,
+    Transaction,
+    TransactionManager,
+)
+from utils.spool import DiskSpool
 
 
 class memTransaction(Transaction):
-    def __init__(self, size, manager):
+    def __init__(self, size, manager, priority=PRIORITY_NORMAL):
         Transaction.__init__(self)
         self._trManager = manager
         self._size = size
+        self._priority = priority
         self._flush_count = 0
 
         self.is_flushable = False
@@ -39,6 +52,37 @@ class memTransaction(Transaction):
         self._trManager.flush_next()
 
 
+class spoolableTransaction(memTransaction):
+    def __init__(self, size, manager, payload):
+        memTransaction.__init__(self, size, manager, PRIORITY_LOW)
+        self.payload = payload
+
+    def dump(self):
+        return '%s %s' % (self._size, self.payload)
+
+
+class batchTransaction(memTransaction):
+    """ Rejected by the intake unless all the transactions it sends are flushable """
+
+    def flush(self):
+        self._flush_count = self._flush_count + 1
+        if self.is_flushable:
+            self._trManager.tr_success(self)
+        else:
+            self._trManager.tr_error(self, backoff=False)
+
+        self._trManager.flush_next()
+
+
+class coalescibleTransaction(memTransaction):
+    _coalesce_key = 'series'
+
+    def coalesce(self, transactions):
+        batch = batchTransaction(sum(tr.get_size() for tr in transactions), self._trManager)
+        batch.is_flushable = all(tr.is_flushable for tr in transactions)
+        return batch
+
+
 @attr(requires='core_integration')
 class TestTransaction(unittest.TestCase):
 
@@ -62,7 +106,7 @@ class TestTransaction(unittest.TestCase):
         # There should be exactly step transaction in the list, with
         # a flush count of 1
         self.assertEqual(len(trManager._transactions), step)
-        for tr in trManager._transactions:
+        for tr in trManager.get_transactions():
             self.assertEqual(tr._flush_count, 1)
 
         # Try to add one more
@@ -71,13 +115,13 @@ class TestTransaction(unittest.TestCase):
 
         # At this point, transaction one (the oldest) should have been removed from the list
         self.assertEqual(len(trManager._transactions), step)
-        for tr in trManager._transactions:
+        for tr in trManager.get_transactions():
             self.assertNotEqual(tr._id, 1)
 
         trManager.flush()
         self.assertEqual(len(trManager._transactions), step)
         # Check and allow transactions to be flushed
-        for tr in trManager._transactions:
+        for tr in trManager.get_transactions():
             tr.is_flushable = True
             # Last transaction has been flushed only once
             if tr._id == step + 1:
@@ -88,6 +132,273 @@ class TestTransaction(unittest.TestCase):
         trManager.flush()
         self.assertEqual(len(trManager._transactions), 0)
 
+    def testScheduling(self):
+        """Test that only the due transactions are flushed, first due first"""
+        trManager = TransactionManager(timedelta(seconds=0), MAX_QUEUE_SIZE, timedelta(seconds=0))
+        flushed = []
+
+        class orderedTransaction(memTransaction):
+            def flush(self):
+                flushed.append(self.get_id())
+                memTransaction.flush(self)
+
+        trs = [orderedTransaction(10, trManager) for i in xrange(4)]
+        for tr in trs:
+            trManager.append(tr)
+        now = datetime.utcnow()
+        for tr, delay in zip(trs, [-2, -1, -3, 10]):
+            tr._next_flush = now + timedelta(seconds=delay)
+        # Scheduled when appended, rescheduled when they fail
+        trManager._flush_queue = sorted((tr.get_next_flush(), tr.get_id()) for tr in trs)
+
+        trManager.flush()
+        self.assertEqual(flushed, [3, 1, 2])
+        self.assertEqual(len(trManager._flush_queue), 4)
+
+        # Completed twice, e.g. by two endpoints, it's only removed once
+        trManager.tr_success(trs[0])
+        trManager.tr_success(trs[0])
+        self.assertEqual(trManager._total_count, 3)
+        self.assertEqual(trManager._total_size, 30)
+        self.assertEqual(trManager._transactions_flushed, 1)
+
+        # An evicted transaction isn't flushed anymore
+        trManager._MAX_QUEUE_SIZE = 35
+        trs.append(orderedTransaction(10, trManager))
+        trManager.append(trs[-1])
+        self.assertEqual([tr.get_id() for tr in trManager.get_transactions()], [3, 4, 5])
+        for tr in trManager.get_transactions():
+            tr._next_flush = now - timedelta(seconds=1)
+        trManager._flush_queue = sorted((tr.get_next_flush(), tr.get_id()) for tr in trs)
+        del flushed[:]
+        trManager.flush()
+        self.assertEqual(sorted(flushed), [3, 4, 5])
+
+    def testWindow(self):
+        """Test the window of transactions in flight"""
+        trManager = TransactionManager(timedelta(seconds=0), MAX_QUEUE_SIZE, timedelta(seconds=0),
+                                       max_in_flight=4)
+        flushed = []
+
+        class asyncTransaction(memTransaction):
+            # Answered later on, like with an HTTP client
+            def flush(self):
+                flushed.append(self)
+
+        def respond(error=False, backoff=True):
+            tr = flushed.pop(0)
+            if error:
+                trManager.tr_error(tr, backoff=backoff)
+            else:
+                trManager.tr_success(tr)
+            trManager.flush_next()
+
+        for i in xrange(20):
+            trManager.append(asyncTransaction(10, trManager))
+        for tr in trManager.get_transactions():
+            tr._next_flush -= timedelta(seconds=1)
+        trManager.flush()
+        self.assertEqual(len(flushed), 1)
+
+        # It opens up while the intake answers
+        respond()
+        self.assertEqual(len(flushed), 2)
+        for _ in xrange(5):
+            respond()
+        self.assertEqual(len(flushed), 3)
+        respond()
+        self.assertEqual(len(flushed), 4)
+        self.assertEqual(len(trManager._in_flight), 4)
+
+        # A client error doesn't change it, an overloaded intake halves it
+        respond(error=True, backoff=False)
+        self.assertEqual(len(flushed), 4)
+        respond(error=True)
+        self.assertEqual(int(trManager._window), 2)
+        self.assertTrue(trManager._backoff)
+        self.assertEqual(len(flushed), 3)
+        respond()
+        respond()
+        self.assertEqual(len(flushed), 2)
+
+        # The flush is over once everything is sent, and the late responses are fine
+        while trManager._trs_to_flush is not None:
+            respond()
+        while flushed:
+            respond()
+        self.assertEqual(trManager._in_flight, {})
+        self.assertEqual(trManager._transactions_flushed, 18)
+        self.assertEqual(len(trManager.get_transactions()), 2)
+
+    def testPriorityEviction(self):
+        """Test that the bulk metrics are evicted first, oldest first"""
+        trManager = TransactionManager(timedelta(seconds=0), 100, timedelta(seconds=0))
+
+        def append(size, priority):
+            trManager.append(memTransaction(size, trManager, priority))
+            return [tr.get_id() for tr in trManager.get_transactions()]
+
+        append(30, PRIORITY_LOW)
+        append(30, PRIORITY_HIGH)
+        append(30, PRIORITY_LOW)
+        self.assertEqual(append(30, PRIORITY_NORMAL), [2, 3, 4])
+        self.assertEqual(append(30, PRIORITY_HIGH), [2, 4, 5])
+        # Nothing of a lower priority to evict, the new one is dropped
+        self.assertEqual(append(30, PRIORITY_LOW), [2, 4, 5])
+        self.assertEqual(append(50, PRIORITY_HIGH), [5, 7])
+
+        self.assertEqual(trManager._total_size, 80)
+        self.assertEqual(trManager._size_by_priority, {PRIORITY_LOW: 0, PRIORITY_NORMAL: 0, PRIORITY_HIGH: 80})
+        self.assertEqual(trManager._evicted, {PRIORITY_LOW: 3, PRIORITY_NORMAL: 1, PRIORITY_HIGH: 1})
+        self.assertEqual(trManager._transactions_received, 7)
+
+    def testSpool(self):
+        """Test that the transactions over the queue size are spooled, and replayed"""
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            def load(record, manager):
+                size, payload = record.split()
+                return spoolableTransaction(int(size), manager, payload)
+
+            spool = DiskSpool(tmp_dir, 1024 * 1024)
+            trManager = TransactionManager(timedelta(seconds=0), 100, timedelta(seconds=0),
+                                           spool=spool, load_transaction=lambda record: load(record, trManager))
+            trManager._flush_without_ioloop = True
+            for i in xrange(5):
+                trManager.append(spoolableTransaction(30, trManager, 'payload-%s' % i))
+            self.assertEqual([tr.payload for tr in trManager.get_transactions()],
+                             ['payload-2', 'payload-3', 'payload-4'])
+            self.assertEqual(len(spool), 2)
+            self.assertEqual(trManager._evicted[PRIORITY_LOW], 0)
+
+            # The queue empties once the intake is back, and they're replayed in order,
+            # while the queue is less than half full
+            for tr in trManager.get_transactions():
+                tr.is_flushable = True
+                tr._next_flush -= timedelta(seconds=1)
+            trManager.flush()
+            self.assertEqual(len(trManager.get_transactions()), 0)
+            trManager.flush()
+            self.assertEqual([tr.payload for tr in trManager.get_transactions()], ['payload-0'])
+            self.assertEqual(len(spool), 1)
+
+            # The queue is spooled when stopping, and recovered after a restart
+            trManager.close()
+            spool = DiskSpool(tmp_dir, 1024 * 1024)
+            self.assertEqual(len(spool), 2)
+            trManager = TransactionManager(timedelta(seconds=0), 1000, timedelta(seconds=0),
+                                           spool=spool, load_transaction=lambda record: load(record, trManager))
+            trManager._flush_without_ioloop = True
+            trManager.flush()
+            self.assertEqual(len(spool), 0)
+            self.assertEqual(trManager._transactions_received, 2)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def testDumpTransaction(self):
+        """Test that the forwarder transactions are rebuilt from their spool record"""
+        for transaction_class, msg_type in [
+                (MetricTransaction, 'metadata'),
+                (APIMetricTransaction, ''),
+                (APIServiceCheckTransaction, '')]:
+            tr = transaction_class('{"payload": 1}', {'Content-Type': 'application/json'}, msg_type, enqueue=False)
+            loaded = load_transaction(tr.dump())
+            self.assertTrue(type(loaded) is transaction_class)
+            self.assertEqual(loaded._data, '{"payload": 1}')
+            self.assertEqual(loaded._headers, tr._headers)
+            self.assertEqual(loaded.get_priority(), tr.get_priority())
+            self.assertEqual(loaded.get_size(), tr.get_size())
+
+    def testCoalescing(self):
+        """Test that the transactions with a coalesce key are sent in batches"""
+        trManager = TransactionManager(timedelta(seconds=0), MAX_QUEUE_SIZE, timedelta(seconds=0),
+                                       batch_max_size=100, batch_max_wait=timedelta(seconds=0.1))
+        trManager._flush_without_ioloop = True
+
+        # Held until there's a batch's worth of them
+        trs = []
+        for _ in xrange(3):
+            trs.append(coalescibleTransaction(30, trManager))
+            trManager.append(trs[-1])
+            trs[-1].is_flushable = True
+        trManager.flush()
+        self.assertEqual([tr._flush_count for tr in trs], [0, 0, 0])
+
+        # The full batch is sent, the others wait for more
+        for _ in xrange(2):
+            trs.append(coalescibleTransaction(30, trManager))
+            trManager.append(trs[-1])
+        trManager.flush()
+        self.assertEqual(trManager.get_transactions(), trs[3:])
+        self.assertEqual([tr._flush_count for tr in trs], [0, 0, 0, 0, 0])
+
+        # Until they've waited enough. The batch is rejected, they're retried one by one
+        time.sleep(0.1)
+        trManager.flush()
+        self.assertEqual(trManager.get_transactions(), trs[3:])
+        self.assertEqual([tr.get_error_count() for tr in trs[3:]], [1, 1])
+        self.assertEqual([tr.get_coalesce_key() for tr in trs[3:]], [None, None])
+        for tr in trs[3:]:
+            tr.is_flushable = True
+        trManager.flush()
+        self.assertEqual(len(trManager.get_transactions()), 0)
+        self.assertEqual([tr._flush_count for tr in trs], [0, 0, 0, 1, 1])
+        self.assertEqual(trManager._transactions_flushed, 5)
+
+        self.assertEqual(trManager._batch_size_distribution(), [
+            ['1', 0], ['2', 1], ['3-4', 1], ['5-8', 0], ['9-16', 0], ['17-32', 0], ['33+', 0]])
+
+    def testCoalesceSeries(self):
+        """Test that the series payloads are spliced in one payload"""
+        headers = {'Content-Type': 'application/json', 'DD-Dogstatsd-Version': '5.8.0'}
+        trs = [
+            APIMetricTransaction('{"series": [{"metric": "a"}]}', dict(headers), enqueue=False),
+            APIMetricTransaction('{"series": []}', dict(headers, **{'Content-Length': '14'}), enqueue=False),
+            APIMetricTransaction('{ "series" : [{"metric": "b"},\n{"metric": "c"}] }\n', dict(headers), enqueue=False),
+        ]
+        self.assertEqual(len(set(tr.get_coalesce_key() for tr in trs)), 1)
+        batch = trs[0].coalesce(trs)
+        self.assertEqual(batch._headers['DD-Dogstatsd-Version'], '5.8.0')
+        self.assertEqual(json.loads(batch._data),
+                         {'series': [{'metric': 'a'}, {'metric': 'b'}, {'metric': 'c'}]})
+        self.assertTrue(batch.get_coalesce_key() is None)
+
+        # Only the payloads with the same headers are coalesced
+        other = APIMetricTransaction('{"series": []}', dict(headers, **{'DD-Dogstatsd-Version': '5.9.0'}),
+                                     enqueue=False)
+        self.assertNotEqual(other.get_coalesce_key(), trs[0].get_coalesce_key())
+
+        # Not the compressed ones, nor the ones that aren't series payloads
+        compressed_headers = dict(headers, **{'Content-Encoding': 'deflate'})
+        for data, tr_headers in [
+                (zlib.compress('{"series": []}'), compressed_headers),
+                ('{"other": []}', headers),
+                ('{"series": [], "other": []}', headers),
+                ('{"series": [{"metric": "a"}], "other": ["]}"]}', headers),
+                ('{"series": {}}', headers),
+                ('{"series": [}', headers),
+                ('', headers)]:
+            tr = APIMetricTransaction(data, dict(tr_headers), enqueue=False)
+            self.assertTrue(tr.get_coalesce_key() is None)
+
+    def testPayloadSize(self):
+        """Test that the size of a transaction is the bytes of its payload"""
+        tr = MetricTransaction.__new__(MetricTransaction)
+        tr._size = None
+        tr._data = 'a' * 10000
+        tr._headers = {'Content-Type': 'application/json'}
+        self.assertEqual(tr.get_size(), 10000 + len('Content-Type') + len('application/json'))
+
+        for transaction_class, msg_type, priority in [
+                (MetricTransaction, '', PRIORITY_NORMAL),
+                (MetricTransaction, 'metrics', PRIORITY_LOW),
+                (MetricTransaction, 'metadata', PRIORITY_HIGH),
+                (APIMetricTransaction, '', PRIORITY_LOW),
+                (APIServiceCheckTransaction, '', PRIORITY_HIGH)]:
+            tr = transaction_class.__new__(transaction_class)
+            tr._msg_type = msg_type
+            self.assertEqual(tr.get_priority(), priority)
+
     def testThrottling(self):
         """Test throttling while flushing"""
 
@@ -101,11 +412,12 @@ class TestTransaction(unittest.TestCase):
             tr = memTransaction(oneTrSize, trManager)
             trManager.append(tr)
 
-        # Try to flush them, time it
+        # Try to flush them, time it: they fail, the first one is sent right away
+        # and the next ones are throttled
         before = datetime.utcnow()
         trManager.flush()
         after = datetime.utcnow()
-        self.assertTrue((after - before) > 3 * THROTTLING_DELAY - timedelta(microseconds=100000),
+        self.assertTrue((after - before) > 2 * THROTTLING_DELAY - timedelta(microseconds=100000),
                         "before = %s after = %s" % (before, after))
 
     def testCustomEndpoint(self):
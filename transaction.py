@@ -1,7 +1,9 @@
 # stdlib
+import bisect
+from collections import OrderedDict
 from datetime import datetime, timedelta
+import heapq
 import logging
-from operator import attrgetter
 import sys
 import time
 
@@ -14,8 +16,31 @@ log = logging.getLogger(__name__)
 FLUSH_LOGGING_PERIOD = 20
 FLUSH_LOGGING_INITIAL = 5
 
+# The window of transactions in flight only grows while the intake answers
+# faster than that, in seconds
+SLOW_RESPONSE_TIME = 2
+# Period over which the drain rate is measured, in seconds
+DRAIN_RATE_PERIOD = 10
+
+# When the queue is full, the transactions of the lowest priority are
+# evicted first, oldest first
+PRIORITY_LOW = 0  # Bulk metrics
+PRIORITY_NORMAL = 1
+PRIORITY_HIGH = 2  # Service checks and metadata
+PRIORITY_NAMES = {
+    PRIORITY_LOW: 'low',
+    PRIORITY_NORMAL: 'normal',
+    PRIORITY_HIGH: 'high',
+}
+
+# Upper bounds of the buckets of the number of transactions per batch
+BATCH_SIZE_BUCKETS = [1, 2, 4, 8, 16, 32]
+
 class Transaction(object):
 
+    _priority = PRIORITY_NORMAL
+    _coalesce_key = None
+
     def __init__(self):
 
         self._id = None
@@ -37,11 +62,34 @@ class Transaction(object):
         return self._error_count
 
     def get_size(self):
+        """ The bytes held by the transaction, counted against the queue size """
         if self._size is None:
-            self._size = sys.getsizeof(self)
+            self._size = self.compute_size()
 
         return self._size
 
+    def compute_size(self):
+        # The payload bytes in the subclasses that have one
+        return sys.getsizeof(self)
+
+    def get_priority(self):
+        return self._priority
+
+    def dump(self):
+        """ The transaction as a spool record, None if it can't be spooled """
+        return None
+
+    def get_coalesce_key(self):
+        """ The transactions of the same key can be sent as one, None if this one can't """
+        return self._coalesce_key
+
+    def set_coalesce_key(self, key):
+        self._coalesce_key = key
+
+    def coalesce(self, transactions):
+        """ A transaction sending the payloads of `transactions`, None if they can't be merged """
+        return None
+
     def get_next_flush(self):
         return self._next_flush
 
@@ -63,16 +111,51 @@ class Transaction(object):
 
 class TransactionManager(object):
     """Holds any transaction derived object list and make sure they
-       are all commited, without exceeding parameters (throttling, memory consumption) """
-
-    def __init__(self, max_wait_for_replay, max_queue_size, throttling_delay):
+       are all commited, without exceeding parameters (throttling, memory consumption)
+
+       The transactions waiting for their next flush are kept in a min-heap
+       of their `(next flush, id)`, so that a flush only looks at the due
+       ones, and they're indexed by id, oldest first, so that completing or
+       evicting one doesn't scan the queue.
+
+       Up to `max_in_flight` transactions are sent concurrently. The window
+       grows by one per round trip while the intake answers quickly, and is
+       halved when it's overloaded or unreachable; until it answers again,
+       the transactions are sent one `throttling_delay` apart.
+
+       With a `spool` (a `utils.spool.DiskSpool`), the transactions evicted
+       when the queue is full are written to disk instead of being dropped.
+       They're moved back to the queue, oldest first, while it has room for
+       them and the intake isn't overloaded; `load_transaction` rebuilds a
+       transaction from its record.
+
+       With a `batch_max_size`, the due transactions with a coalesce key are
+       held until those of the same key add up to `batch_max_size` bytes, or
+       the first one was held `batch_max_wait` ago, and sent as one. Each of
+       them is still completed or retried on its own. """
+
+    def __init__(self, max_wait_for_replay, max_queue_size, throttling_delay, max_in_flight=1,
+                 spool=None, load_transaction=None, batch_max_size=0, batch_max_wait=timedelta(0)):
         self._MAX_WAIT_FOR_REPLAY = max_wait_for_replay
         self._MAX_QUEUE_SIZE = max_queue_size
         self._THROTTLING_DELAY = throttling_delay
+        self._MAX_IN_FLIGHT = max(int(max_in_flight), 1)
+        self._spool = spool
+        self._load_transaction = load_transaction
+        self._BATCH_MAX_SIZE = batch_max_size
+        self._BATCH_MAX_WAIT = batch_max_wait
 
         self._flush_without_ioloop = False # useful for tests
 
-        self._transactions = []  # List of all non commited transactions
+        self._transactions = OrderedDict()  # All non commited transactions, by id
+        # The same, by priority, for the eviction
+        self._transactions_by_priority = dict((priority, OrderedDict()) for priority in PRIORITY_NAMES)
+        self._size_by_priority = dict.fromkeys(PRIORITY_NAMES, 0)
+        self._evicted = dict.fromkeys(PRIORITY_NAMES, 0)
+        # (next flush, id) of the transactions waiting to be flushed. The
+        # entries of the evicted ones are skipped when they're popped.
+        self._flush_queue = []
+        self._flushing = set()  # Ids of the transactions being flushed
         self._total_count = 0  # Maintain size/count not to recompute it everytime
         self._total_size = 0
         self._flush_count = 0
@@ -86,20 +169,136 @@ class TransactionManager(object):
         self._trs_to_flush = None # Current transactions being flushed
         self._last_flush = datetime.utcnow() # Last flush (for throttling)
 
+        self._in_flight = {}  # Time the transactions in flight were sent at, by id
+        self._window = 1.0  # Number of transactions allowed in flight
+        self._backoff = False  # Whether the last response was an overloaded intake
+        self._flush_next_pending = False  # Whether a throttled flush_next is scheduled
+
+        self._drain_rate = 0.0  # Transactions flushed per second
+        self._drain_rate_start = (time.time(), 0)
+
+        # (time the first was held, transactions by id) of the held transactions, by coalesce key
+        self._coalescing = {}
+        self._batches = {}  # The transactions sent by the batches in flight, by batch id
+        self._batched = set()  # Ids of these transactions
+        self._batch_sizes = [0] * (len(BATCH_SIZE_BUCKETS) + 1)
+
         # Track an initial status message.
         ForwarderStatus().persist()
 
     def get_transactions(self):
-        return self._transactions
+        return self._transactions.values()
 
     def print_queue_stats(self):
-        log.debug("Queue size: at %s, %s transaction(s), %s KB" %
-            (time.time(), self._total_count, (self._total_size/1024)))
+        log.debug("Queue size: at %s, %s transaction(s), %s KB",
+            time.time(), self._total_count, (self._total_size/1024))
 
     def get_tr_id(self):
         self._counter = self._counter + 1
         return self._counter
 
+    def _schedule(self, tr):
+        heapq.heappush(self._flush_queue, (tr.get_next_flush(), tr.get_id()))
+
+    def _remove(self, tr):
+        del self._transactions[tr.get_id()]
+        del self._transactions_by_priority[tr.get_priority()][tr.get_id()]
+        self._flushing.discard(tr.get_id())
+        self._total_count -= 1
+        self._total_size -= tr.get_size()
+        self._size_by_priority[tr.get_priority()] -= tr.get_size()
+
+    def _evict(self, tr):
+        """
+        Evict the transactions of lowest priority, oldest first, until
+        there's room for `tr`. Returns False if it's `tr` that must go,
+        because the transactions of a higher priority take the room.
+        """
+        tr_size = tr.get_size()
+        priority = tr.get_priority()
+        evictable = sum(size for p, size in self._size_by_priority.iteritems() if p <= priority)
+        if self._total_size - evictable + tr_size > self._MAX_QUEUE_SIZE and evictable < self._total_size:
+            log.warn("Queue is too big, dropping transaction %s for transactions of a higher priority",
+                     tr.get_id())
+            if not self._spill(tr):
+                self._evicted[priority] += 1
+            return False
+
+        log.warn("Queue is too big, removing old transactions...")
+        for p in sorted(self._transactions_by_priority):
+            transactions = self._transactions_by_priority[p]
+            while transactions and (self._total_size + tr_size) > self._MAX_QUEUE_SIZE:
+                tr2 = next(transactions.itervalues())
+                # Spooled unless it's being sent, not to send it twice
+                in_flight = self._is_in_flight(tr2)
+                self._remove(tr2)
+                if in_flight or not self._spill(tr2):
+                    self._evicted[p] += 1
+                    log.warn("Removed transaction %s from queue", tr2.get_id())
+
+        # Don't let the entries of the evicted transactions pile up
+        if len(self._flush_queue) > 2 * len(self._transactions):
+            self._flush_queue = [entry for entry in self._flush_queue
+                                 if entry[1] in self._transactions]
+            heapq.heapify(self._flush_queue)
+        return True
+
+    def _is_in_flight(self, tr):
+        return tr.get_id() in self._in_flight or tr.get_id() in self._batched
+
+    def _spill(self, tr):
+        """ Spool `tr` if there's a spool and it can be, returns whether it was """
+        if self._spool is None:
+            return False
+        record = tr.dump()
+        if record is None:
+            return False
+        log.debug("Spooling transaction %s", tr.get_id())
+        self._spool.append(record)
+        return True
+
+    def _replay_spool(self):
+        """
+        Move the spooled transactions back to the queue, oldest first, while
+        it's less than half full, so that they don't get spooled again by
+        the new transactions.
+        """
+        spool = self._spool
+        replayed = 0
+        while len(spool) and self._total_size < self._MAX_QUEUE_SIZE / 2:
+            record = spool.peek()
+            if record is None:
+                break
+            try:
+                tr = self._load_transaction(record)
+            except Exception:
+                log.exception("Unable to load a spooled transaction, dropping it")
+                spool.pop()
+                continue
+            if self._total_size + tr.get_size() > self._MAX_QUEUE_SIZE / 2 and self._transactions:
+                break
+            spool.pop()
+            self.append(tr)
+            replayed += 1
+        if replayed:
+            log.info("Replaying %s spooled transaction%s, %s left in the spool",
+                     replayed, plural(replayed), len(spool))
+
+    def close(self):
+        """
+        Spool the transactions waiting to be flushed, to send them after a
+        restart, and close the spool.
+        """
+        if self._spool is None:
+            return
+        spilled = 0
+        for tr in self.get_transactions():
+            if not self._is_in_flight(tr) and self._spill(tr):
+                spilled += 1
+        if spilled:
+            log.info("Spooled %s queued transaction%s", spilled, plural(spilled))
+        self._spool.close()
+
     def append(self,tr):
 
         # Give the transaction an id
@@ -108,26 +307,22 @@ class TransactionManager(object):
         # Check the size
         tr_size = tr.get_size()
 
-        log.debug("New transaction to add, total size of queue would be: %s KB" %
-            ((self._total_size + tr_size) / 1024))
+        log.debug("New transaction to add, total size of queue would be: %s KB",
+            (self._total_size + tr_size) / 1024)
 
-        if (self._total_size + tr_size) > self._MAX_QUEUE_SIZE:
-            log.warn("Queue is too big, removing old transactions...")
-            new_trs = sorted(self._transactions,key=attrgetter('_next_flush'), reverse = True)
-            for tr2 in new_trs:
-                if (self._total_size + tr_size) > self._MAX_QUEUE_SIZE:
-                    self._transactions.remove(tr2)
-                    self._total_count = self._total_count - 1
-                    self._total_size = self._total_size - tr2.get_size()
-                    log.warn("Removed transaction %s from queue" % tr2.get_id())
+        self._transactions_received += 1
+        if (self._total_size + tr_size) > self._MAX_QUEUE_SIZE and not self._evict(tr):
+            return
 
         # Done
-        self._transactions.append(tr)
+        self._transactions[tr.get_id()] = tr
+        self._transactions_by_priority[tr.get_priority()][tr.get_id()] = tr
+        self._schedule(tr)
         self._total_count += 1
-        self._transactions_received += 1
         self._total_size = self._total_size + tr_size
+        self._size_by_priority[tr.get_priority()] += tr_size
 
-        log.debug("Transaction %s added" % (tr.get_id()))
+        log.debug("Transaction %s added", tr.get_id())
         self.print_queue_stats()
 
     def flush(self):
@@ -136,12 +331,26 @@ class TransactionManager(object):
             log.debug("A flush is already in progress, not doing anything")
             return
 
+        if self._spool is not None and not self._backoff:
+            self._replay_spool()
+
         to_flush = []
         # Do we have something to do ?
         now = datetime.utcnow()
-        for tr in self._transactions:
-            if tr.time_to_flush(now):
-                to_flush.append(tr)
+        flush_queue = self._flush_queue
+        while flush_queue and flush_queue[0][0] < now:
+            tr = self._transactions.get(heapq.heappop(flush_queue)[1])
+            if tr is not None:
+                self._flushing.add(tr.get_id())
+                key = tr.get_coalesce_key() if self._BATCH_MAX_SIZE else None
+                if key is None:
+                    to_flush.append(tr)
+                else:
+                    self._hold(key, tr, now)
+        # Batches are lists of transactions, sent after the others
+        to_flush.extend(self._ready_batches(now))
+        # The first due is flushed first
+        to_flush.reverse()
 
         count = len(to_flush)
         should_log = self._flush_count + 1 <= FLUSH_LOGGING_INITIAL or (self._flush_count + 1) % FLUSH_LOGGING_PERIOD == 0
@@ -163,59 +372,214 @@ class TransactionManager(object):
             log.info("First flushes done, next flushes will be logged every %s flushes." % FLUSH_LOGGING_PERIOD)
 
         self._flush_count += 1
+        self._update_drain_rate()
 
         ForwarderStatus(
             queue_length=self._total_count,
             queue_size=self._total_size,
             flush_count=self._flush_count,
             transactions_received=self._transactions_received,
-            transactions_flushed=self._transactions_flushed).persist()
+            transactions_flushed=self._transactions_flushed,
+            in_flight=len(self._in_flight),
+            window=int(self._window),
+            drain_rate=self._drain_rate,
+            size_by_priority=dict((PRIORITY_NAMES[p], size) for p, size in self._size_by_priority.iteritems()),
+            evicted=dict((PRIORITY_NAMES[p], count) for p, count in self._evicted.iteritems()),
+            spool_stats=self._spool.stats() if self._spool is not None else None,
+            batch_sizes=self._batch_size_distribution()).persist()
+
+    def _hold(self, key, tr, now):
+        """ Hold `tr` until it can be sent with the transactions of the same coalesce key """
+        if key not in self._coalescing:
+            self._coalescing[key] = (now, OrderedDict())
+            # Send them once they've waited enough, even if there's no flush by then
+            tornado_ioloop = get_tornado_ioloop()
+            if tornado_ioloop._running:
+                tornado_ioloop.add_timeout(time.time() + self._BATCH_MAX_WAIT.total_seconds(), self.flush)
+        self._coalescing[key][1][tr.get_id()] = tr
+
+    def _ready_batches(self, now):
+        """
+        The batches of held transactions to send: those of the keys held for
+        `batch_max_wait`, and the full ones of the others.
+        """
+        batches = []
+        for key, (held_since, held) in self._coalescing.items():
+            del self._coalescing[key]
+            batch = []
+            batch_size = 0
+            for tr in held.itervalues():
+                if tr.get_id() not in self._transactions:
+                    # Evicted while held
+                    continue
+                if batch and batch_size + tr.get_size() > self._BATCH_MAX_SIZE:
+                    batches.append(batch)
+                    batch = []
+                    batch_size = 0
+                batch.append(tr)
+                batch_size += tr.get_size()
+            if not batch:
+                continue
+            if batch_size < self._BATCH_MAX_SIZE and now - held_since < self._BATCH_MAX_WAIT:
+                # Wait for more to join the last one
+                self._coalescing[key] = (held_since, OrderedDict((tr.get_id(), tr) for tr in batch))
+            else:
+                batches.append(batch)
+        return batches
+
+    def _make_batch(self, transactions):
+        """ The transaction to send for a batch of held transactions, None if there's none """
+        transactions = [tr for tr in transactions if tr.get_id() in self._transactions]
+        if len(transactions) <= 1:
+            if transactions:
+                self._count_batch(1)
+                return transactions[0]
+            return None
+
+        try:
+            batch = transactions[0].coalesce(transactions)
+        except Exception:
+            log.exception("Unable to coalesce %s transactions", len(transactions))
+            batch = None
+        if batch is None:
+            # Send them one by one
+            for tr in transactions:
+                tr.set_coalesce_key(None)
+                self._count_batch(1)
+            self._trs_to_flush.extend(transactions)
+            return None
+
+        batch.set_id(self.get_tr_id())
+        self._batches[batch.get_id()] = transactions
+        self._batched.update(tr.get_id() for tr in transactions)
+        self._count_batch(len(transactions))
+        log.debug("Coalesced %s transactions in batch %d", len(transactions), batch.get_id())
+        return batch
+
+    def _count_batch(self, count):
+        self._batch_sizes[bisect.bisect_left(BATCH_SIZE_BUCKETS, count)] += 1
+
+    def _batch_size_distribution(self):
+        """ The number of batches sent, by number of transactions, e.g. `[['1', 3], ['2', 5], ['3-4', 1]...]` """
+        if not any(self._batch_sizes):
+            return None
+        labels = []
+        lower = 1
+        for upper in BATCH_SIZE_BUCKETS:
+            labels.append(str(upper) if upper == lower else '%s-%s' % (lower, upper))
+            lower = upper + 1
+        labels.append('%s+' % lower)
+        return [[label, count] for label, count in zip(labels, self._batch_sizes)]
+
+    def _update_drain_rate(self):
+        start_time, start_flushed = self._drain_rate_start
+        elapsed = time.time() - start_time
+        if elapsed >= DRAIN_RATE_PERIOD:
+            self._drain_rate = (self._transactions_flushed - start_flushed) / elapsed
+            self._drain_rate_start = (time.time(), self._transactions_flushed)
 
     def flush_next(self):
+        """ Send the transactions of the current flush, as many as the window allows """
+        trs_to_flush = self._trs_to_flush
+        if trs_to_flush is None:
+            return
 
-        if len(self._trs_to_flush) > 0:
-
-            td = self._last_flush + self._THROTTLING_DELAY - datetime.utcnow()
-            # Python 2.7 has this built in, python < 2.7 don't...
-            if hasattr(td,'total_seconds'):
+        while trs_to_flush and len(self._in_flight) < int(self._window):
+            if self._backoff:
+                td = self._last_flush + self._THROTTLING_DELAY - datetime.utcnow()
                 delay = td.total_seconds()
-            else:
-                delay = (td.microseconds + (td.seconds + td.days * 24 * 3600) * 10**6) / 10.0**6
-
-            if delay <= 0:
-                tr = self._trs_to_flush.pop()
-                self._last_flush = datetime.utcnow()
-                log.debug("Flushing transaction %d" % tr.get_id())
-                try:
-                    tr.flush()
-                except Exception,e :
-                    log.exception(e)
-                    self.tr_error(tr)
-                    self.flush_next()
-            else:
-                # Wait a little bit more
-                tornado_ioloop = get_tornado_ioloop()
-                if tornado_ioloop._running:
-                    tornado_ioloop.add_timeout(time.time() + delay,
-                        lambda: self.flush_next())
-                elif self._flush_without_ioloop:
-                    # Tornado is no started (ie, unittests), do it manually: BLOCKING
-                    time.sleep(delay)
-                    self.flush_next()
-        else:
+                if delay > 0:
+                    # Wait a little bit more
+                    self._wait(delay)
+                    return
+
+            tr = trs_to_flush.pop()
+            if isinstance(tr, list):
+                tr = self._make_batch(tr)
+                if tr is None:
+                    continue
+            elif tr.get_id() not in self._transactions:
+                # Evicted since the flush started
+                continue
+            self._last_flush = datetime.utcnow()
+            self._in_flight[tr.get_id()] = time.time()
+            log.debug("Flushing transaction %d", tr.get_id())
+            try:
+                tr.flush()
+            except Exception,e :
+                log.exception(e)
+                self.tr_error(tr)
+
+        # The transactions still in flight don't hold the next flush
+        if not trs_to_flush and self._trs_to_flush is trs_to_flush:
             self._trs_to_flush = None
 
-    def tr_error(self,tr):
+    def _wait(self, delay):
+        tornado_ioloop = get_tornado_ioloop()
+        if tornado_ioloop._running:
+            if not self._flush_next_pending:
+                self._flush_next_pending = True
+                tornado_ioloop.add_timeout(time.time() + delay, self._throttled_flush_next)
+        elif self._flush_without_ioloop:
+            # Tornado is no started (ie, unittests), do it manually: BLOCKING
+            time.sleep(delay)
+            self.flush_next()
+
+    def _throttled_flush_next(self):
+        self._flush_next_pending = False
+        self.flush_next()
+
+    def _on_response(self, tr, error=False, backoff=False):
+        """ Adapt the window to the response to `tr` """
+        sent = self._in_flight.pop(tr.get_id(), None)
+        if sent is None:
+            # The response of another endpoint
+            return
+        if error:
+            if backoff:
+                self._window = max(self._window / 2, 1.0)
+                self._backoff = True
+        else:
+            self._backoff = False
+            if time.time() - sent < SLOW_RESPONSE_TIME:
+                self._window = min(self._window + 1.0 / self._window, self._MAX_IN_FLIGHT)
+
+    def tr_error(self, tr, backoff=True):
+        """ `backoff` tells that the intake is overloaded or unreachable """
+        self._on_response(tr, error=True, backoff=backoff)
+        transactions = self._batches.pop(tr.get_id(), None)
+        if transactions is not None:
+            log.warn("Batch %d of %s transactions in error", tr.get_id(), len(transactions))
+            for tr2 in transactions:
+                self._batched.discard(tr2.get_id())
+                if not backoff:
+                    # The intake rejected the batch, maybe for one of them: retry them one by one
+                    tr2.set_coalesce_key(None)
+                self._retry(tr2)
+            return
+        self._retry(tr)
+
+    def _retry(self, tr):
         tr.inc_error_count()
         tr.compute_next_flush(self._MAX_WAIT_FOR_REPLAY)
-        log.warn("Transaction %d in error (%s error%s), it will be replayed after %s" %
-          (tr.get_id(), tr.get_error_count(), plural(tr.get_error_count()),
-           tr.get_next_flush()))
+        log.warn("Transaction %d in error (%s error%s), it will be replayed after %s",
+          tr.get_id(), tr.get_error_count(), plural(tr.get_error_count()),
+          tr.get_next_flush())
+        # Unless it was evicted, or already rescheduled by another endpoint
+        if tr.get_id() in self._flushing:
+            self._flushing.discard(tr.get_id())
+            self._schedule(tr)
 
     def tr_success(self,tr):
-        log.debug("Transaction %d completed" % tr.get_id())
-        self._transactions.remove(tr)
-        self._total_count -= 1
-        self._total_size -= tr.get_size()
-        self._transactions_flushed += 1
+        log.debug("Transaction %d completed", tr.get_id())
+        self._on_response(tr)
+        transactions = self._batches.pop(tr.get_id(), None)
+        if transactions is not None:
+            for tr2 in transactions:
+                self._batched.discard(tr2.get_id())
+                self.tr_success(tr2)
+            return
+        if tr.get_id() in self._transactions:
+            self._remove(tr)
+            self._transactions_flushed += 1
         self.print_queue_stats()
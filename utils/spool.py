@@ -0,0 +1,248 @@
+# stdlib
+import logging
+import os
+import struct
+import threading
+import zlib
+
+log = logging.getLogger(__name__)
+
+# Length, crc32 and flags of each record
+RECORD_HEADER = struct.Struct('!IIB')
+COMPRESSED_FLAG = 1
+SEGMENT_SUFFIX = '.seg'
+CURSOR_FILE = 'cursor'
+MAX_SEGMENT_SIZE = 8 * 1024 * 1024
+
+
+class DiskSpool(object):
+    """
+    A FIFO of records, persisted in append-only segment files under `path`.
+
+    Records are appended to the newest segment, and a new one is started
+    once it's over `segment_size` bytes. The spool never holds more than
+    `max_size` bytes: past that, its oldest segments are deleted, records
+    included. Read segments are deleted, and the read position is saved
+    in a cursor file, so that the records left are recovered on restart.
+
+    Thread-safe.
+    """
+
+    def __init__(self, path, max_size, segment_size=None):
+        self.path = path
+        self.max_size = int(max_size)
+        self.segment_size = int(segment_size or min(MAX_SEGMENT_SIZE, max(self.max_size // 8, 1)))
+        self._lock = threading.Lock()
+
+        # [sequence number, size, record count] of each segment, oldest first
+        self._segments = []
+        self._writer = None
+        # Position of the next record to read in the oldest segment
+        self._read_offset = 0
+        self._read_records = 0
+        self._peeked_end = None
+
+        self.size = 0
+        self.records = 0
+        # Counts since startup
+        self.spooled = 0
+        self.replayed = 0
+        self.evicted = 0
+        self.corrupted = 0
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._load()
+
+    def _segment_path(self, seq):
+        return os.path.join(self.path, '%020d%s' % (seq, SEGMENT_SUFFIX))
+
+    def _load(self):
+        """ Recover the segments and the read position of a previous run """
+        sequences = sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(self.path)
+                           if name.endswith(SEGMENT_SUFFIX) and name[:-len(SEGMENT_SUFFIX)].isdigit())
+        cursor_seq, cursor_offset = self._read_cursor()
+
+        for seq in sequences:
+            if seq < cursor_seq:
+                # Fully read before the restart
+                os.remove(self._segment_path(seq))
+                continue
+            size, records = self._scan(seq)
+            if not records:
+                os.remove(self._segment_path(seq))
+                continue
+            self._segments.append([seq, size, records])
+            self.size += size
+            self.records += records
+
+        if self._segments and self._segments[0][0] == cursor_seq:
+            self._skip_to(cursor_offset)
+        if self.records:
+            log.info("Recovered %s spooled records (%s bytes) from %s", self.records, self.size, self.path)
+
+    def _scan(self, seq):
+        """
+        Count the records of a segment, and truncate it after the last
+        complete one, in case the agent stopped while writing it.
+        """
+        path = self._segment_path(seq)
+        size = records = 0
+        with open(path, 'rb') as f:
+            while True:
+                header = f.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    break
+                length = RECORD_HEADER.unpack(header)[0]
+                f.seek(length, os.SEEK_CUR)
+                if f.tell() > os.fstat(f.fileno()).st_size:
+                    break
+                size += RECORD_HEADER.size + length
+                records += 1
+        if size < os.path.getsize(path):
+            log.warning("Truncating the incomplete record at the end of %s", path)
+            with open(path, 'r+b') as f:
+                f.truncate(size)
+        return size, records
+
+    def _skip_to(self, offset):
+        """ Move the read position of the oldest segment to `offset` """
+        with open(self._segment_path(self._segments[0][0]), 'rb') as f:
+            while self._read_offset < min(offset, self._segments[0][1]):
+                length = RECORD_HEADER.unpack(f.read(RECORD_HEADER.size))[0]
+                f.seek(length, os.SEEK_CUR)
+                self._read_offset = f.tell()
+                self._read_records += 1
+                self.records -= 1
+
+    def _read_cursor(self):
+        try:
+            with open(os.path.join(self.path, CURSOR_FILE)) as f:
+                seq, offset = f.read().split()
+                return int(seq), int(offset)
+        except (IOError, ValueError):
+            return -1, 0
+
+    def _write_cursor(self):
+        seq = self._segments[0][0] if self._segments else -1
+        path = os.path.join(self.path, CURSOR_FILE)
+        with open(path + '.tmp', 'w') as f:
+            f.write('%s %s' % (seq, self._read_offset))
+        os.rename(path + '.tmp', path)
+
+    def _drop_oldest(self):
+        """ Delete the oldest segment, returns the number of unread records it had """
+        seq, size, records = self._segments.pop(0)
+        if self._writer is not None and not self._segments:
+            self._writer.close()
+            self._writer = None
+        os.remove(self._segment_path(seq))
+        unread = records - self._read_records
+        self.size -= size
+        self.records -= unread
+        self._read_offset = 0
+        self._read_records = 0
+        self._peeked_end = None
+        return unread
+
+    def append(self, record, compress=True):
+        """
+        Append `record`, compressed unless it already is. Returns the number
+        of records evicted to make room for it.
+        """
+        flags = 0
+        if compress:
+            record = zlib.compress(record, 1)
+            flags |= COMPRESSED_FLAG
+        data = RECORD_HEADER.pack(len(record), zlib.crc32(record) & 0xffffffff, flags) + record
+        if len(data) > self.max_size:
+            log.warning("Not spooling a record of %s bytes, over the spool size of %s bytes",
+                        len(data), self.max_size)
+            return 0
+
+        with self._lock:
+            evicted = 0
+            while self._segments and self.size + len(data) > self.max_size:
+                evicted += self._drop_oldest()
+            if evicted:
+                self.evicted += evicted
+                log.warning("The spool is full, evicted its %s oldest records", evicted)
+                self._write_cursor()
+
+            if not self._segments or self._segments[-1][1] >= self.segment_size:
+                seq = self._segments[-1][0] + 1 if self._segments else self._read_cursor()[0] + 1
+                if self._writer is not None:
+                    self._writer.close()
+                self._segments.append([seq, 0, 0])
+                self._writer = open(self._segment_path(seq), 'ab')
+            elif self._writer is None:
+                self._writer = open(self._segment_path(self._segments[-1][0]), 'ab')
+
+            self._writer.write(data)
+            self._writer.flush()
+            segment = self._segments[-1]
+            segment[1] += len(data)
+            segment[2] += 1
+            self.size += len(data)
+            self.records += 1
+            self.spooled += 1
+            return evicted
+
+    def peek(self):
+        """ The oldest record, or None if there's none """
+        with self._lock:
+            while self.records:
+                seq, size, records = self._segments[0]
+                if self._read_offset >= size:
+                    self._drop_oldest()
+                    continue
+
+                with open(self._segment_path(seq), 'rb') as f:
+                    f.seek(self._read_offset)
+                    length, crc, flags = RECORD_HEADER.unpack(f.read(RECORD_HEADER.size))
+                    record = f.read(length)
+                if len(record) == length and zlib.crc32(record) & 0xffffffff == crc:
+                    self._peeked_end = self._read_offset + RECORD_HEADER.size + length
+                    if flags & COMPRESSED_FLAG:
+                        record = zlib.decompress(record)
+                    return record
+
+                # The rest of the segment can't be trusted
+                log.warning("Dropping the corrupted records of %s", self._segment_path(seq))
+                self.corrupted += self._drop_oldest()
+            return None
+
+    def pop(self):
+        """ Remove the record returned by the last `peek` """
+        with self._lock:
+            if self._peeked_end is None:
+                return
+            self._read_offset = self._peeked_end
+            self._read_records += 1
+            self._peeked_end = None
+            self.records -= 1
+            self.replayed += 1
+            if self._read_offset >= self._segments[0][1] and len(self._segments) > 1:
+                self._drop_oldest()
+            self._write_cursor()
+
+    def __len__(self):
+        return self.records
+
+    def stats(self):
+        with self._lock:
+            return {
+                'records': self.records,
+                'size': self.size,
+                'segments': len(self._segments),
+                'spooled': self.spooled,
+                'replayed': self.replayed,
+                'evicted': self.evicted,
+                'corrupted': self.corrupted,
+            }
+
+    def close(self):
+        with self._lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None